@@ -5,6 +5,7 @@ RAWDIR = os.path.join(ROOTDIR,'raw')
 OUTDIR = os.path.join(ROOTDIR,'out')
 IMGDIR = os.path.join(OUTDIR, 'img')
 TRAFFICDIR = os.path.join(OUTDIR, 'traffic')
+TREEDIR = os.path.join(OUTDIR, 'trees') # optimal trees memoized by obst()
 
 BGPTAB = 'bgptable.txt' # file name for raw & processed prefixes
 STATSFILE = 'stats.txt' # write stats for prefix distribution here
@@ -3,12 +3,19 @@ Compute optimal binary search tree with various weighting functions:
     - equal weights (balanced tree)
     - weights correlated with prefix count
     - weights correlated with prefix IP address space share
+    - weights counted during lookups (BMP prefix length frequencies)
 
-Using Knuth's dynamic programming algorithm.
+Using Knuth's dynamic programming algorithm, O(n^2). Trees are memoized
+in memory and on disk (TREEDIR), keyed by protocol and a hash of the
+weights, so repeated builds skip the dynamic program.
 '''
 
 import os
+import json
+from hashlib import sha1
 from sys import maxsize
+from bisect import bisect_right
+from array import array
 from conf import *
 
 class Node:
@@ -46,45 +53,75 @@ def weigh_by_prefix_range(protocol='v4'):
     '''
     return weigh_by_prefix_count(protocol=protocol, skiplines=1)
 
-def _construct_w_tab(weights):
-    '''Construct and return upper triangular weight matrix: (n+1) x (n+1)
+def weigh_by_lookups(counts, pref_lens, floor=1.0):
+    '''Return a weight function for `pref_lens` (ascending) and gap
+        weights (see obst()) from `counts[pref_len]`, the number of lookups
+        whose deepest match is of length pref_len: the longest length at
+        which the IP shares its leading bits with a route at least as long.
+        Such a lookup hits at that length (a prefix, or a marker of a
+        longer route) and misses the longer lengths, so it ends its walk
+        down the tree at the gap just after it; its BMP may be shorter.
+        So the counts weigh the gaps, gap i (between pref_lens[i-1] and
+        pref_lens[i]) those of lengths pref_lens[i-1]..pref_lens[i]-1 and
+        gap 0 the default route, each plus `floor`, and the lengths weigh
+        nothing:
+        (weigh, [gap weight, ..., gap weight]), one more gap than lengths
+    '''
+    gaps = [floor] * (len(pref_lens)+1)
+    for pref_len, count in enumerate(counts):
+        gaps[bisect_right(pref_lens, pref_len)] += count
+    def weigh(protocol='v4'):
+        return [(0.0, pref_len) for pref_len in pref_lens]
+    return weigh, gaps
+
+def _construct_w_tab(weights, gaps=None):
+    '''Construct and return upper triangular weight matrix: (n+1) x (n+1),
+        one array of doubles per row.
     '''
     p = [w for w,_ in weights]
-    mat = [[0.0 for i in range(len(weights)+1)] for j in range(len(weights)+1)]
-    for i in range(len(weights)):
+    q = gaps or [0.0] * (len(weights)+1)
+    mat = [array('d', bytes(8 * (len(weights)+1))) for j in range(len(weights)+1)]
+    for i in range(len(weights)+1):
+        mat[i][i] = q[i]
         for j in range(i, len(weights), 1):
-            mat[i][j+1] = mat[i][j] + p[j]
+            mat[i][j+1] = mat[i][j] + p[j] + q[j+1]
     return mat
 
-def _construct_tabs(weights):
+def _construct_tabs(weights, gaps=None):
     '''Construct and return upper triangular weight (w), expected cost (e)
-        and optimal subtree root (r) matrices, each (n+1) x (n+1).
+        and optimal subtree root (r) matrices, each (n+1) x (n+1), one
+        array per row.
+
+        Knuth's bound r[i][j-1] <= r[i][j] <= r[i+1][j] limits the roots
+        tried for each subtree, which makes the whole table O(n^2).
     '''
-    w = _construct_w_tab(weights)
-    # initialize optimal subtree root table (when row == col, None signals to stop iteration)
-    r = [[None for i in range(len(weights)+1)] for j in range(len(weights)+1)]
+    n = len(weights)
+    q = gaps or [0.0] * (n+1)
+    w = _construct_w_tab(weights, gaps)
+    # initialize optimal subtree root table (0 where row == col: no subtree)
+    r = [array('i', bytes(4 * (n+1))) for j in range(n+1)]
     # initialize expected costs to very large num
-    e = [[maxsize for i in range(len(weights)+1)] for j in range(len(weights)+1)]
-    for i in range(len(weights)):
-        e[i][i] = 0.0
-        e[i][i+1] = weights[i][0]
+    e = [array('d', [maxsize] * (n+1)) for j in range(n+1)]
+    for i in range(n):
+        e[i][i] = q[i]
+        e[i][i+1] = q[i] + q[i+1] + w[i][i+1]
         r[i][i+1] = i+1
-    e[len(e)-1][len(e)-1] = 0.0
+    e[n][n] = q[-1]
 
-    for l in range(len(weights)+1):
-        for i in range(len(weights)+1-l):
+    for l in range(2, n+1):
+        for i in range(n+1-l):
             j = i + l
-            for root in range(i+1, j+1, 1):
-                t = e[i][root-1] + e[root][j] + w[i][j]
-                if t < e[i][j]:
-                    e[i][j] = t
-                    # r[i][j] = root-1
+            e_i, w_ij, best = e[i], w[i][j], e[i][j]
+            for root in range(r[i][j-1], r[i+1][j]+1):
+                t = e_i[root-1] + e[root][j] + w_ij
+                if t < best:
+                    best = t
                     r[i][j] = root
+            e[i][j] = best
     return w, e, r
 
 def _build_optimal_bin_search_tree(r, weights):
     '''Construct optimal binary search tree from the optimal root matrix (r).
-        Caveat: this functions modifies the r matrix in place.
     '''
     minn, maxx = 0, len(r)-1
     root = Node(r[0][-1])
@@ -157,14 +194,63 @@ def _output(tree, protocol='v4', fname='balanced_tree.dot'):
     with open(os.path.join(IMGDIR, 'ip'+protocol, fname), 'w') as outfile:
         outfile.write(dotgraph)
 
-def obst(protocol='v4', weigh=weigh_equally, plot=False, fname='tree.dot'):
+_trees = dict() # memoized trees: cache key -> nested [val, left, right] lists
+
+def _to_lists(tree):
+    if tree is None: return None
+    return [tree.val, _to_lists(tree.left), _to_lists(tree.right)]
+
+def _from_lists(lists):
+    if lists is None: return None
+    return Node(lists[0], _from_lists(lists[1]), _from_lists(lists[2]))
+
+def _cache_key(protocol, weights, gaps):
+    '''Return the protocol and a hash of the weights, e.g. 'v4_3f2a...'.
+    '''
+    digest = sha1(json.dumps([weights, gaps]).encode()).hexdigest()
+    return '%s_%s' %(protocol, digest)
+
+def _cached_tree(key):
+    '''Return the memoized tree under `key`, or None if not memoized yet.
+    '''
+    if key not in _trees:
+        try:
+            with open(os.path.join(TREEDIR, key + '.json'), 'r') as infile:
+                _trees[key] = json.load(infile)
+        except (OSError, ValueError):
+            return None
+    return _from_lists(_trees[key])
+
+def _cache_tree(key, tree):
+    '''Memoize `tree` under `key`, on disk if TREEDIR is writable.
+    '''
+    _trees[key] = _to_lists(tree)
+    fpath = os.path.join(TREEDIR, key + '.json')
+    try:
+        os.makedirs(TREEDIR, exist_ok=True)
+        with open(fpath + '.tmp', 'w') as outfile:
+            json.dump(_trees[key], outfile)
+        os.replace(fpath + '.tmp', fpath)
+    except OSError:
+        pass # the in-memory copy still serves this process
+
+def obst(protocol='v4', weigh=weigh_equally, plot=False, fname='tree.dot', gaps=None,
+         cache=True):
     '''Return balanced tree. Optionally output .dot file for Graphviz.
+        `gaps` optionally weighs the n+1 gaps around the n prefix lengths
+        (searches that end between two lengths), as in Knuth's algorithm.
+        Unset `cache` to recompute the tree rather than use a memoized one.
     '''
     weights = (weigh(protocol=protocol))
-    w, e, r = _construct_tabs(weights)
+    key = _cache_key(protocol, weights, gaps)
+    tree = _cached_tree(key) if cache else None
+    if tree is None:
+        w, e, r = _construct_tabs(weights, gaps)
 
-    # construct the tree
-    tree = _build_optimal_bin_search_tree(r, weights)
+        # construct the tree
+        tree = _build_optimal_bin_search_tree(r, weights)
+        if cache:
+            _cache_tree(key, tree)
     if plot:
         _output(tree, protocol=protocol, fname=fname)
     return tree
@@ -183,3 +269,11 @@ if __name__ == "__main__":
     # weights correlated with prefix IP address space share
     addrshare_tree_v4 = obst('v4', weigh_by_prefix_range, plot=True, fname='prefix_addrshare_tree.dot')
     addrshare_tree_v6 = obst('v6', weigh_by_prefix_range, plot=True, fname='prefix_addrshare_tree.dot')
+
+    # memoized trees: built again without the dynamic program
+    from time import perf_counter
+    for cache in (False, True):
+        start = perf_counter()
+        tree = obst('v6', weigh_by_prefix_count, cache=cache)
+        print('cache=%s: %.4fs' %(cache, perf_counter() - start))
+    print(_to_lists(tree) == _to_lists(prefcount_tree_v6)) # => True
@@ -2,9 +2,9 @@
 - parse BGP tables from http://bgp.potaroo.net/index-bgp.html
 - plot and output the stats about prefix count & address space covered
 - fetch covered address space and partition the space by prefix length
-- output sorted list of prefixes:
-    prefix_int prefix_len cidr_network
-    16909060 32 1.2.3.4/32
+- output sorted list of prefixes and their next hops:
+    prefix_int prefix_len cidr_network next_hop
+    16909060 32 1.2.3.4/32 203.62.252.83
 
 Usage:
     python3 preprocess_bgp_tables.py
@@ -20,11 +20,10 @@ IPv4_SPACE = 2**32
 IPv6_SPACE = 2**128
 
 def parse_oregon(protocol='v4'):
-    ''' Extract network addresses from the Oregon table (IPv4 or IPv6).
-        Ignore next hop for the purpose of this experiment.
+    ''' Extract network addresses from the Oregon table (IPv4 or IPv6),
+        with the next hop of the best path to each ('-' if none given).
 
-        Write (NetworkStr PrefixLength NetworkInt) to file and return
-        count of prefix lengths.
+        Return list of (NetworkStr, NextHopStr) pairs.
     '''
     if protocol == 'v4':
         return _oregon_v4()
@@ -40,7 +39,8 @@ def _oregon_v4():
                 parts = line[1:].split()
                 if len(parts) > 0:
                     network = parts[0]
-                    res.append(network)
+                    next_hop = parts[1] if len(parts) > 1 else '-'
+                    res.append((network, next_hop))
     return res
 
 def _oregon_v6():
@@ -54,7 +54,8 @@ def _oregon_v6():
                 network = parts[0]
                 if network in seen: continue
                 seen.add(network)
-                res.append(network)
+                next_hop = parts[1] if len(parts) > 1 else '-'
+                res.append((network, next_hop))
     return res
 
 
@@ -140,12 +141,12 @@ def plot_stats(x, y, outdir=IMGDIR, outfile='stats.png', title='Count vs. Length
     plt.savefig(os.path.join(outdir, outfile), format='png',
                 bbox_inches='tight')
 
-def output(prefixes, protocol='v4'):
-    res = sorted([net.IPNetwork(network) for network in prefixes])
-    triples = map(lambda network: (network.first, network.prefixlen, str(network)), res)
+def output(routes, protocol='v4'):
+    res = sorted([(net.IPNetwork(network), next_hop) for network, next_hop in routes])
+    rows = map(lambda route: (route[0].first, route[0].prefixlen, str(route[0]), route[1]), res)
 
     with open(os.path.join(TRAFFICDIR, 'ip'+protocol, BGPTAB), 'w') as outfile:
-        outfile.write('\n'.join('%d %d %s' %group for group in triples))
+        outfile.write('\n'.join('%d %d %s %s' %group for group in rows))
 
 def write_stats(arrays, protocol='v4'):
     with open(os.path.join(TRAFFICDIR, 'ip'+protocol, STATSFILE), 'w') as outfile:
@@ -158,13 +159,14 @@ def preprocess(protocol='v4'):
         LEN = 33
     else:
         LEN = 129
-    # extract addresses
-    prefixes = parse_oregon(protocol)
+    # extract addresses and next hops
+    routes = parse_oregon(protocol)
+    prefixes = [network for network, _ in routes]
 
     # output sorted list of prefixes (will be entered in Bloom filter):
-    #     prefix_int prefix_len cidr_network
-    #     16909060 32 1.2.3.4/32
-    output(prefixes, protocol)
+    #     prefix_int prefix_len cidr_network next_hop
+    #     16909060 32 1.2.3.4/32 203.62.252.83
+    output(routes, protocol)
 
     # partitions of address space by prefix length
     ipset_covered_by_prefixes, fraction_covered, ipsets_for_each_prefix_length =\
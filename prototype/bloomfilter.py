@@ -1,10 +1,14 @@
 from bitarray import bitarray
-from fnv import hash_fnv
+import numpy as np
+from fnv import to_words
+from hashfuncs import HASH_FUNCS
 from math import log, ceil
-from profiler import count_invocations
+from functools import partial
+from profiler import count_invocations, instrumented
 
 class BloomFilter:
-    def __init__(self, fpp, n, k=None, num_bits=None):
+    def __init__(self, fpp, n, k=None, num_bits=None, width=None, hash_func='fnv',
+                 buffer=None, instrument=True):
         ''' Calculate size of bit array, number of hash functions
                 (k, unless specified) or set the params arbitrarily.
             Initialize the bitarray.
@@ -12,6 +16,15 @@ class BloomFilter:
             fpp (float): 0.0 <= false positive probability <= 1.0
             n (int): expected number of elements to insert
             k (int, optional): override the number of hash functions to use
+            width (int, optional): fixed key width in bytes for hashing,
+                None for the legacy getsizeof()-wide hash (see fnv.hash_fnv)
+            hash_func (str, optional): hash family, a key of
+                hashfuncs.HASH_FUNCS
+            buffer (optional): writable bytes-like object of at least
+                num_bits/8 bytes to use as the bit array without copying
+                (e.g. the bits of another filter in shared memory)
+            instrument (bool, optional): count probes (_register.ncalls) and
+                hash calls; if False, probe with no counters at all
         '''
         if k is None: # default case, calculate optimal k
             num_bits = ceil(-n * log(fpp) / ((log(2))**2))
@@ -27,6 +40,18 @@ class BloomFilter:
             self.k = k
             self.fpp = -1.0 # TODO
         self.num_elements = n
+        self.width = width
+        self.hash_func = hash_func
+        self._hash, self._hash_many, self._split_high = HASH_FUNCS[hash_func]
+        self.instrument = instrument
+        if not instrument: # bind the uncounted hash and probe loop
+            self._hash = instrumented(self._hash, enabled=False)
+            self._hash_many = partial(self._hash_many, instrument=False)
+            self._helper = self._plain_helper
+        self.num_bits = num_bits # a buffer may hold a few more (padding) bits
+        if buffer is not None:
+            self.ba = bitarray(buffer=buffer)
+            return
         self.ba = bitarray(num_bits)
         self.ba.setall(False)
 
@@ -39,61 +64,365 @@ class BloomFilter:
             BitArray size
             % of BitArray set
         '''
-        res = 'BloomFilter(fpp=%.8f, n=%d, k=%d, ba=(malloc=%.2fMB, length=%db, %%full=%.1f))'\
-                %(self.fpp,
+        res = '%s(fpp=%.8f, n=%d, k=%d, ba=(malloc=%.2fMB, length=%db, %%full=%.1f))'\
+                %(type(self).__name__,
+                  self.fpp,
                   self.num_elements,
                   self.k,
                   self.ba.buffer_info()[-1]/(1024**2),
-                  self.ba.length(),
-                  100*self.ba.count()/self.ba.length())
+                  self.num_bits,
+                  100*self.ba.count()/self.num_bits)
         return res
 
     def _set_bit(self, ix):
         self.ba[ix] = True
         return True
 
-    def insert(self, key, hashes=[]):
+    def hash_key(self, key):
+        '''Return the 64-bit hash of key, which can be passed as `hash64`
+            to insert()/contains() to probe the same key repeatedly
+            without rehashing it.
+        '''
+        return self._hash(key, self.width)
+
+    def hash_many(self, keys):
+        '''Vectorized hash_key(): uint64 array of the hashes of `keys`,
+            which can be passed as `hash64` to contains_many().
+        '''
+        return self._hash_many(keys, self.width)
+
+    def insert(self, key, hashes=[], hash64=None):
         '''Insert key into Bloom filter. By default using full
         range of hash functions. If hashes is a list/generator
         of hash funcs to use (indices).
         '''
         self._helper(key, lamda=self._set_bit,
                      hashes=hashes,
-                     keep_going=True)
+                     keep_going=True,
+                     hash64=hash64)
 
-    def contains(self, key, hashes=[], keep_going=False):
+    def contains(self, key, hashes=[], keep_going=False, hash64=None):
         '''Return non-zero number if present, else 0.
             The returned number can be sometimes interpreted as index.
         '''
         return self._helper(key, lamda=self.ba.__getitem__,
                             hashes=hashes,
-                            keep_going=keep_going)
+                            keep_going=keep_going,
+                            hash64=hash64)
 
 
-    def _helper(self, key, lamda=None, hashes=[], keep_going=False):
+    def _helper(self, key, lamda=None, hashes=[], keep_going=False, hash64=None):
         '''Insert or look up key (int) in Bloom filter using
             hash functions from hashes list.
             If `keep_going` is True, complete all `hashes` and decode the result.
+            `hash64` is the precomputed hash_key(key), if available.
         '''
         if not hashes: return 0
-        hash64 = hash_fnv(key)
-        h1 = hash64 & 0x00000000FFFFFFFF
-        h2 = hash64 & 0xFFFFFFFF00000000
+        if hash64 is None:
+            hash64 = self._hash(key, self.width)
         decode = 0
-        size = self.ba.length()
-        for i in hashes:
+        for i, ix in zip(hashes, self._positions(hash64, hashes)):
             self._register() # count iterations
-            ix = (h1 + i * h2) % size
             res = lamda(ix)
             if res==False and not keep_going:
                 return 0
             decode += int(res)<<(i-hashes[0])
         return decode
 
+    def _plain_helper(self, key, lamda=None, hashes=[], keep_going=False, hash64=None):
+        '''_helper() without counting, for filters built with instrument=False.
+        '''
+        if not hashes: return 0
+        if hash64 is None:
+            hash64 = self._hash(key, self.width)
+        decode = 0
+        for i, ix in zip(hashes, self._positions(hash64, hashes)):
+            res = lamda(ix)
+            if res==False and not keep_going:
+                return 0
+            decode += int(res)<<(i-hashes[0])
+        return decode
+
+    def _positions(self, hash64, hashes):
+        '''Bit indices probed by hash funcs `hashes` (double hashing).
+        '''
+        h1 = hash64 & 0x00000000FFFFFFFF
+        h2 = hash64 >> 32 if self._split_high else hash64 & 0xFFFFFFFF00000000
+        size = self.num_bits
+        return [(h1 + i * h2) % size for i in hashes]
+
+    def insert_many(self, keys, hashes=[]):
+        '''Vectorized insert(): set the `hashes` bits of every key in
+            `keys` (NumPy array of uint64 encoded prefixes, or of words
+            from fnv.to_words() for keys wider than 8 bytes) in one pass.
+        '''
+        hashes = list(hashes)
+        keys = np.asarray(keys, dtype=np.uint64)
+        if not hashes or len(keys) == 0: return
+        byte_ix, bit_masks = self._locate_many(self._probe_many(keys, hashes))
+        np.bitwise_or.at(self._buffer(), byte_ix.ravel(), bit_masks.ravel())
+        if self.instrument:
+            BloomFilter._register.ncalls += byte_ix.size # count iterations
+
+    def contains_many(self, keys, hashes=[], keep_going=False, hash64=None):
+        '''Vectorized contains(): returns a NumPy uint64 array holding,
+            for each key in `keys`, the value contains() would return
+            (including the decoded pattern if `keep_going` is True).
+            `hash64` is the precomputed hash_many(keys), if available
+            (`keys` can then be None).
+        '''
+        hashes = list(hashes)
+        num_keys = len(keys) if hash64 is None else len(hash64)
+        if not hashes or num_keys == 0:
+            return np.zeros(num_keys, dtype=np.uint64)
+        if hash64 is None:
+            hash64 = self.hash_many(np.asarray(keys, dtype=np.uint64))
+        byte_ix, bit_masks = self._locate_many(self._positions_many(hash64, hashes))
+        bits = (self._buffer()[byte_ix] & bit_masks) != 0
+
+        shifts = np.array(hashes, dtype=np.uint64) - np.uint64(hashes[0])
+        decode = (bits.astype(np.uint64) << shifts).sum(axis=1, dtype=np.uint64)
+        if keep_going:
+            if self.instrument:
+                BloomFilter._register.ncalls += bits.size
+            return decode
+        # the scalar loop stops at the first unset bit
+        found = bits.all(axis=1)
+        if self.instrument:
+            BloomFilter._register.ncalls += int(np.where(found, len(hashes),
+                                                         bits.argmin(axis=1) + 1).sum())
+        return np.where(found, decode, np.uint64(0))
+
+    def _probe_many(self, keys, hashes):
+        '''Returns (len(keys), len(hashes)) array of bit indices, the same
+            (h1 + i*h2) % size sequence _helper() walks for each key.
+        '''
+        return self._positions_many(self._hash_many(keys, self.width), hashes)
+
+    def _positions_many(self, hash64, hashes):
+        size = np.uint64(self.num_bits)
+        # reduce before multiplying so that i*h2 cannot wrap around 64 bits
+        h1 = (hash64 & np.uint64(0x00000000FFFFFFFF)) % size
+        if self._split_high:
+            h2 = (hash64 >> np.uint64(32)) % size
+        else:
+            h2 = (hash64 & np.uint64(0xFFFFFFFF00000000)) % size
+        i = np.array(hashes, dtype=np.uint64)
+        return (h1[:, None] + i[None, :] * h2[:, None]) % size
+
+    def _locate_many(self, ixs):
+        '''Map bit indices to (byte index, bit mask) pairs in the buffer.
+        '''
+        offsets = ixs & np.uint64(7)
+        if self.ba.endian() == 'big':
+            offsets = np.uint64(7) - offsets
+        return ixs >> np.uint64(3), (np.uint64(1) << offsets).astype(np.uint8)
+
+    def _buffer(self):
+        '''Bit array buffer viewed as a (writable) NumPy byte array.
+        '''
+        return np.frombuffer(self.ba, dtype=np.uint8)
+
     @count_invocations
     def _register(self):
         pass
 
+BLOCK_BITS = 512 # one 64-byte cache line
+
+class BlockedBloomFilter(BloomFilter):
+    '''Cache-line-blocked Bloom filter: the low hash word picks a block of
+        BLOCK_BITS bits and all probes of a key fall inside that block, so a
+        lookup touches one cache line instead of up to k (at the price of
+        a somewhat higher false positive rate for the same bit array size).
+        Same insert/contains API, including pattern decoding, as BloomFilter.
+    '''
+    def __init__(self, fpp, n, k=None, num_bits=None, width=None, hash_func='fnv',
+                 buffer=None, instrument=True):
+        BloomFilter.__init__(self, fpp, n, k=k, num_bits=num_bits, width=width,
+                             hash_func=hash_func, buffer=buffer, instrument=instrument)
+        # round bit array up to whole blocks
+        self.num_blocks = ceil(self.num_bits / BLOCK_BITS)
+        if self.num_bits != self.num_blocks * BLOCK_BITS:
+            if buffer is not None: # cannot grow a shared buffer
+                raise ValueError('%d bits are not whole blocks of %d bits, as a buffer needs'
+                                 %(self.num_bits, BLOCK_BITS))
+            self.num_bits = self.num_blocks * BLOCK_BITS
+            self.ba = bitarray(self.num_bits)
+            self.ba.setall(False)
+
+    def _helper(self, key, lamda=None, hashes=[], keep_going=False, hash64=None):
+        if hashes: self._register_line() # one block per key
+        return BloomFilter._helper(self, key, lamda=lamda, hashes=hashes,
+                                   keep_going=keep_going, hash64=hash64)
+
+    def _positions(self, hash64, hashes):
+        '''Bit indices probed by hash funcs `hashes`, all in the same block:
+            high hash word split into an offset and an odd (hence full
+            period) stride within the block.
+        '''
+        block = ((hash64 & 0x00000000FFFFFFFF) % self.num_blocks) * BLOCK_BITS
+        offset = (hash64 >> 32) & 0xFFFF
+        stride = (hash64 >> 48) | 1
+        return [block + (offset + i * stride) % BLOCK_BITS for i in hashes]
+
+    def _positions_many(self, hash64, hashes):
+        if self.instrument:
+            BlockedBloomFilter._register_line.ncalls += len(hash64)
+        bits = np.uint64(BLOCK_BITS)
+        block = ((hash64 & np.uint64(0x00000000FFFFFFFF)) % np.uint64(self.num_blocks)) * bits
+        offset = (hash64 >> np.uint64(32)) & np.uint64(0xFFFF)
+        stride = (hash64 >> np.uint64(48)) | np.uint64(1)
+        i = np.array(hashes, dtype=np.uint64)
+        return block[:, None] + (offset[:, None] + i[None, :] * stride[:, None]) % bits
+
+    @count_invocations
+    def _register_line(self):
+        pass
+
+class CountingBloomFilter(BloomFilter):
+    '''Counting Bloom filter that supports remove(): one `counter_bits`-wide
+        counter per bit of the bit array, packed 8//counter_bits per byte.
+        The bit array mirrors (counter > 0), so lookups are exactly
+        BloomFilter's and only updates touch the counters. A counter that
+        reaches 2**counter_bits - 1 saturates and is never decremented
+        again, trading a few stale bits for never a false negative.
+    '''
+    def __init__(self, fpp, n, k=None, num_bits=None, width=None, counter_bits=4,
+                 hash_func='fnv', instrument=True):
+        assert counter_bits in (2, 4, 8)
+        BloomFilter.__init__(self, fpp, n, k=k, num_bits=num_bits, width=width,
+                             hash_func=hash_func, instrument=instrument)
+        self.counter_bits = counter_bits
+        self.per_byte = 8 // counter_bits
+        self.max_count = (1 << counter_bits) - 1
+        self.counters = bytearray(ceil(self.num_bits / self.per_byte))
+
+    def __str__(self):
+        return BloomFilter.__str__(self)[:-1] +\
+                ', counters=(bits=%d, malloc=%.2fMB, saturated=%d))'\
+                %(self.counter_bits,
+                  len(self.counters)/(1024**2),
+                  self.saturated())
+
+    def remove(self, key, hashes=[], hash64=None):
+        '''Remove key previously inserted with the same `hashes`.
+            Removing a key that was never inserted corrupts the filter.
+        '''
+        self._helper(key, lamda=self._clear_bit,
+                     hashes=hashes,
+                     keep_going=True,
+                     hash64=hash64)
+
+    def _set_bit(self, ix):
+        self.ba[ix] = self._add(ix, 1) > 0
+        return True
+
+    def _clear_bit(self, ix):
+        self.ba[ix] = self._add(ix, -1) > 0
+        return True
+
+    def _add(self, ix, delta):
+        '''Add `delta` to counter `ix` unless saturated, return new count.
+        '''
+        byte_ix, shift = divmod(ix, self.per_byte)
+        shift *= self.counter_bits
+        count = (self.counters[byte_ix] >> shift) & self.max_count
+        if count == self.max_count: return count
+        count = min(max(count + delta, 0), self.max_count)
+        self.counters[byte_ix] = (self.counters[byte_ix] & ~(self.max_count << shift))\
+                                    | (count << shift)
+        return count
+
+    def insert_many(self, keys, hashes=[]):
+        self._add_many(keys, hashes, 1)
+
+    def remove_many(self, keys, hashes=[]):
+        '''Vectorized remove(), see insert_many() for `keys`.
+        '''
+        self._add_many(keys, hashes, -1)
+
+    def _add_many(self, keys, hashes, sign):
+        hashes = list(hashes)
+        keys = np.asarray(keys, dtype=np.uint64)
+        if not hashes or len(keys) == 0: return
+        ixs = self._probe_many(keys, hashes)
+        if self.instrument:
+            BloomFilter._register.ncalls += ixs.size # count iterations
+        ixs, deltas = np.unique(ixs, return_counts=True)
+
+        counters = np.frombuffer(self.counters, dtype=np.uint8)
+        byte_ix = ixs // np.uint64(self.per_byte)
+        shifts = ((ixs % np.uint64(self.per_byte)) * np.uint64(self.counter_bits)).astype(np.uint8)
+        counts = ((counters[byte_ix] >> shifts) & self.max_count).astype(np.int64)
+        new = np.clip(counts + sign * deltas, 0, self.max_count)
+        new[counts == self.max_count] = self.max_count # saturated
+        # several counters may share a byte: clear, then set each in place
+        masks = (np.uint8(self.max_count) << shifts).astype(np.uint8)
+        np.bitwise_and.at(counters, byte_ix, ~masks)
+        np.bitwise_or.at(counters, byte_ix, (new.astype(np.uint8) << shifts).astype(np.uint8))
+
+        bit_ix, bit_masks = self._locate_many(ixs)
+        buf = self._buffer()
+        np.bitwise_or.at(buf, bit_ix[new > 0], bit_masks[new > 0])
+        np.bitwise_and.at(buf, bit_ix[new == 0], ~bit_masks[new == 0])
+
+    def saturated(self):
+        '''Return count of saturated (stuck) counters.
+        '''
+        counters = np.frombuffer(self.counters, dtype=np.uint8)
+        return int(sum(np.count_nonzero(((counters >> shift) & self.max_count) == self.max_count)
+                       for shift in range(0, 8, self.counter_bits)))
+
+class PartitionedBloomFilter:
+    '''Bloom filter split into independently sized sub-filters, one per
+        group of prefix lengths (e.g. one level of the bin search tree).
+        Probes are routed by the prefix length encoded in the high bits of
+        each key (see utils.encode_ip_prefix_pair), so it can stand in for
+        a BloomFilter wherever keys are encoded prefixes.
+
+        filters (list): BloomFilter per group, all with the same k, width and
+            hash_func
+        groups (dict): prefix length -> index into `filters`
+        shift (int): bits below the prefix length in a key (utils.ENCODING)
+    '''
+    _register = BloomFilter._register # count iterations with the sub-filters
+
+    def __init__(self, filters, groups, shift):
+        assert len(set((bf.k, bf.width, bf.hash_func) for bf in filters)) == 1
+        self.filters = filters
+        self.groups = groups
+        self.shift = shift
+        self.k = filters[0].k
+        self.width = filters[0].width
+        self.instrument = filters[0].instrument
+
+    def __str__(self):
+        lens = [sorted(pref_len for pref_len, ix in self.groups.items() if ix == i)
+                for i in range(len(self.filters))]
+        return 'PartitionedBloomFilter(malloc=%.2fMB, filters=[\n%s])'\
+                %(self.num_bytes()/(1024**2),
+                  ',\n'.join('  %s: %s' %(pref_lens, bf) for pref_lens, bf in zip(lens, self.filters)))
+
+    def num_bytes(self):
+        '''Return total size of the bit arrays in bytes.
+        '''
+        return sum(ceil(bf.num_bits/8) for bf in self.filters)
+
+    def hash_key(self, key):
+        return self.filters[0].hash_key(key)
+
+    def insert(self, key, hashes=[], hash64=None):
+        self.filters[self.groups[key >> self.shift]].insert(key, hashes=hashes, hash64=hash64)
+
+    def contains(self, key, hashes=[], keep_going=False, hash64=None):
+        '''Same as BloomFilter.contains(); 0 for prefix lengths outside
+            of all groups, since no key of that length was ever inserted.
+        '''
+        group = self.groups.get(key >> self.shift)
+        if group is None: return 0
+        return self.filters[group].contains(key, hashes=hashes, keep_going=keep_going,
+                                            hash64=hash64)
+
 if __name__ == "__main__":
     bf = BloomFilter(1e-5, int(1e6), k=10)
     print(bf)
@@ -113,3 +442,64 @@ if __name__ == "__main__":
     bf = BloomFilter(1e-5, int(1e6))
     bf.insert(10, hashes=[7]) # encode start=5, pattern=4
     print(bf.contains(10, hashes=[5,6,7,8,9], keep_going=True)) # => 4
+
+    print('\n---\n')
+    # batch API agrees with the scalar path, including the pattern decode
+    keys = np.arange(0, 1<<40, 1<<28, dtype=np.uint64)
+    bf = BloomFilter(1e-5, len(keys))
+    bf.insert_many(keys[::2], hashes=range(bf.k))
+    bf.insert_many(keys[1::4], hashes=[0, 3, 4])
+    for hashes, keep_going in [(range(bf.k), False), ([0], False), (range(1, 6), True)]:
+        print(list(bf.contains_many(keys, hashes, keep_going)) ==
+              [bf.contains(int(key), hashes, keep_going) for key in keys]) # => True
+
+    # fixed-width hashing of 17-byte (IPv6) keys
+    keys = [(64<<128) + (i<<80) for i in range(1000)]
+    bf = BloomFilter(1e-5, len(keys), width=17)
+    bf.insert_many(to_words(keys[::2], 17), hashes=range(bf.k))
+    print(list(bf.contains_many(to_words(keys, 17), range(bf.k))) ==
+          [bf.contains(key, range(bf.k)) for key in keys]) # => True
+
+    # every hash family agrees between the scalar and batch paths
+    for hash_func in HASH_FUNCS:
+        bf = BloomFilter(1e-5, len(keys), width=17, hash_func=hash_func)
+        bf.insert_many(to_words(keys[::2], 17), hashes=range(bf.k))
+        print(hash_func, list(bf.contains_many(to_words(keys, 17), range(bf.k))) ==
+              [bf.contains(key, range(bf.k)) for key in keys]) # => True
+
+    print('\n---\n')
+    bf = BlockedBloomFilter(1e-5, int(1e6), width=8)
+    print(bf)
+    bf.insert(10, hashes=[7]) # encode start=5, pattern=4
+    print(bf.contains(10, hashes=[5,6,7,8,9], keep_going=True)) # => 4
+    keys = np.arange(0, 1<<40, 1<<28, dtype=np.uint64)
+    bf.insert_many(keys[::2], hashes=range(bf.k))
+    print(list(bf.contains_many(keys, range(bf.k))) ==
+          [bf.contains(int(key), range(bf.k)) for key in keys]) # => True
+
+    print('\n---\n')
+    bf = CountingBloomFilter(1e-5, len(keys), width=8)
+    bf.insert(10, hashes=[7]) # encode start=5, pattern=4
+    bf.insert(10, hashes=[7])
+    bf.remove(10, hashes=[7])
+    print(bf.contains(10, hashes=[5,6,7,8,9], keep_going=True)) # => 4
+    bf.remove(10, hashes=[7])
+    print(bf.contains(10, hashes=[5,6,7,8,9], keep_going=True)) # => 0
+
+    bf.insert_many(keys, hashes=range(bf.k))
+    for key in keys[1::2]:
+        bf.remove(int(key), hashes=range(bf.k))
+    print(bf)
+    print(all(bf.contains_many(keys[::2], range(bf.k)))) # => True
+    bf.remove_many(keys[::2], hashes=range(bf.k))
+    print(bf.ba.count()) # => 0
+
+    print('\n---\n')
+    # one small filter for /8 keys, a larger one for /24 keys
+    bf = PartitionedBloomFilter([BloomFilter(1e-3, 10, k=7, num_bits=100),
+                                 BloomFilter(1e-3, 1000, k=7, num_bits=10000)],
+                                {8: 0, 24: 1}, 32)
+    bf.insert((8<<32) + (10<<24), hashes=range(bf.k))
+    print(bf.contains((8<<32) + (10<<24), hashes=range(bf.k))) # => 127
+    print(bf.contains((24<<32) + (10<<24), hashes=range(bf.k))) # => 0
+    print(bf)
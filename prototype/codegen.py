@@ -0,0 +1,182 @@
+'''codegen.py
+
+Guided lookup unrolled for one built filter and bin search tree.
+lookup_source() writes Python source for a lookup function with the whole
+_guided_lookup_helper() control flow spelled out: one nested if/else per
+tree node, constant netmasks and key prefixes, the filter's bit tests
+inlined, and the BMP decode and verification over constant ranges of hash
+funcs at every leaf. compile_lookup() compiles it:
+
+    lookup = compile_lookup(bf, bst, fib, maxx, minn, ix2len, protocol='v4')
+    preflen, fib_val, false_positives = lookup(ip)
+
+The function returns exactly what ipfilter._guided_lookup_helper() returns.
+It is specialized to the tree and to the geometry of `bf` (bit array,
+k, hash func, next hops if encoded), so recompile after rebuilding either; inserts into the
+same bit array are seen. Hash funcs and FIB lookups are counted as usual
+(unless `bf` is uninstrumented), as are rejected BMP pointers and next
+hops (ipfilter._bmp_rejected.ncalls, _hop_rejected.ncalls); the inlined
+bit tests are not (BloomFilter._register.ncalls).
+'''
+import sys
+from mconf import *
+for d in [DATADIR]:
+    sys.path.append(d)
+
+from bloomfilter import BloomFilter, BlockedBloomFilter, BLOCK_BITS
+import ipfilter
+from ipfilter import NUMBITS, KEY_SHIFT
+from profiler import instrumented
+
+LOW = 0x00000000FFFFFFFF
+HIGH = 0xFFFFFFFF00000000
+
+def _probes(bf, h):
+    '''Returns code for the bit tests of hash func i of the key hashed to
+        variable `h`, as in bf._positions(): statements to run first, and a
+        function of i returning the test expression.
+    '''
+    if isinstance(bf, BlockedBloomFilter):
+        setup = ['a = (%s & %#x) %% %d * %d' %(h, LOW, bf.num_blocks, BLOCK_BITS),
+                 'b = (%s >> 32) & 0xFFFF' %h,
+                 'c = (%s >> 48) | 1' %h]
+        return setup, lambda i: 'ba[a + (b + %d*c) %% %d]' %(i, BLOCK_BITS)
+    setup = ['a = %s & %#x' %(h, LOW),
+             'b = %s >> 32' %h if bf._split_high else 'b = %s & %#x' %(h, HIGH)]
+    return setup, lambda i: 'ba[(a + %d*b) %% %d]' %(i, bf.num_bits) if i else\
+                            'ba[a %% %d]' %bf.num_bits
+
+def _emit_node(lines, bf, plan, node, depth, probed, hit, protocol):
+    '''Append the code for the subtree at `node` (-1 if none): probe it and
+        branch on its first hash func, or past a leaf, decode the BMP.
+        `probed` lists the prefix lengths probed so far, `hit` is the
+        (prefix length, count of hits) of the last hit, or (None, 0) if none
+        (a node of prefix length 0 can be hit too).
+    '''
+    pad = '    ' * depth
+    if node < 0:
+        _emit_leaf(lines, bf, depth, probed, hit, protocol)
+        return
+    val = plan.vals[node]
+    lines.append(pad + 'k%d = %#x + (ip & %#x)' %(val, val << KEY_SHIFT[protocol], plan.masks[node]))
+    lines.append(pad + 'h%d = hash_(k%d, width)' %(val, val))
+    setup, probe = _probes(bf, 'h%d' %val)
+    lines.extend(pad + line for line in setup)
+    lines.append(pad + 'if %s:' %probe(0)) # guided by first hash function
+    _emit_node(lines, bf, plan, plan.rights[node], depth+1, probed + [val],
+               (val, hit[1]+1), protocol)
+    lines.append(pad + 'else:')
+    _emit_node(lines, bf, plan, plan.lefts[node], depth+1, probed + [val], hit, protocol)
+
+def _emit_leaf(lines, bf, depth, probed, hit, protocol):
+    '''Append the code that decodes the BMP pointer at the last hit and
+        verifies it, else defaults to linear search.
+    '''
+    pad = '    ' * depth
+    val, count_hit = hit
+    if val is None:
+        lines.append(pad + 'return ix2len[0], None, 0') # default route
+        return
+    bits, check, width = ipfilter._bmp_layout(bf, protocol)
+    start, end = count_hit, count_hit + bits + width
+    lines.append(pad + 'hashed = {%s}' %', '.join('%d: h%d' %(p, p) for p in probed))
+    setup, probe = _probes(bf, 'h%d' %val)
+    lines.extend(pad + line for line in setup)
+    lines.append(pad + 'bmp_ix = ' + ' | '.join('%s << %d' %(probe(i), i - start) if i > start
+                                                else probe(i) for i in range(start, end)))
+    if check is not None: # a pointer whose check bits do not match: verify the hit itself
+        lines.append(pad + 'bmp_ix = decode_bmp(bmp_ix, %d, %r, %d)' %(bits, check, width))
+        lines.append(pad + 'if bmp_ix is None:')
+        if bf.instrument:
+            lines.append(pad + '    rejected()')
+        lines.append(pad + '    bmp_ix = %d' %((1<<bits) - 1))
+    lines.append(pad + 'if bmp_ix < num_lens:')
+    lines.append(pad + '    hyp = ix2len[bmp_ix] # BMP hypothesis')
+    lines.append(pad + '    key = (hyp << %d) + (ip & masks[hyp])' %KEY_SHIFT[protocol])
+    lines.append(pad + '    if hyp not in hashed:')
+    lines.append(pad + '        hashed[hyp] = hash_(key, width)')
+    lines.append(pad + '    h = hashed[hyp]')
+    lines.append(pad + 'else:')
+    lines.append(pad + '    hyp, key, h = %d, k%d, h%d' %(val, val, val))
+    if getattr(bf, 'hops', None) is not None: # all k hash funcs, the FIB, then the next hop
+        lines.append(pad + 'if bmp_ix == %d or hyp < %d:' %((1<<bits) - 1, val))
+        setup, probe = _probes(bf, 'h')
+        lines.extend(pad + '    ' + line for line in setup)
+        lines.append(pad + '    if %s and key in fib:' %' and '.join(probe(i) for i in range(bf.k)))
+        lines.append(pad + '        fib_val = fib[key]')
+        if bf.instrument:
+            lines.append(pad + '        hop = ' + ' | '.join('%s << %d' %(probe(bf.k + i), i) if i
+                                                             else probe(bf.k)
+                                                             for i in range(bf.hop_bits)))
+            lines.append(pad + '        if hop < num_hops and hops[hop] != fib_val:')
+            lines.append(pad + '            hop_rejected()')
+        lines.append(pad + '        return hyp, fib_val, 0')
+    elif end < bf.k:
+        lines.append(pad + 'if bmp_ix == %d or hyp < %d:' %((1<<bits) - 1, val))
+        setup, probe = _probes(bf, 'h')
+        lines.extend(pad + '    ' + line for line in setup)
+        lines.append(pad + '    if %s and key in fib:' %' and '.join(probe(i) for i in range(end, bf.k)))
+        lines.append(pad + '        return hyp, fib[key], 0')
+    else: # no hash funcs are left to verify with, only the FIB
+        lines.append(pad + 'if (bmp_ix == %d or hyp < %d) and key in fib:' %((1<<bits) - 1, val))
+        lines.append(pad + '    return hyp, fib[key], 0')
+    lines.append(pad + 'preflen, fib_val, fp = linear(bf, ip, %d, minn, fib, protocol, hashed)' %(val-1))
+    lines.append(pad + 'return preflen, fib_val, fp + 1')
+
+def lookup_source(bf, root, ix2len, protocol='v4'):
+    '''Returns the source of `lookup(ip)`, the guided lookup in `bf` along
+        bin search tree `root` (obst.Node or ipfilter.SearchPlan) unrolled.
+    '''
+    if not isinstance(bf, BloomFilter):
+        raise ValueError('unrolled lookup needs a single bit array backend, not %s'
+                         %type(bf).__name__)
+    plan = ipfilter._as_plan(root, protocol)
+    lines = ['def lookup(ip):']
+    _emit_node(lines, bf, plan, 0 if plan.vals else -1, 1, [], (None, 0), protocol)
+    return '\n'.join(lines) + '\n'
+
+def compile_lookup(bf, root, fib, maxx, minn, ix2len, protocol='v4'):
+    '''Returns lookup(ip) compiled from lookup_source(), with the source
+        in its `source` attribute.
+    '''
+    source = lookup_source(bf, root, ix2len, protocol)
+    max_shift = NUMBITS[protocol]
+    namespace = {'bf': bf, 'ba': bf.ba, 'hash_': bf._hash, 'width': bf.width,
+                 'fib': fib, 'minn': minn, 'ix2len': ix2len, 'num_lens': len(ix2len),
+                 'masks': [((1<<max_shift) - 1) << (max_shift-preflen) & ((1<<max_shift) - 1)
+                           for preflen in range(max_shift+1)],
+                 'hops': getattr(bf, 'hops', None), 'num_hops': len(getattr(bf, 'hops', [])),
+                 'linear': instrumented(ipfilter._default_to_linear_search, bf.instrument),
+                 'decode_bmp': ipfilter._bmp_decode, 'rejected': ipfilter._bmp_rejected,
+                 'hop_rejected': ipfilter._hop_rejected,
+                 'protocol': protocol}
+    exec(compile(source, '<lookup %s>' %protocol, 'exec'), namespace)
+    lookup = namespace['lookup']
+    lookup.source = source
+    return lookup
+
+if __name__ == "__main__":
+    from utils import compile_fib_table, load_traffic, load_prefixes, prefix_stats
+    from obst import weigh_equally
+
+    for protocol, backend in [('v4', BloomFilter), ('v4', BlockedBloomFilter), ('v6', BloomFilter)]:
+        fib = compile_fib_table(protocol=protocol)
+        pref_stats = prefix_stats(load_prefixes(protocol))
+        bf, bst = ipfilter.build_bloom_filter(protocol=protocol, lamda=weigh_equally, fpp=None,
+                                              k=10 if protocol == 'v4' else 14, num_bits=100000,
+                                              fib=fib, pref_stats=pref_stats, backend=backend)
+        args = (fib, pref_stats['maxx'], pref_stats['minn'], pref_stats['ix2len'], protocol)
+        lookup = compile_lookup(bf, bst, *args)
+        print(all(lookup(ip) == ipfilter._guided_lookup_helper(bf, bst, ip, *args)
+                  for ip in load_traffic(protocol))) # => True
+
+    # with next hops encoded in the filter (here, each route's own CIDR string)
+    fib = compile_fib_table(protocol='v4')
+    pref_stats = prefix_stats(load_prefixes('v4'))
+    bf, bst = ipfilter.build_bloom_filter(protocol='v4', lamda=weigh_equally, fpp=None, k=10,
+                                          num_bits=100000, fib=fib, pref_stats=pref_stats,
+                                          next_hops=dict(fib.items()))
+    args = (fib, pref_stats['maxx'], pref_stats['minn'], pref_stats['ix2len'], 'v4')
+    lookup = compile_lookup(bf, bst, *args)
+    print(all(lookup(ip) == ipfilter._guided_lookup_helper(bf, bst, ip, *args)
+              for ip in load_traffic('v4'))) # => True
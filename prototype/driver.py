@@ -45,10 +45,22 @@ from mconf import *
 for d in [DATADIR]:
     sys.path.append(d)
 
-from utils import compile_fib_table, load_traffic, load_prefixes, prefix_stats
+from utils import compile_fib_table, load_traffic, load_prefixes, prefix_stats,\
+                    encode_ip_prefix_pair, KEY_WIDTH, iter_traffic, CompactFIB, FIB,\
+                    load_next_hops
 import ipfilter
+from engine import LookupEngine
+from codegen import compile_lookup
+from bloomfilter import BloomFilter, BlockedBloomFilter, CountingBloomFilter
 from obst import *
-from fnv import hash_fnv
+from fnv import hash_fnv, hash_fnv_many, to_words
+from hashfuncs import HASH_FUNCS
+from profiler import LatencyRecorder
+from time import perf_counter, perf_counter_ns
+from tracemalloc import start as trace_start, stop as trace_stop, get_traced_memory
+import numpy as np
+from multiprocessing import cpu_count
+from random import randint, choice, choices, sample, getrandbits
 from plot import plot_vbar, plot_scatter
 
 THROTTLE = 100000 # test with representative but limited amount of traffic
@@ -64,6 +76,8 @@ BITARR_SIZE=86192144
 FPP = 1e-3
 # FPP = 1e-4
 
+NUM_LINKS = 16 # outgoing links to spread routes over if the tables hold no next hops
+
 def _common_prep(protocol='v4', traffic_pattern=RANDOM_TRAFFIC):
     fib = compile_fib_table(protocol=protocol)
     traffic = load_traffic(protocol=protocol, typ=traffic_pattern)
@@ -227,7 +241,7 @@ def test_bitarray_size(fib, traffic, pref_stats):
                 bf_linear, _ = ipfilter.build_bloom_filter(
                     protocol=protocol, lamda=None, fpp=None, k=K,
                     num_bits=bitarray_size, fib=fib)
-                res[typ]['percent_full'].append(100*bf_linear.ba.count()/bf_linear.ba.length())
+                res[typ]['percent_full'].append(100*bf_linear.ba.count()/len(bf_linear.ba))
                 res[typ]['bf'].append(str(bf_linear))
                 print(bf_linear)
 
@@ -253,7 +267,7 @@ def test_bitarray_size(fib, traffic, pref_stats):
                 bf_guided, bst = ipfilter.build_bloom_filter(
                     protocol=protocol, lamda=weigh_equally, fpp=None, k=K,
                     num_bits=bitarray_size, fib=fib)
-                res[typ]['percent_full'].append(100*bf_guided.ba.count()/bf_guided.ba.length())
+                res[typ]['percent_full'].append(100*bf_guided.ba.count()/len(bf_guided.ba))
                 res[typ]['bf'].append(str(bf_guided))
                 print(bf_guided)
 
@@ -417,9 +431,997 @@ def test_num_hash_funcs(fib, traffic, pref_stats):
 
     print('\n\nAll done!')
 
+def test_hash_throughput(protocol='v4', num_keys=THROTTLE):
+    '''Hashes per second over encoded prefixes: legacy getsizeof()-wide
+        FNV vs fixed-width FNV (scalar and NumPy batch).
+    '''
+    print('\n\ntest_hash_throughput()\n\n')
+    width = KEY_WIDTH[protocol]
+    keys = [encode_ip_prefix_pair(*pair, protocol)
+            for pair in load_prefixes(protocol=protocol)[:num_keys]]
+    words = to_words(keys, width)
+
+    runs = [('legacy', lambda: [hash_fnv(key) for key in keys]),
+            ('fixed', lambda: [hash_fnv(key, width) for key in keys]),
+            ('fixed batch', lambda: hash_fnv_many(words, width))]
+    rates = []
+    for label, run in runs:
+        start = perf_counter()
+        run()
+        rates.append(len(keys)/(perf_counter() - start))
+        print('%s: %.0f hashes/s' %(label, rates[-1]))
+
+    # record experiment to file in EXPERIMENTS: header, plot title, xaxis, yaxis, xs, ys, misc info
+    with open(os.path.join(EXPERIMENTS,
+                           'hashThroughput_'+protocol+'.txt'),
+              'w') as out:
+        lines = ["test_hash_throughput(): legacy vs fixed-width FNV over encoded prefixes,xs=[hash_fnv(key), hash_fnv(key, width), hash_fnv_many(words, width)], yaxis=hashes/s"] # header
+        lines.append('FNV hashing throughput') # plot title
+        lines.append('Hash variant') # xaxis title
+        lines.append('Hashes per second') # yaxis title
+        lines.append(', '.join(label for label, _ in runs)) # xs
+        lines.append(', '.join('%.0f' %rate for rate in rates)) # ys
+        lines.append('%d keys, width=%d bytes, speedup fixed=%.1fx, batch=%.1fx'
+                     %(len(keys), width, rates[1]/rates[0], rates[2]/rates[0])) # any extra info
+        out.write('\n'.join(lines))
+
+def test_hash_funcs(fib, pref_stats, protocol='v4', num_keys=THROTTLE):
+    '''Nanoseconds per key (scalar and NumPy batch) and measured false
+        positive rate of a linear Bloom filter sized for FPP, for each hash
+        family in hashfuncs.HASH_FUNCS. Picks the fastest (batch) family
+        whose measured rate is within sampling error of FPP.
+    '''
+    print('\n\ntest_hash_funcs()\n\n')
+    width = KEY_WIDTH[protocol]
+    keys = [encode_ip_prefix_pair(*pair, protocol)
+            for pair in pref_stats['prefixes'][:num_keys]]
+    words = to_words(keys, width)
+    tolerance = FPP + 3*(FPP/num_keys)**0.5 # 3 std devs of the measured rate
+
+    res = [] # (hash family, scalar ns/key, batch ns/key, measured fpp)
+    for name, (scalar, batch, _) in HASH_FUNCS.items():
+        start = perf_counter()
+        for key in keys: scalar(key, width)
+        ns_scalar = (perf_counter() - start)/len(keys)*1e9
+        start = perf_counter()
+        batch(words, width)
+        ns_batch = (perf_counter() - start)/len(keys)*1e9
+
+        bf, _ = ipfilter.build_bloom_filter(protocol=protocol, fpp=FPP, fib=fib,
+                                            pref_stats=pref_stats, hash_func=name)
+        fpp = _measure_fpp(bf, fib, pref_stats, protocol, num_keys)
+        res.append((name, ns_scalar, ns_batch, fpp))
+        print('%s: %.0f ns/key, batch %.1f ns/key, fpp %.2e' %res[-1])
+    fit = [row for row in res if row[3] <= tolerance]
+    best = min(fit, key=lambda row: row[2])[0] if fit else None
+    print('fastest hash within target FPP: %s' %best)
+
+    # record experiment to file in EXPERIMENTS: header, plot title, xaxis, yaxis, xs, ys, misc info
+    with open(os.path.join(EXPERIMENTS,
+                           'hashFuncs_'+protocol+'.txt'),
+              'w') as out:
+        lines = ["test_hash_funcs(): hash families for a linear BF sized for FPP,xs=[scalar ns/key, batch ns/key, measured fpp], yaxis=per key"] # header
+        lines.append('Hash family throughput and false positive rate') # plot title
+        lines.append('Hash family') # xaxis title
+        lines.append('ns/key, fpp') # yaxis title
+        lines.append(';'.join(row[0] for row in res)) # xs
+        lines.append(';'.join('(%.1f, %.2f, %.2e)' %row[1:] for row in res)) # ys
+        lines.append('FPP=%.0e, %d keys, width=%d bytes, fastest within FPP: %s'
+                     %(FPP, len(keys), width, best)) # any extra info
+        out.write('\n'.join(lines))
+
+def _lines_touched(bf):
+    '''Count of cache lines touched so far: one per key for a blocked
+        filter, else (practically) one per probed bit.
+    '''
+    if isinstance(bf, BlockedBloomFilter):
+        return bf._register_line.ncalls
+    return bf._register.ncalls
+
+def _measure_fpp(bf, fib, pref_stats, protocol, num_keys=THROTTLE):
+    '''Fraction of random (prefix, length) keys absent from `fib` that
+        pass all k hash funcs of `bf`.
+    '''
+    max_shift = ipfilter.NUMBITS[protocol]
+    pref_lens = [pref_len for pref_len in pref_stats['ix2len'] if pref_len > 0]
+    hashes = ipfilter._choose_hash_funcs(0, end=bf.k)
+    false_positives = tested = 0
+    while tested < num_keys:
+        pref_len = choice(pref_lens)
+        mask = ((1<<max_shift) - 1) << (max_shift-pref_len)
+        key = encode_ip_prefix_pair(randint(0, (1<<max_shift) - 1) & mask, pref_len, protocol)
+        if key in fib.keys(): continue
+        tested += 1
+        if bf.contains(key, hashes=hashes): false_positives += 1
+    return false_positives/tested
+
+def test_blocked_bloom(fib, traffic, pref_stats, protocol='v4'):
+    '''Trade-off between false positive rate and cache lines touched:
+        BloomFilter vs BlockedBloomFilter at the same bitarray size and k.
+    '''
+    print('\n\ntest_blocked_bloom()\n\n')
+    throttle = min(THROTTLE, len(traffic))
+    res = [] # (backend, search, fpp, bit lookups, lines, FIB lookups, defaults) per IP
+    for backend in [BloomFilter, BlockedBloomFilter]:
+        for typ, lamda in [('linear', None), ('guided', weigh_equally)]:
+            bf, bst = ipfilter.build_bloom_filter(
+                protocol=protocol, lamda=lamda, fpp=None, k=K,
+                num_bits=BITARR_SIZE, fib=fib, backend=backend)
+            print(bf)
+
+            # record starting ncalls for each function of interest
+            ncontains = bf._register.ncalls
+            nlines = _lines_touched(bf)
+            nfib = fib.__contains__.ncalls
+            ndefault = ipfilter._default_to_linear_search.ncalls
+
+            # perform the lookup
+            _lookup_wrapper(bf, traffic, fib, pref_stats, protocol, bst=bst, typ=typ)
+
+            # record the ending ncalls for each function of interest
+            ncontains = (bf._register.ncalls - ncontains)/throttle
+            nlines = (_lines_touched(bf) - nlines)/throttle
+            nfib = (fib.__contains__.ncalls - nfib)/throttle
+            ndefault = (ipfilter._default_to_linear_search.ncalls - ndefault)/throttle
+
+            fpp = _measure_fpp(bf, fib, pref_stats, protocol)
+            res.append((backend.__name__, typ, fpp, ncontains, nlines, nfib, ndefault))
+
+    # record experiment to file in EXPERIMENTS: header, plot title, xaxis, yaxis, xs, ys, misc info
+    with open(os.path.join(EXPERIMENTS,
+                           'blocked_'+protocol+'_random.txt'),
+              'w') as out:
+        lines = ["test_blocked_bloom(): plain vs cache-line-blocked BF, same bitarray size and k,xs=[measured fpp, bf._register(), cache lines, fib.__contains__(), ipfilter._default_to_linear_search], yaxis=ncalls"] # header
+        lines.append('Blocked vs plain Bloom filter: stats per packet') # plot title
+        lines.append('Backend/search') # xaxis title
+        lines.append('Count of invocations') # yaxis title
+        lines.append(';'.join('%s/%s' %row[:2] for row in res)) # xs
+        lines.append(';'.join('(%.2e, %.2f, %.2f, %.2f, %.2f)' %row[2:] for row in res)) # ys
+        lines.append('K=%d, BITARR_SIZE=%d' %(K, BITARR_SIZE)) # any extra info
+        out.write('\n'.join(lines))
+
+    print('\n\nAll done!')
+
+def test_counting_bloom(fib, traffic, pref_stats, protocol='v4', withdrawn=0.01):
+    '''Memory vs counter width for a guided counting Bloom filter, and cost
+        of withdrawing a `withdrawn` fraction of routes vs a full rebuild.
+    '''
+    print('\n\ntest_counting_bloom()\n\n')
+    throttle = min(THROTTLE, len(traffic))
+    routes = sample(pref_stats['prefixes'], max(1, int(withdrawn*len(pref_stats['prefixes']))))
+    res = [] # (counter bits, bitarray MB, counters MB, saturated, withdraw s/route, FIB lookups/IP)
+    for counter_bits in [2, 4, 8]:
+        backend = lambda *args, **kwargs: CountingBloomFilter(*args, counter_bits=counter_bits, **kwargs)
+        start = perf_counter()
+        bf, bst = ipfilter.build_bloom_filter(
+            protocol=protocol, lamda=weigh_equally, fpp=None, k=K,
+            num_bits=BITARR_SIZE, fib=fib, backend=backend)
+        build = perf_counter() - start
+        print(bf)
+
+        fib_copy = compile_fib_table(protocol=protocol)
+        start = perf_counter()
+        for prefix, preflen in routes:
+            ipfilter.withdraw_prefix(bf, prefix, preflen, root=bst, fib=fib_copy, protocol=protocol)
+        withdraw = (perf_counter() - start)/len(routes)
+
+        nfib = fib_copy.__contains__.ncalls
+        _lookup_wrapper(bf, traffic, fib_copy, pref_stats, protocol, bst=bst, typ='guided')
+        nfib = (fib_copy.__contains__.ncalls - nfib)/throttle
+
+        res.append((counter_bits, bf.num_bits/8/(1024**2), len(bf.counters)/(1024**2),
+                    bf.saturated(), withdraw, nfib))
+        print('build: %.2fs, withdraw: %.2es per route' %(build, withdraw))
+
+    # record experiment to file in EXPERIMENTS: header, plot title, xaxis, yaxis, xs, ys, misc info
+    with open(os.path.join(EXPERIMENTS,
+                           'counting_'+protocol+'_random.txt'),
+              'w') as out:
+        lines = ["test_counting_bloom(): guided counting BF by counter width,xs=[counter bits], ys=[bitarray MB, counters MB, saturated counters, seconds per withdrawal, fib.__contains__() per IP after withdrawals]"] # header
+        lines.append('Counting Bloom filter: memory vs counter width') # plot title
+        lines.append('Counter bits') # xaxis title
+        lines.append('MB, count, seconds') # yaxis title
+        lines.append(';'.join(str(row[0]) for row in res)) # xs
+        lines.append(';'.join('(%.2f, %.2f, %d, %.2e, %.2f)' %row[1:] for row in res)) # ys
+        lines.append('K=%d, BITARR_SIZE=%d, withdrew %d routes, last full build took %.2fs'
+                     %(K, BITARR_SIZE, len(routes), build)) # any extra info
+        out.write('\n'.join(lines))
+
+    print('\n\nAll done!')
+
+def test_partitioned_bloom(fib, traffic, pref_stats, protocol='v4', bits_per_prefix=[4, 8, 16]):
+    '''Total bytes vs probes per IP: single guided Bloom filter vs one
+        sub-filter per BST level or per prefix length, same total bit count,
+        at each of `bits_per_prefix`. Sub-filters are sized on a slice of
+        the traffic disjoint from the one measured.
+    '''
+    print('\n\ntest_partitioned_bloom()\n\n')
+    throttle = min(THROTTLE, len(traffic)//2)
+    measured, sizing = traffic[:throttle], traffic[throttle:2*throttle]
+    res = [] # (layout, bytes, bit lookups, FIB lookups, defaults) per IP
+    for bits in bits_per_prefix:
+        for partition in [None, 'level', 'length']:
+            bf, bst = ipfilter.build_bloom_filter(
+                protocol=protocol, lamda=weigh_equally, fpp=None, k=K,
+                num_bits=bits*len(pref_stats['prefixes']), fib=fib, partition=partition,
+                traffic=sizing)
+            print(bf)
+            num_bytes = bf.num_bytes() if partition else bf.num_bits/8
+
+            # record starting ncalls for each function of interest
+            ncontains = bf._register.ncalls
+            nfib = fib.__contains__.ncalls
+            ndefault = ipfilter._default_to_linear_search.ncalls
+
+            # perform the lookup
+            _lookup_wrapper(bf, measured, fib, pref_stats, protocol, bst=bst, typ='guided')
+
+            # record the ending ncalls for each function of interest
+            ncontains = (bf._register.ncalls - ncontains)/throttle
+            nfib = (fib.__contains__.ncalls - nfib)/throttle
+            ndefault = (ipfilter._default_to_linear_search.ncalls - ndefault)/throttle
+            res.append(('%s@%d' %(partition or 'single', bits), num_bytes, ncontains, nfib,
+                        ndefault))
+            print('%s: %d bytes, %.2f probes/IP' %res[-1][:3])
+
+    # record experiment to file in EXPERIMENTS: header, plot title, xaxis, yaxis, xs, ys, misc info
+    with open(os.path.join(EXPERIMENTS,
+                           'partitioned_'+protocol+'_random.txt'),
+              'w') as out:
+        lines = ["test_partitioned_bloom(): single vs per-level vs per-length guided BF,xs=[layout@bits per prefix], ys=[total bytes, bf._register(), fib.__contains__(), ipfilter._default_to_linear_search]"] # header
+        lines.append('Partitioned Bloom filter: bytes vs stats per packet') # plot title
+        lines.append('Layout@bits per prefix') # xaxis title
+        lines.append('Bytes, count of invocations') # yaxis title
+        lines.append(';'.join(row[0] for row in res)) # xs
+        lines.append(';'.join('(%d, %.2f, %.2f, %.2f)' %row[1:] for row in res)) # ys
+        lines.append('K=%d, sized on %d IPs, measured on %d others' %(K, len(sizing), throttle)) # any extra info
+        out.write('\n'.join(lines))
+
+    print('\n\nAll done!')
+
+def test_parallel_build(fib, protocol='v4'):
+    '''Guided Bloom filter build time vs number of worker processes,
+        checking that every parallel build equals the serial one (`workers`
+        None, built first and kept as the reference).
+    '''
+    print('\n\ntest_parallel_build()\n\n')
+    counts = [None] + [n for n in [1, 2, 4, 8, 16, 32] if n <= max(2, cpu_count())]
+    res = [] # (workers, seconds, same bit array as the serial build)
+    reference = None
+    for workers in counts:
+        start = perf_counter()
+        bf, _ = ipfilter.build_bloom_filter(
+            protocol=protocol, lamda=weigh_equally, fpp=None, k=K,
+            num_bits=BITARR_SIZE, fib=fib, workers=workers)
+        elapsed = perf_counter() - start
+        if workers is None: reference = bf
+        res.append((workers or 0, elapsed, bf.ba == reference.ba))
+        print('workers=%s: %.2fs' %(workers, elapsed))
+
+    # record experiment to file in EXPERIMENTS: header, plot title, xaxis, yaxis, xs, ys, misc info
+    with open(os.path.join(EXPERIMENTS,
+                           'parallelBuild_'+protocol+'.txt'),
+              'w') as out:
+        lines = ["test_parallel_build(): guided BF build time by worker processes (0: serial build),xs=[workers], ys=[(seconds, identical to serial build)]"] # header
+        lines.append('Parallel guided build') # plot title
+        lines.append('Worker processes') # xaxis title
+        lines.append('Seconds') # yaxis title
+        lines.append(';'.join(str(row[0]) for row in res)) # xs
+        lines.append(';'.join('(%.2f, %s)' %row[1:] for row in res)) # ys
+        lines.append('K=%d, BITARR_SIZE=%d, %d CPUs' %(K, BITARR_SIZE, cpu_count())) # any extra info
+        out.write('\n'.join(lines))
+
+    print('\n\nAll done!')
+
+def test_lookup_batch(fib, traffic, pref_stats, protocol='v4'):
+    '''Guided lookups per second: IP by IP (_guided_lookup_helper) vs
+        ipfilter.lookup_batch() over the whole traffic array, checking
+        that both return the same prefix length and FIB value per IP.
+    '''
+    print('\n\ntest_lookup_batch()\n\n')
+    traffic = traffic[:THROTTLE]
+    k = K if protocol == 'v4' else K6
+    bf, bst = ipfilter.build_bloom_filter(
+        protocol=protocol, lamda=weigh_equally, fpp=None, k=k,
+        num_bits=BITARR_SIZE, fib=fib, pref_stats=pref_stats)
+
+    start = perf_counter()
+    res = [ipfilter._guided_lookup_helper(bf, bst, ip, fib, pref_stats['maxx'], pref_stats['minn'],
+                                          pref_stats['ix2len'], protocol)[:2]
+           for ip in traffic]
+    scalar = len(traffic)/(perf_counter() - start)
+
+    ips = np.array(traffic, dtype=np.uint64) if protocol == 'v4' else traffic
+    start = perf_counter()
+    pref_lens, fib_vals = ipfilter.lookup_batch(bf, ips, fib, bst, pref_stats['maxx'],
+                                                pref_stats['minn'], pref_stats['ix2len'], protocol)
+    batch = len(traffic)/(perf_counter() - start)
+    same = res == list(zip(pref_lens.tolist(), fib_vals.tolist()))
+    print('scalar: %.0f lookups/s, batch: %.0f lookups/s, same results: %s' %(scalar, batch, same))
+
+    # record experiment to file in EXPERIMENTS: header, plot title, xaxis, yaxis, xs, ys, misc info
+    with open(os.path.join(EXPERIMENTS,
+                           'lookupBatch_'+protocol+'_random.txt'),
+              'w') as out:
+        lines = ["test_lookup_batch(): guided lookup IP by IP vs level-synchronous batch,xs=[_guided_lookup_helper, lookup_batch], yaxis=lookups/s"] # header
+        lines.append('Batch guided lookup') # plot title
+        lines.append('Lookup') # xaxis title
+        lines.append('Lookups per second') # yaxis title
+        lines.append('scalar, batch') # xs
+        lines.append('%.0f, %.0f' %(scalar, batch)) # ys
+        lines.append('K=%d, BITARR_SIZE=%d, %d IPs, speedup=%.1fx, same results: %s'
+                     %(k, BITARR_SIZE, len(traffic), batch/scalar, same)) # any extra info
+        out.write('\n'.join(lines))
+
+def test_lookup_stream(fib, pref_stats, protocol='v4', traffic_pattern=RANDOM_TRAFFIC):
+    '''Lookups per second and peak traced memory of a guided lookup over a
+        whole traffic file: loaded up front (utils.load_traffic() then
+        lookup_batch()) vs streamed in chunks (lookup_stream() over
+        utils.iter_traffic()).
+    '''
+    print('\n\ntest_lookup_stream()\n\n')
+    k = K if protocol == 'v4' else K6
+    bf, bst = ipfilter.build_bloom_filter(
+        protocol=protocol, lamda=weigh_equally, fpp=None, k=k,
+        num_bits=BITARR_SIZE, fib=fib, pref_stats=pref_stats)
+    args = (fib, bst, pref_stats['maxx'], pref_stats['minn'], pref_stats['ix2len'], protocol)
+
+    def loaded():
+        traffic = load_traffic(protocol=protocol, typ=traffic_pattern)
+        ips = np.array(traffic, dtype=np.uint64) if protocol == 'v4' else traffic
+        return len(ipfilter.lookup_batch(bf, ips, *args)[0])
+    def streamed():
+        return sum(len(ips) for ips, _, _ in
+                   ipfilter.lookup_stream(bf, iter_traffic(protocol, traffic_pattern), *args))
+
+    res = [] # (mode, lookups/s, peak MB)
+    for label, run in [('loaded', loaded), ('streamed', streamed)]:
+        start = perf_counter()
+        num_ips = run()
+        elapsed = perf_counter() - start
+        trace_start() # separate run, tracing slows down the lookup
+        run()
+        peak = get_traced_memory()[1]/(1024**2)
+        trace_stop()
+        res.append((label, num_ips/elapsed, peak))
+        print('%s: %.0f lookups/s, peak %.2fMB' %res[-1])
+
+    # record experiment to file in EXPERIMENTS: header, plot title, xaxis, yaxis, xs, ys, misc info
+    with open(os.path.join(EXPERIMENTS,
+                           'lookupStream_'+protocol+'_'+traffic_pattern),
+              'w') as out:
+        lines = ["test_lookup_stream(): guided lookup over a traffic file loaded up front vs streamed in chunks,xs=[loaded, streamed], ys=[(lookups/s, peak MB)]"] # header
+        lines.append('Streaming guided lookup') # plot title
+        lines.append('Traffic source') # xaxis title
+        lines.append('Lookups per second, peak MB') # yaxis title
+        lines.append(', '.join(row[0] for row in res)) # xs
+        lines.append(';'.join('(%.0f, %.2f)' %row[1:] for row in res)) # ys
+        lines.append('K=%d, BITARR_SIZE=%d, %d IPs, CHUNK_SIZE=%d'
+                     %(k, BITARR_SIZE, num_ips, ipfilter.CHUNK_SIZE)) # any extra info
+        out.write('\n'.join(lines))
+
+def test_lookup_engine(fib, traffic, pref_stats, protocol='v4', repeat=20):
+    '''Lookups per second of the shared-memory LookupEngine at 1..N worker
+        processes, over `traffic` repeated `repeat` times per batch, vs
+        lookup_batch() in this process, checking that results agree.
+    '''
+    print('\n\ntest_lookup_engine()\n\n')
+    k = K if protocol == 'v4' else K6
+    bf, bst = ipfilter.build_bloom_filter(
+        protocol=protocol, lamda=weigh_equally, fpp=None, k=k,
+        num_bits=BITARR_SIZE, fib=fib, pref_stats=pref_stats)
+    traffic = traffic[:THROTTLE] * repeat
+    ips = np.array(traffic, dtype=np.uint64) if protocol == 'v4' else traffic
+
+    start = perf_counter()
+    expected = ipfilter.lookup_batch(bf, ips, fib, bst, pref_stats['maxx'], pref_stats['minn'],
+                                     pref_stats['ix2len'], protocol)
+    res = [(0, len(ips)/(perf_counter() - start), True)] # (workers, lookups/s, same results)
+    print('in process: %.0f lookups/s' %res[-1][1])
+    for workers in [n for n in [1, 2, 4, 8, 16, 32] if n <= max(2, cpu_count())]:
+        with LookupEngine(bf, bst, fib, pref_stats, protocol=protocol, workers=workers) as engine:
+            engine.lookup(ips[:workers]) # let every worker attach first
+            start = perf_counter()
+            pref_lens, fib_vals = engine.lookup(ips)
+            elapsed = perf_counter() - start
+        same = (pref_lens == expected[0]).all() and list(fib_vals) == list(expected[1])
+        res.append((workers, len(ips)/elapsed, same))
+        print('workers=%d: %.0f lookups/s, same results: %s' %res[-1])
+
+    # record experiment to file in EXPERIMENTS: header, plot title, xaxis, yaxis, xs, ys, misc info
+    with open(os.path.join(EXPERIMENTS,
+                           'lookupEngine_'+protocol+'_random.txt'),
+              'w') as out:
+        lines = ["test_lookup_engine(): guided lookups/s by worker processes sharing the filter (0: lookup_batch in process),xs=[workers], ys=[(lookups/s, same results)]"] # header
+        lines.append('Shared-memory lookup scaling') # plot title
+        lines.append('Worker processes') # xaxis title
+        lines.append('Lookups per second') # yaxis title
+        lines.append(';'.join(str(row[0]) for row in res)) # xs
+        lines.append(';'.join('(%.0f, %s)' %row[1:] for row in res)) # ys
+        lines.append('K=%d, BITARR_SIZE=%d, %d IPs per batch, %d CPUs'
+                     %(k, BITARR_SIZE, len(ips), cpu_count())) # any extra info
+        out.write('\n'.join(lines))
+
+def test_route_cache(fib, traffic, pref_stats, protocol='v4', num_flows=1000):
+    '''Guided lookup of traffic with destination locality (Zipf-weighted
+        picks among `num_flows` destinations, random low 8 bits) without
+        and with a RouteCache keyed by IP or by AGGREGATE prefix: hit rate
+        and Bloom filter probes per IP, i.e. probes saved by the cache.
+    '''
+    print('\n\ntest_route_cache()\n\n')
+    k = K if protocol == 'v4' else K6
+    bf, bst = ipfilter.build_bloom_filter(
+        protocol=protocol, lamda=weigh_equally, fpp=None, k=k,
+        num_bits=BITARR_SIZE, fib=fib, pref_stats=pref_stats)
+    flows = traffic[:num_flows]
+    traffic = [ip ^ getrandbits(8) for ip in
+               choices(flows, weights=[1/(i+1) for i in range(len(flows))],
+                       k=min(THROTTLE, 10*len(flows)))]
+
+    res = [] # (cache, hit rate, bf._register() per IP, fib.__contains__() per IP)
+    configs = [('none', None)] + [('%s/%d' %(label, capacity),
+                                   ipfilter.RouteCache(capacity, pref_stats['prefixes'],
+                                                       aggregate, protocol))
+                                  for capacity in [256, 4096]
+                                  for label, aggregate in [('ip', None),
+                                                           ('aggregate', ipfilter.AGGREGATE[protocol])]]
+    for label, cache in configs:
+        nhit, nmiss = ipfilter._cache_hit.ncalls, ipfilter._cache_miss.ncalls
+        ncontains = bf._register.ncalls
+        nfib = fib.__contains__.ncalls
+        ipfilter.lookup_in_bloom(bf, traffic, fib, root=bst, maxx=pref_stats['maxx'],
+                                 minn=pref_stats['minn'], ix2len=pref_stats['ix2len'],
+                                 protocol=protocol, cache=cache)
+        hits = ipfilter._cache_hit.ncalls - nhit
+        lookups = hits + ipfilter._cache_miss.ncalls - nmiss
+        res.append((label, hits/lookups if lookups else 0.0,
+                    (bf._register.ncalls - ncontains)/len(traffic),
+                    (fib.__contains__.ncalls - nfib)/len(traffic)))
+        print('%s: hit rate %.3f, probes/IP %.2f, FIB lookups/IP %.2f' %res[-1])
+
+    # record experiment to file in EXPERIMENTS: header, plot title, xaxis, yaxis, xs, ys, misc info
+    with open(os.path.join(EXPERIMENTS,
+                           'routeCache_'+protocol+'_zipf.txt'),
+              'w') as out:
+        lines = ["test_route_cache(): guided lookup with a route cache keyed by IP or aggregate prefix,xs=[cache key/capacity], ys=[(hit rate, bf._register() per IP, fib.__contains__() per IP)]"] # header
+        lines.append('Route cache in front of guided lookup') # plot title
+        lines.append('Cache key/capacity') # xaxis title
+        lines.append('Hit rate, count of invocations per IP') # yaxis title
+        lines.append(';'.join(row[0] for row in res)) # xs
+        lines.append(';'.join('(%.3f, %.2f, %.2f)' %row[1:] for row in res)) # ys
+        lines.append('K=%d, BITARR_SIZE=%d, %d IPs over %d flows, probes saved per IP: %s'
+                     %(k, BITARR_SIZE, len(traffic), len(flows),
+                       ', '.join('%s=%.2f' %(row[0], res[0][2] - row[2]) for row in res[1:]))) # any extra info
+        out.write('\n'.join(lines))
+
+def test_unrolled_lookup(fib, traffic, pref_stats, protocol='v4'):
+    '''Per-lookup latency of the generic guided lookup
+        (_guided_lookup_helper) vs the one unrolled for the built tree by
+        codegen.compile_lookup(): mean, median and 99th percentile over
+        the traffic, checking that both return the same per IP.
+    '''
+    print('\n\ntest_unrolled_lookup()\n\n')
+    traffic = traffic[:THROTTLE]
+    k = K if protocol == 'v4' else K6
+    bf, bst = ipfilter.build_bloom_filter(
+        protocol=protocol, lamda=weigh_equally, fpp=None, k=k,
+        num_bits=BITARR_SIZE, fib=fib, pref_stats=pref_stats)
+    args = (fib, pref_stats['maxx'], pref_stats['minn'], pref_stats['ix2len'], protocol)
+    unrolled = compile_lookup(bf, bst, *args)
+
+    res = [] # (lookup, mean ns, median ns, 99th percentile ns)
+    results = []
+    for label, lookup in [('generic', lambda ip: ipfilter._guided_lookup_helper(bf, bst, ip, *args)),
+                          ('unrolled', unrolled)]:
+        latencies = np.zeros(len(traffic), dtype=np.int64)
+        out = []
+        for i, ip in enumerate(traffic):
+            start = perf_counter_ns()
+            out.append(lookup(ip))
+            latencies[i] = perf_counter_ns() - start
+        results.append(out)
+        res.append((label, latencies.mean(), np.median(latencies), np.percentile(latencies, 99)))
+        print('%s: mean %.0fns, median %.0fns, p99 %.0fns' %res[-1])
+    same = results[0] == results[1]
+    print('same results: %s' %same)
+
+    # record experiment to file in EXPERIMENTS: header, plot title, xaxis, yaxis, xs, ys, misc info
+    with open(os.path.join(EXPERIMENTS,
+                           'unrolledLookup_'+protocol+'_random.txt'),
+              'w') as out:
+        lines = ["test_unrolled_lookup(): generic vs unrolled guided lookup,xs=[_guided_lookup_helper, compile_lookup()], ys=[(mean, median, p99 latency in ns)]"] # header
+        lines.append('Unrolled guided lookup') # plot title
+        lines.append('Lookup') # xaxis title
+        lines.append('Latency per lookup (ns)') # yaxis title
+        lines.append(';'.join(row[0] for row in res)) # xs
+        lines.append(';'.join('(%.0f, %.0f, %.0f)' %row[1:] for row in res)) # ys
+        lines.append('K=%d, BITARR_SIZE=%d, %d IPs, %d lines of source, speedup=%.2fx, same results: %s'
+                     %(k, BITARR_SIZE, len(traffic), len(unrolled.source.splitlines()),
+                       res[0][1]/res[1][1], same)) # any extra info
+        out.write('\n'.join(lines))
+
+def test_hybrid_filter(fib, traffic, pref_stats, protocol='v4', strides=[16, 20, 24]):
+    '''Memory vs probes per IP: guided Bloom filter over all routes vs
+        ipfilter.HybridFilter, a direct-indexed array over the top
+        `stride` bits in front of a guided filter of the longer routes
+        only (both filters sized for FPP).
+    '''
+    print('\n\ntest_hybrid_filter()\n\n')
+    traffic = traffic[:THROTTLE]
+    res = [] # (stride, MB, bf._register() per IP, hash_fnv() per IP, fib.__contains__() per IP, resolved directly)
+    for stride in [None] + strides:
+        if stride is None:
+            bf, bst = ipfilter.build_bloom_filter(protocol=protocol, lamda=weigh_equally, fpp=FPP,
+                                                  fib=fib, pref_stats=pref_stats)
+            args = (fib, pref_stats['maxx'], pref_stats['minn'], pref_stats['ix2len'], protocol)
+            lookup = lambda ip: ipfilter._guided_lookup_helper(bf, bst, ip, *args)
+            num_bytes = bf.num_bits/8
+        else:
+            hybrid = ipfilter.HybridFilter(pref_stats, fib, stride=stride, fpp=FPP, protocol=protocol)
+            lookup, num_bytes = hybrid.lookup, hybrid.num_bytes()
+
+        ncontains = BloomFilter._register.ncalls
+        nfnv = hash_fnv.ncalls
+        nfib = fib.__contains__.ncalls
+        ndirect = ipfilter._direct_hit.ncalls
+        for ip in traffic:
+            lookup(ip)
+        res.append(('guided' if stride is None else 'hybrid/%d' %stride, num_bytes/(1024**2),
+                    (BloomFilter._register.ncalls - ncontains)/len(traffic),
+                    (hash_fnv.ncalls - nfnv)/len(traffic),
+                    (fib.__contains__.ncalls - nfib)/len(traffic),
+                    (ipfilter._direct_hit.ncalls - ndirect)/len(traffic)))
+        print('%s: %.2fMB, probes/IP %.2f, hashes/IP %.2f, FIB lookups/IP %.2f, resolved directly %.2f'
+              %res[-1])
+
+    # record experiment to file in EXPERIMENTS: header, plot title, xaxis, yaxis, xs, ys, misc info
+    with open(os.path.join(EXPERIMENTS,
+                           'hybrid_'+protocol+'_random.txt'),
+              'w') as out:
+        lines = ["test_hybrid_filter(): guided BF vs direct-indexed first stage + guided BF of longer routes,xs=[search/stride], ys=[(MB, bf._register() per IP, hash_fnv() per IP, fib.__contains__() per IP, fraction resolved directly)]"] # header
+        lines.append('Hybrid direct-indexed and guided lookup: memory vs stats per packet') # plot title
+        lines.append('Search/stride') # xaxis title
+        lines.append('MB, count of invocations per IP') # yaxis title
+        lines.append(';'.join(row[0] for row in res)) # xs
+        lines.append(';'.join('(%.2f, %.2f, %.2f, %.2f, %.2f)' %row[1:] for row in res)) # ys
+        lines.append('FPP=%.0e, %d IPs' %(FPP, len(traffic))) # any extra info
+        out.write('\n'.join(lines))
+
+def test_fallbacks(fib, traffic, pref_stats, protocol='v4', bits_per_prefix=[4, 16]):
+    '''Cost of the searches after a BMP fails to verify (ipfilter.FALLBACKS):
+        linear scan below the deepest hit vs backtracking along the search
+        path vs likely prefix lengths first, in filters small enough
+        (`bits_per_prefix`) for false positives to matter.
+    '''
+    print('\n\ntest_fallbacks()\n\n')
+    traffic = traffic[:THROTTLE]
+    k = K if protocol == 'v4' else K6
+    counters = {'linear': ipfilter._default_to_linear_search,
+                'backtrack': ipfilter._backtrack_search,
+                'likely': ipfilter._likely_search}
+    res = [] # (bits per prefix/fallback, fallbacks, bf._register(), hash_fnv(), fib.__contains__() per IP, results differing from linear)
+    for bits in bits_per_prefix:
+        bf, bst = ipfilter.build_bloom_filter(
+            protocol=protocol, lamda=weigh_equally, fpp=None, k=k,
+            num_bits=bits*len(pref_stats['prefixes']), fib=fib, pref_stats=pref_stats)
+        args = (fib, pref_stats['maxx'], pref_stats['minn'], pref_stats['ix2len'], protocol)
+        expected = None
+        for fallback in ipfilter.FALLBACKS:
+            nfallback = counters[fallback].ncalls
+            ncontains = bf._register.ncalls
+            nfnv = hash_fnv.ncalls
+            nfib = fib.__contains__.ncalls
+            out = [ipfilter._guided_lookup_helper(bf, bst, ip, *args, fallback=fallback)[:2]
+                   for ip in traffic]
+            expected = expected or out
+            res.append(('%d/%s' %(bits, fallback),
+                        (counters[fallback].ncalls - nfallback)/len(traffic),
+                        (bf._register.ncalls - ncontains)/len(traffic),
+                        (hash_fnv.ncalls - nfnv)/len(traffic),
+                        (fib.__contains__.ncalls - nfib)/len(traffic),
+                        sum(a != b for a, b in zip(out, expected))))
+            print('%s: fallbacks/IP %.3f, probes/IP %.2f, hashes/IP %.2f, FIB lookups/IP %.2f, differing from linear %d'
+                  %res[-1])
+
+    # record experiment to file in EXPERIMENTS: header, plot title, xaxis, yaxis, xs, ys, misc info
+    with open(os.path.join(EXPERIMENTS,
+                           'fallbacks_'+protocol+'_random.txt'),
+              'w') as out:
+        lines = ["test_fallbacks(): search after a BMP fails to verify,xs=[bits per prefix/fallback], ys=[(fallbacks, bf._register(), hash_fnv(), fib.__contains__() per IP, results differing from linear)]"] # header
+        lines.append('Fallback search after BMP decode failure: stats per packet') # plot title
+        lines.append('Bits per prefix/fallback') # xaxis title
+        lines.append('Count of invocations per IP') # yaxis title
+        lines.append(';'.join(row[0] for row in res)) # xs
+        lines.append(';'.join('(%.3f, %.2f, %.2f, %.2f, %d)' %row[1:] for row in res)) # ys
+        lines.append('K=%d, %d IPs' %(k, len(traffic))) # any extra info
+        out.write('\n'.join(lines))
+
+def test_instrumentation(traffic, pref_stats, protocol='v4'):
+    '''Throughput with instrumentation on (counters and progress reports,
+        the default) vs off (build_bloom_filter(instrument=False) and a
+        plain dict FIB): guided build, then linear and guided lookups.
+    '''
+    print('\n\ntest_instrumentation()\n\n')
+    traffic = traffic[:THROTTLE]
+    k = K if protocol == 'v4' else K6
+    res = [] # (instrumented, build s, linear lookups/s, guided lookups/s)
+    results = []
+    for instrument in (True, False):
+        fib = compile_fib_table(protocol=protocol, instrument=instrument)
+        start = perf_counter()
+        bf, bst = ipfilter.build_bloom_filter(
+            protocol=protocol, lamda=weigh_equally, fpp=None, k=k, num_bits=BITARR_SIZE,
+            fib=fib, pref_stats=pref_stats, instrument=instrument)
+        build = perf_counter() - start
+        bf_linear, _ = ipfilter.build_bloom_filter(
+            protocol=protocol, fpp=None, k=k, num_bits=BITARR_SIZE, fib=fib,
+            pref_stats=pref_stats, instrument=instrument)
+
+        rates = []
+        for f, root in [(bf_linear, None), (bf, bst)]:
+            start = perf_counter()
+            out = ipfilter.lookup_in_bloom(f, traffic, fib, root=root, maxx=pref_stats['maxx'],
+                                           minn=pref_stats['minn'], ix2len=pref_stats['ix2len'],
+                                           protocol=protocol)
+            rates.append(len(traffic)/(perf_counter() - start))
+            results.append(out)
+        res.append(('on' if instrument else 'off', build) + tuple(rates))
+        print('instrumentation %s: build %.2fs, linear %.0f lookups/s, guided %.0f lookups/s'
+              %res[-1])
+    same = results[:2] == results[2:]
+    print('same results: %s, speedup linear %.2fx, guided %.2fx'
+          %(same, res[1][2]/res[0][2], res[1][3]/res[0][3]))
+
+    # record experiment to file in EXPERIMENTS: header, plot title, xaxis, yaxis, xs, ys, misc info
+    with open(os.path.join(EXPERIMENTS,
+                           'instrumentation_'+protocol+'_random.txt'),
+              'w') as out:
+        lines = ["test_instrumentation(): counters and progress reports on vs off,xs=[on, off], ys=[(build s, linear lookups/s, guided lookups/s)]"] # header
+        lines.append('Throughput with and without instrumentation') # plot title
+        lines.append('Instrumentation') # xaxis title
+        lines.append('Build time, lookups per second') # yaxis title
+        lines.append(';'.join(row[0] for row in res)) # xs
+        lines.append(';'.join('(%.2f, %.0f, %.0f)' %row[1:] for row in res)) # ys
+        lines.append('K=%d, BITARR_SIZE=%d, %d IPs, same results=%s' %(k, BITARR_SIZE, len(traffic), same)) # any extra info
+        out.write('\n'.join(lines))
+
+def test_latency(fib, traffic, pref_stats, protocol='v4', sample=10, bits_per_prefix=[4, None]):
+    '''Tail latency of guided lookups by search path (ipfilter.LATENCY_PATHS),
+        1 in `sample` lookups timed, in a filter with `bits_per_prefix`
+        (None for BITARR_SIZE bits) and for linear search. Percentiles go
+        to EXPERIMENTS as JSON and Prometheus text too, and the throughput
+        with the recorder to check its overhead.
+    '''
+    print('\n\ntest_latency()\n\n')
+    traffic = traffic[:THROTTLE]
+    k = K if protocol == 'v4' else K6
+    res = [] # (filter/path, count sampled, p50, p99, p99.9 in ns)
+    rates = [] # (filter, lookups/s without, with recorder)
+    for bits in bits_per_prefix + ['linear']:
+        num_bits = BITARR_SIZE if bits in (None, 'linear') else bits*len(pref_stats['prefixes'])
+        bf, bst = ipfilter.build_bloom_filter(
+            protocol=protocol, lamda=None if bits == 'linear' else weigh_equally, fpp=None,
+            k=k, num_bits=num_bits, fib=fib, pref_stats=pref_stats)
+        label = 'linear' if bits == 'linear' else '%d bits' %(bits or num_bits/len(pref_stats['prefixes']))
+        latency = LatencyRecorder(sample=sample)
+        elapsed = []
+        for recorder in (None, latency):
+            start = perf_counter()
+            ipfilter.lookup_in_bloom(bf, traffic, fib, root=bst, maxx=pref_stats['maxx'],
+                                     minn=pref_stats['minn'], ix2len=pref_stats['ix2len'],
+                                     protocol=protocol, latency=recorder)
+            elapsed.append(perf_counter() - start)
+        rates.append((label,) + tuple(len(traffic)/t for t in elapsed))
+        for path, stats in latency.summary().items():
+            quantiles = stats['quantiles']
+            res.append(('%s/%s' %(label, path), stats['count'],
+                        quantiles['0.5'], quantiles['0.99'], quantiles['0.999']))
+            print('%s: sampled %d, p50 %dns, p99 %dns, p99.9 %dns' %res[-1])
+        print('%s: %.0f lookups/s, %.0f with latency recorder' %rates[-1])
+        name = 'latency_%s_%s_random' %(protocol, label.replace(' ', ''))
+        latency.save_json(os.path.join(EXPERIMENTS, name + '.json'))
+        latency.save_prometheus(os.path.join(EXPERIMENTS, name + '.prom'))
+
+    # record experiment to file in EXPERIMENTS: header, plot title, xaxis, yaxis, xs, ys, misc info
+    with open(os.path.join(EXPERIMENTS,
+                           'latency_'+protocol+'_random.txt'),
+              'w') as out:
+        lines = ["test_latency(): sampled lookup latency by search path,xs=[bits per prefix or linear/path], ys=[(count sampled, p50, p99, p99.9 in ns)]"] # header
+        lines.append('Lookup latency percentiles by search path') # plot title
+        lines.append('Bits per prefix/search path') # xaxis title
+        lines.append('Latency (ns)') # yaxis title
+        lines.append(';'.join(row[0] for row in res)) # xs
+        lines.append(';'.join('(%d, %d, %d, %d)' %row[1:] for row in res)) # ys
+        lines.append('K=%d, 1 in %d of %d IPs sampled, lookups/s without/with recorder: %s'
+                     %(k, sample, len(traffic),
+                       ', '.join('%s %.0f/%.0f' %rate for rate in rates))) # any extra info
+        out.write('\n'.join(lines))
+
+def test_next_hops(fib, traffic, pref_stats, protocol='v4', bits_per_prefix=[8, None]):
+    '''Guided lookup of next hops: from the FIB (a FIB of next hops) vs
+        decoded from the filter (build_bloom_filter(next_hops=...)) and
+        confirmed in the FIB, counting the wrong ones, in a filter with
+        `bits_per_prefix` (None for BITARR_SIZE bits). Next hops come from
+        the prefix file, or if it has none, are drawn from NUM_LINKS links.
+    '''
+    print('\n\ntest_next_hops()\n\n')
+    traffic = traffic[:THROTTLE]
+    k = K if protocol == 'v4' else K6
+    next_hops = load_next_hops(protocol)
+    source = 'prefix file'
+    if not next_hops:
+        next_hops = {key: 'link%d' %randint(0, NUM_LINKS-1) for key in fib.keys()}
+        source = '%d random links' %NUM_LINKS
+    hop_fib = FIB()
+    for key in fib.keys():
+        hop_fib[key] = next_hops.get(key, '-')
+
+    # next hop of the exact longest prefix match
+    max_shift = ipfilter.NUMBITS[protocol]
+    expected = []
+    for ip in traffic:
+        keys = (encode_ip_prefix_pair(ip & ((1<<max_shift) - 1) << (max_shift-pref_len) & ((1<<max_shift) - 1),
+                                      pref_len, protocol)
+                for pref_len in pref_stats['ix2len'][:0:-1])
+        expected.append(next((next_hops.get(key, '-') for key in keys if key in next_hops), None))
+
+    res = [] # (bits per prefix/mode, fib.__contains__(), hash_fnv(), bf._register() per IP, lookups/s, wrong next hops decoded, next hops differing from exact LPM)
+    for bits in bits_per_prefix:
+        num_bits = BITARR_SIZE if bits is None else bits*len(pref_stats['prefixes'])
+        label = '%d' %(bits or num_bits/len(pref_stats['prefixes']))
+        for mode, encoded in [('fib', None), ('filter', next_hops)]:
+            bf, bst = ipfilter.build_bloom_filter(
+                protocol=protocol, lamda=weigh_equally, fpp=None, k=k, num_bits=num_bits,
+                fib=hop_fib, pref_stats=pref_stats, next_hops=encoded)
+            args = (hop_fib, pref_stats['maxx'], pref_stats['minn'], pref_stats['ix2len'], protocol)
+            nfib = hop_fib.__contains__.ncalls
+            nfnv = hash_fnv.ncalls
+            ncontains = bf._register.ncalls
+            nwrong = ipfilter._hop_rejected.ncalls
+            start = perf_counter()
+            out = [ipfilter._guided_lookup_helper(bf, bst, ip, *args)[1] for ip in traffic]
+            elapsed = perf_counter() - start
+            res.append(('%s/%s' %(label, mode),
+                        (hop_fib.__contains__.ncalls - nfib)/len(traffic),
+                        (hash_fnv.ncalls - nfnv)/len(traffic),
+                        (bf._register.ncalls - ncontains)/len(traffic),
+                        len(traffic)/elapsed,
+                        ipfilter._hop_rejected.ncalls - nwrong,
+                        sum(a != b for a, b in zip(out, expected))))
+            print('%s: FIB lookups/IP %.3f, hashes/IP %.2f, probes/IP %.2f, %.0f lookups/s, wrong next hops decoded %d, differing from exact LPM %d'
+                  %res[-1])
+
+    # record experiment to file in EXPERIMENTS: header, plot title, xaxis, yaxis, xs, ys, misc info
+    with open(os.path.join(EXPERIMENTS,
+                           'next_hops_'+protocol+'_random.txt'),
+              'w') as out:
+        lines = ["test_next_hops(): next hop from the FIB vs decoded from the filter,xs=[bits per prefix/mode], ys=[(fib.__contains__(), hash_fnv(), bf._register() per IP, lookups/s, wrong next hops decoded, next hops differing from exact LPM)]"] # header
+        lines.append('Next hop lookup: FIB vs encoded in the filter') # plot title
+        lines.append('Bits per prefix/next hop from') # xaxis title
+        lines.append('Count of invocations per IP, lookups per second') # yaxis title
+        lines.append(';'.join(row[0] for row in res)) # xs
+        lines.append(';'.join('(%.3f, %.2f, %.2f, %.0f, %d, %d)' %row[1:] for row in res)) # ys
+        lines.append('K=%d, %d IPs, next hops from %s, %d distinct'
+                     %(k, len(traffic), source, len(set(next_hops.values())))) # any extra info
+        out.write('\n'.join(lines))
+
+def test_bmp_check(fib, traffic, pref_stats, protocol='v4', bits_per_prefix=[4, 8, 16]):
+    '''BMP pointers of the fixed ENCODING width vs sized to the hash funcs
+        (bmp_bits='auto'), without and with check bits (ipfilter.BMP_CHECKS),
+        k raised where the checked pointers need more (ipfilter.bmp_min_k()),
+        in filters with `bits_per_prefix`: bit
+        probes, hashes, FIB lookups, pointers rejected by their check bits
+        and fallbacks to linear search per IP, and results differing from
+        the exact longest prefix match.
+    '''
+    print('\n\ntest_bmp_check()\n\n')
+    traffic = traffic[:THROTTLE]
+    k = K if protocol == 'v4' else K6
+    args = (fib, pref_stats['maxx'], pref_stats['minn'], pref_stats['ix2len'], protocol)
+    layouts = [(None, None), ('auto', None), ('auto', 'parity'), ('auto', 'berger')]
+    plan = ipfilter.SearchPlan.compile(obst(protocol, weigh_equally), protocol)
+
+    # FIB value of the exact longest prefix match
+    max_shift = ipfilter.NUMBITS[protocol]
+    expected = []
+    for ip in traffic:
+        keys = (encode_ip_prefix_pair(ip & ((1<<max_shift) - 1) << (max_shift-pref_len) & ((1<<max_shift) - 1),
+                                      pref_len, protocol)
+                for pref_len in pref_stats['ix2len'][:0:-1])
+        expected.append(next((fib[key] for key in keys if key in fib), None))
+
+    res = [] # (bits per prefix/pointer bits/check, bf._register(), hash_fnv(), fib.__contains__(), rejected, fallbacks per IP, results differing from exact LPM)
+    for bits in bits_per_prefix:
+        for bmp_bits, bmp_check in layouts:
+            bf, bst = ipfilter.build_bloom_filter(
+                protocol=protocol, plan=plan, fpp=None,
+                k=max(k, ipfilter.bmp_min_k(plan, pref_stats['ix2len'], bmp_check)),
+                num_bits=bits*len(pref_stats['prefixes']), fib=fib, pref_stats=pref_stats,
+                bmp_bits=bmp_bits, bmp_check=bmp_check)
+            ncontains = bf._register.ncalls
+            nfnv = hash_fnv.ncalls
+            nfib = fib.__contains__.ncalls
+            nrejected = ipfilter._bmp_rejected.ncalls
+            ndefault = ipfilter._default_to_linear_search.ncalls
+            out = [ipfilter._guided_lookup_helper(bf, bst, ip, *args)[1] for ip in traffic]
+            res.append(('%d/%d/%s/k=%d' %(bits, ipfilter._bmp_layout(bf, protocol)[0], bmp_check, bf.k),
+                        (bf._register.ncalls - ncontains)/len(traffic),
+                        (hash_fnv.ncalls - nfnv)/len(traffic),
+                        (fib.__contains__.ncalls - nfib)/len(traffic),
+                        (ipfilter._bmp_rejected.ncalls - nrejected)/len(traffic),
+                        (ipfilter._default_to_linear_search.ncalls - ndefault)/len(traffic),
+                        sum(a != b for a, b in zip(out, expected))))
+            print('%s: probes/IP %.2f, hashes/IP %.2f, FIB lookups/IP %.3f, rejected/IP %.3f, fallbacks/IP %.3f, differing from exact LPM %d'
+                  %res[-1])
+
+    # record experiment to file in EXPERIMENTS: header, plot title, xaxis, yaxis, xs, ys, misc info
+    with open(os.path.join(EXPERIMENTS,
+                           'bmp_check_'+protocol+'_random.txt'),
+              'w') as out:
+        lines = ["test_bmp_check(): BMP pointer width and check bits,xs=[bits per prefix/pointer bits/check/k], ys=[(bf._register(), hash_fnv(), fib.__contains__(), rejected, fallbacks per IP, results differing from exact LPM)]"] # header
+        lines.append('BMP pointer width and check bits: stats per packet') # plot title
+        lines.append('Bits per prefix/pointer bits/check/k') # xaxis title
+        lines.append('Count of invocations per IP') # yaxis title
+        lines.append(';'.join(row[0] for row in res)) # xs
+        lines.append(';'.join('(%.2f, %.2f, %.3f, %.3f, %.3f, %d)' %row[1:] for row in res)) # ys
+        lines.append('K=%d, %d prefix lengths, %d IPs' %(k, len(pref_stats['ix2len']), len(traffic))) # any extra info
+        out.write('\n'.join(lines))
+
+def _walk_depth(bf, plan, traffic, protocol='v4'):
+    '''Mean count of nodes of `plan` the walk down it visits per IP of
+        `traffic`, going right on a hit in `bf` (a prefix or a marker) and
+        left on a miss.
+    '''
+    depths = []
+    for ip in traffic:
+        node, depth = 0 if plan.vals else -1, 0
+        while node >= 0:
+            key = encode_ip_prefix_pair(plan.masks[node] & ip, plan.vals[node], protocol)
+            node = plan.rights[node] if bf.contains(key, hashes=[0]) else plan.lefts[node]
+            depth += 1
+        depths.append(depth)
+    return sum(depths)/max(1, len(depths))
+
+def test_adaptive_tree(fib, pref_stats, protocol='v4',
+                       traffic_patterns=[RANDOM_TRAFFIC, PREF_COUNT_TRAFFIC, PREF_SPACE_TRAFFIC],
+                       windows=10):
+    '''Static balanced tree (weigh_equally) vs ipfilter.AdaptiveFilter,
+        whose tree is recomputed `windows` times over one pass of the
+        traffic from the lookups recorded so far: bit probes, hashes and
+        mean tree walk depth (see _walk_depth()) per IP of a second pass
+        over the same traffic, and the count of filter rebuilds during the
+        first.
+    '''
+    print('\n\ntest_adaptive_tree()\n\n')
+    args = (fib, pref_stats['maxx'], pref_stats['minn'], pref_stats['ix2len'], protocol)
+    names = {RANDOM_TRAFFIC: 'random', PREF_COUNT_TRAFFIC: 'count', PREF_SPACE_TRAFFIC: 'space'}
+    res = [] # (traffic/tree, bf._register(), hash_fnv() per IP, mean walk depth, rebuilds)
+    for pattern in traffic_patterns:
+        traffic = load_traffic(protocol=protocol, typ=pattern)[:THROTTLE]
+        adaptive = ipfilter.AdaptiveFilter(pref_stats, fib, fpp=FPP, protocol=protocol,
+                                           interval=max(1, len(traffic)//windows))
+        nrebuilt = ipfilter._tree_rebuilt.ncalls
+        for start in range(0, len(traffic), adaptive.interval):
+            for ip in traffic[start:start + adaptive.interval]:
+                adaptive.lookup(ip)
+            adaptive.maybe_rebuild() # between windows, off the lookup path
+        nrebuilt = ipfilter._tree_rebuilt.ncalls - nrebuilt
+
+        bf, bst = ipfilter.build_bloom_filter(protocol=protocol, lamda=weigh_equally, fpp=FPP,
+                                              fib=fib, pref_stats=pref_stats)
+        for label, (bf, bst) in [('equal', (bf, bst)), ('adaptive', (adaptive.bf, adaptive.root))]:
+            ncontains = BloomFilter._register.ncalls
+            nfnv = hash_fnv.ncalls
+            results = [ipfilter._guided_lookup_helper(bf, bst, ip, *args) for ip in traffic]
+            res.append(('%s/%s' %(names.get(pattern, pattern), label),
+                        (BloomFilter._register.ncalls - ncontains)/len(traffic),
+                        (hash_fnv.ncalls - nfnv)/len(traffic),
+                        _walk_depth(bf, bst, traffic, protocol),
+                        nrebuilt if label == 'adaptive' else 0))
+            print('%s: probes/IP %.2f, hashes/IP %.2f, mean walk depth %.2f, rebuilds %d' %res[-1])
+
+    # record experiment to file in EXPERIMENTS: header, plot title, xaxis, yaxis, xs, ys, misc info
+    with open(os.path.join(EXPERIMENTS,
+                           'adaptiveTree_'+protocol+'.txt'),
+              'w') as out:
+        lines = ["test_adaptive_tree(): static balanced vs traffic-adaptive search tree,xs=[traffic/tree], ys=[(bf._register(), hash_fnv() per IP, mean walk depth, rebuilds)]"] # header
+        lines.append('Static vs traffic-adaptive search tree: stats per packet') # plot title
+        lines.append('Traffic/tree') # xaxis title
+        lines.append('Count of invocations per IP, depth') # yaxis title
+        lines.append(';'.join(row[0] for row in res)) # xs
+        lines.append(';'.join('(%.2f, %.2f, %.2f, %d)' %row[1:] for row in res)) # ys
+        lines.append('FPP=%.0e, %d windows, up to %d IPs' %(FPP, windows, THROTTLE)) # any extra info
+        out.write('\n'.join(lines))
+
+def _fib_bytes(fib):
+    '''Memory of a FIB: its dict and every key and value in it.
+    '''
+    return sys.getsizeof(fib.__dict__) + sum(sys.getsizeof(key) + sys.getsizeof(val)
+                                             for key, val in fib.items())
+
+def test_compact_fib(fib, traffic, pref_stats, protocol='v4'):
+    '''Memory and lookup speed of the FIB (dict of CIDR strings) vs
+        utils.CompactFIB, with CIDR strings rendered on access or stored:
+        keys of all routes and as many absent keys looked up one by one,
+        then in one contains_many() batch; and the batch guided lookup
+        (ipfilter.lookup_batch()) with each FIB.
+    '''
+    print('\n\ntest_compact_fib()\n\n')
+    keys = list(fib.keys())
+    keys += [key ^ 1 for key in keys] # absent: host bit set
+    words = np.array(keys, dtype=np.uint64) if protocol == 'v4' else to_words(keys, KEY_WIDTH[protocol])
+
+    traffic = traffic[:THROTTLE]
+    ips = np.array(traffic, dtype=np.uint64) if protocol == 'v4' else traffic
+    k = K if protocol == 'v4' else K6
+    bf, bst = ipfilter.build_bloom_filter(
+        protocol=protocol, lamda=weigh_equally, fpp=None, k=k,
+        num_bits=BITARR_SIZE, fib=fib, pref_stats=pref_stats)
+
+    res = [] # (FIB, MB, scalar lookups/s, batch lookups/s, guided batch lookups/s)
+    results = []
+    for label, table in [('FIB', fib),
+                         ('CompactFIB/render', CompactFIB.from_fib(fib, protocol)),
+                         ('CompactFIB/store', CompactFIB.from_fib(fib, protocol, render=False))]:
+        num_bytes = table.num_bytes() if hasattr(table, 'num_bytes') else _fib_bytes(fib)
+        start = perf_counter()
+        found = [table[key] if key in table else None for key in keys]
+        scalar = len(keys)/(perf_counter() - start)
+        if hasattr(table, 'contains_many'):
+            start = perf_counter()
+            contained = table.contains_many(words)
+            batch = len(keys)/(perf_counter() - start)
+            assert list(contained) == [val is not None for val in found]
+        else:
+            batch = scalar # no batch lookup
+        start = perf_counter()
+        pref_lens, fib_vals = ipfilter.lookup_batch(bf, ips, table, bst, pref_stats['maxx'],
+                                                    pref_stats['minn'], pref_stats['ix2len'], protocol)
+        guided = len(traffic)/(perf_counter() - start)
+        results.append((found, pref_lens.tolist(), fib_vals.tolist()))
+        res.append((label, num_bytes/(1024**2), scalar, batch, guided))
+        print('%s: %.2fMB, %.0f lookups/s, batch %.0f lookups/s, guided batch %.0f lookups/s' %res[-1])
+    same = results[0] == results[1] == results[2]
+    print('same results: %s' %same)
+
+    # record experiment to file in EXPERIMENTS: header, plot title, xaxis, yaxis, xs, ys, misc info
+    with open(os.path.join(EXPERIMENTS,
+                           'compactFib_'+protocol+'.txt'),
+              'w') as out:
+        lines = ["test_compact_fib(): dict FIB vs CompactFIB,xs=[FIB, CompactFIB rendering/storing CIDR strings], ys=[(MB, scalar lookups/s, batch lookups/s, lookup_batch() lookups/s)]"] # header
+        lines.append('Compact array-backed FIB') # plot title
+        lines.append('FIB') # xaxis title
+        lines.append('MB, lookups per second') # yaxis title
+        lines.append(';'.join(row[0] for row in res)) # xs
+        lines.append(';'.join('(%.2f, %.0f, %.0f, %.0f)' %row[1:] for row in res)) # ys
+        lines.append('%d routes, %d keys looked up, %d IPs, bytes per route: %s, same results: %s'
+                     %(len(fib), len(keys), len(traffic),
+                       ', '.join('%.1f' %(row[1]*(1024**2)/len(fib)) for row in res), same)) # any extra info
+        out.write('\n'.join(lines))
+
 if __name__ == "__main__":
     # tests
+    test_hash_throughput('v4')
+    test_hash_throughput('v6')
     test_traffic_patterns()
     fib, traffic, pref_stats = _common_prep(protocol='v4', traffic_pattern=RANDOM_TRAFFIC)
     test_bitarray_size(fib, traffic, pref_stats)
     test_num_hash_funcs(fib, traffic, pref_stats)
+    test_hash_funcs(fib, pref_stats)
+    test_blocked_bloom(fib, traffic, pref_stats)
+    test_counting_bloom(fib, traffic, pref_stats)
+    test_partitioned_bloom(fib, traffic, pref_stats)
+    test_parallel_build(fib)
+    test_lookup_batch(fib, traffic, pref_stats)
+    test_lookup_stream(fib, pref_stats)
+    test_lookup_engine(fib, traffic, pref_stats)
+    test_route_cache(fib, traffic, pref_stats)
+    test_unrolled_lookup(fib, traffic, pref_stats)
+    test_hybrid_filter(fib, traffic, pref_stats)
+    test_fallbacks(fib, traffic, pref_stats)
+    test_compact_fib(fib, traffic, pref_stats)
+    test_instrumentation(traffic, pref_stats)
+    test_latency(fib, traffic, pref_stats)
+    test_next_hops(fib, traffic, pref_stats)
+    test_bmp_check(fib, traffic, pref_stats)
+    test_adaptive_tree(fib, pref_stats)
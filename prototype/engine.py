@@ -0,0 +1,158 @@
+'''engine.py
+
+Multi-process guided lookup. LookupEngine publishes a guided Bloom
+filter's bit array, its search plan (ipfilter.SearchPlan), ix2len and the
+keys of the FIB (as in a utils.CompactFIB) in multiprocessing.shared_memory
+once; a pool of worker processes attaches to them without copying and
+runs ipfilter.lookup_batch() on its share of every batch of traffic:
+
+    with LookupEngine(bf, root, fib, pref_stats, protocol='v4', workers=4) as engine:
+        pref_lens, fib_vals = engine.lookup(ips)
+
+The engine serves a snapshot: build a new one after updating `bf` or `fib`.
+Next hops encoded in `bf` (ipfilter.build_bloom_filter(next_hops=...)) are
+verified by the workers against the FIB as in lookup_batch().
+'''
+import sys
+from mconf import *
+for d in [DATADIR]:
+    sys.path.append(d)
+
+import numpy as np
+from math import ceil
+from multiprocessing import Pool, cpu_count
+from multiprocessing.shared_memory import SharedMemory
+from bloomfilter import BloomFilter, BlockedBloomFilter
+from utils import CompactFIB
+import ipfilter
+
+def _share(array):
+    '''Copy `array` into a new shared memory block. Returns the block and
+        the (name, shape, dtype) a worker needs to attach to it.
+    '''
+    block = SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+def _attach(spec):
+    '''Returns the shared memory block named in `spec` (see _share()) and
+        an array over it.
+    '''
+    name, shape, dtype = spec
+    block = SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+_worker = dict() # per worker process: shared blocks and the lookup args built on them
+
+def _init_worker(specs, meta):
+    '''Pool initializer: attach to the shared blocks and rebuild the filter,
+        tree and FIB views on them.
+    '''
+    backend, n, k, num_bits, width, hash_func, instrument, bmp_layout, hop_layout, maxx, minn,\
+        protocol = meta
+    arrays = dict()
+    for name, spec in specs.items():
+        block, arrays[name] = _attach(spec)
+        _worker.setdefault('blocks', []).append(block) # keep mapped
+    bits = arrays['bits']
+    bf = backend(None, n, k=k, num_bits=num_bits, width=width, hash_func=hash_func,
+                 buffer=bits.data, instrument=instrument)
+    bf.bmp_bits, bf.bmp_check = bmp_layout
+    root = ipfilter.SearchPlan(*arrays['tree'], protocol)
+    fib = CompactFIB(arrays['fib'], protocol=protocol, instrument=instrument) # values are rows
+    if hop_layout[0] is not None:
+        bf.hops, bf.hop_bits = hop_layout
+    _worker['args'] = (bf, fib, root, maxx, minn, arrays['ix2len'], protocol)
+
+def _lookup_worker(ips):
+    '''Pool worker: guided lookup of a slice of traffic. Returns prefix
+        lengths and FIB rows (-1 if default route).
+    '''
+    bf, fib, root, maxx, minn, ix2len, protocol = _worker['args']
+    pref_lens, rows = ipfilter.lookup_batch(bf, ips, fib, root, maxx, minn, ix2len, protocol)
+    return pref_lens, np.array([-1 if row is None else row for row in rows], dtype=np.int64)
+
+class LookupEngine:
+    '''Guided lookup over a pool of `workers` processes (default: one per
+        CPU) sharing one copy of the filter, tree, ix2len and FIB.
+    '''
+    def __init__(self, bf, root, fib, pref_stats, protocol='v4', workers=None):
+        if not hasattr(bf, 'ba') or (bf.width is None and protocol != 'v4'):
+            raise ValueError('lookup engine needs a fixed-width bit array backend, not %s'
+                             %type(bf).__name__)
+        self.workers = workers or cpu_count()
+        if not isinstance(fib, CompactFIB):
+            fib = CompactFIB.from_fib(fib, protocol)
+        # FIB values by row, row -1 (default route) -> None
+        self.fib_vals = np.array(fib.values() + [None], dtype=object)
+
+        plan = ipfilter._as_plan(root, protocol)
+        self.blocks, specs = [], dict()
+        for name, array in [('bits', np.frombuffer(bf.ba.tobytes(), dtype=np.uint8)),
+                            ('tree', np.array([plan.vals, plan.lefts, plan.rights], dtype=np.int64)),
+                            ('ix2len', np.array(pref_stats['ix2len'], dtype=np.int64)),
+                            ('fib', fib.words)]:
+            block, specs[name] = _share(array)
+            self.blocks.append(block)
+
+        # lookups only read the bit array, so a counting filter is served as a plain one
+        backend = BlockedBloomFilter if isinstance(bf, BlockedBloomFilter) else BloomFilter
+        meta = (backend, bf.num_elements, bf.k, bf.num_bits, bf.width, bf.hash_func,
+                bf.instrument, (getattr(bf, 'bmp_bits', None), getattr(bf, 'bmp_check', None)),
+                (getattr(bf, 'hops', None), getattr(bf, 'hop_bits', None)),
+                pref_stats['maxx'], pref_stats['minn'], protocol)
+        self.pool = Pool(self.workers, initializer=_init_worker, initargs=(specs, meta))
+
+    def lookup(self, ips):
+        '''Look up a batch of `ips` (as for ipfilter.lookup_batch()), split
+            evenly between the workers.
+
+            Returns a pair of per-IP arrays: resulting prefix length, and
+                FIB value (None if default route).
+        '''
+        if not len(ips):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=object)
+        size = ceil(len(ips) / self.workers)
+        parts = self.pool.map(_lookup_worker, [ips[i:i+size] for i in range(0, len(ips), size)])
+        pref_lens = np.concatenate([pref_lens for pref_lens, _ in parts])
+        return pref_lens, self.fib_vals[np.concatenate([rows for _, rows in parts])]
+
+    def close(self):
+        '''Stop the workers and free the shared memory.
+        '''
+        self.pool.close()
+        self.pool.join()
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+if __name__ == "__main__":
+    from utils import compile_fib_table, load_traffic, load_prefixes, prefix_stats
+    from obst import weigh_equally
+
+    fib = compile_fib_table(protocol='v4')
+    pref_stats = prefix_stats(load_prefixes('v4'))
+    bf, bst = ipfilter.build_bloom_filter(protocol='v4', lamda=weigh_equally, fpp=None,
+                                          k=10, num_bits=100000, fib=fib, pref_stats=pref_stats)
+    ips = np.array(load_traffic('v4'), dtype=np.uint64)
+    expected = ipfilter.lookup_batch(bf, ips, fib, bst, pref_stats['maxx'], pref_stats['minn'],
+                                     pref_stats['ix2len'], 'v4')
+    with LookupEngine(bf, bst, fib, pref_stats, protocol='v4', workers=2) as engine:
+        pref_lens, fib_vals = engine.lookup(ips)
+    print((pref_lens == expected[0]).all() and list(fib_vals) == list(expected[1])) # => True
+
+    # with next hops (unlike the FIB values) encoded in the filter, vs the scalar lookup
+    bf, bst = ipfilter.build_bloom_filter(protocol='v4', lamda=weigh_equally, fpp=None,
+                                          k=10, num_bits=100000, fib=fib, pref_stats=pref_stats,
+                                          next_hops={key: 'hop %d' %(key % 5) for key in fib})
+    args = (fib, pref_stats['maxx'], pref_stats['minn'], pref_stats['ix2len'], 'v4')
+    with LookupEngine(bf, bst, fib, pref_stats, protocol='v4', workers=2) as engine:
+        pref_lens, fib_vals = engine.lookup(ips)
+    print([(pref_len, fib_val) for pref_len, fib_val in zip(pref_lens.tolist(), fib_vals)]
+          == [ipfilter._guided_lookup_helper(bf, bst, ip, *args)[:2] for ip in ips.tolist()]) # => True
@@ -3,27 +3,103 @@
 https://en.wikipedia.org/wiki/Fowler%E2%80%93Noll%E2%80%93Vo_hash_function
 '''
 from sys import getsizeof
+import numpy as np
 from profiler import count_invocations
 
 FNV_OFFSET_BASIS = 0xcbf29ce484222325
 FNV_PRIME = 0x100000001b3
 
+# getsizeof() of an int by count of 30-bit digits (0 is special-cased),
+# i.e. the number of bytes hash_fnv walks for a key of that magnitude
+_INT_SIZES = [getsizeof(0), getsizeof(1), getsizeof(1<<30), getsizeof(1<<60)]
+
 @count_invocations
-def hash_fnv(obj):
+def hash_fnv(obj, width=None):
     '''Returns a hash of obj.
+
+        width (int, optional): hash exactly the `width` low-order bytes
+            of obj (e.g. utils.KEY_WIDTH[protocol] for an encoded prefix).
+            Default (None) is the legacy behavior of walking getsizeof(obj)
+            bytes, kept to reproduce earlier experiments.
     '''
     if not isinstance(obj, int):
         obj = int.from_bytes(bytes(str(obj), encoding='utf-8'), byteorder='big')
 
     res = FNV_OFFSET_BASIS
+    if width is not None:
+        for byte_chunk in obj.to_bytes(width, byteorder='little'):
+            res ^= byte_chunk
+            res = (res * FNV_PRIME) & 0xFFFFFFFFFFFFFFFF
+        return res
+
     for i in range(getsizeof(obj)): # for each byte
         byte_chunk = (obj>>(8*i)) & 0xff # extract byte
         res ^= byte_chunk
         res *= FNV_PRIME
     return res % (1<<64)
 
+def to_words(keys, width):
+    '''Split (arbitrarily large) int keys into a (len(keys), words) uint64
+        array of little-endian 64-bit words, as expected by hash_fnv_many()
+        for keys wider than 8 bytes.
+    '''
+    words = (width + 7) // 8
+    return np.array([[(key >> (64*w)) & 0xFFFFFFFFFFFFFFFF for w in range(words)]
+                     for key in keys], dtype=np.uint64).reshape(-1, words)
+
+def hash_fnv_many(keys, width=None, instrument=True):
+    '''Vectorized hash_fnv() over a NumPy array of keys, returns a uint64
+        array matching hash_fnv(key, width) key for key.
+
+        keys: uint64 array, or for `width` > 8 a (len(keys), words) array of
+            little-endian 64-bit words (see to_words()).
+        width (int, optional): key width in bytes; None walks the same
+            getsizeof(key) bytes per key as the legacy scalar version.
+        instrument (bool, optional): count the keys in hash_fnv.ncalls
+    '''
+    keys = np.asarray(keys, dtype=np.uint64)
+    if width is not None:
+        return _hash_fnv_fixed_many(keys, width, instrument)
+
+    nbytes = np.full(keys.shape, _INT_SIZES[1])
+    nbytes[keys == 0] = _INT_SIZES[0]
+    nbytes[keys >= (1<<30)] = _INT_SIZES[2]
+    nbytes[keys >= (1<<60)] = _INT_SIZES[3]
+
+    res = np.full(keys.shape, FNV_OFFSET_BASIS, dtype=np.uint64)
+    prime = np.uint64(FNV_PRIME)
+    for i in range(int(nbytes.max(initial=0))): # for each byte
+        # bytes past the 8th are the zero padding of the int object
+        byte_chunk = (keys >> np.uint64(8*i)) & np.uint64(0xff) if i < 8 else np.uint64(0)
+        res = np.where(i < nbytes, (res ^ byte_chunk) * prime, res) # uint64 wraps around
+    if instrument:
+        hash_fnv.ncalls += keys.size # keep per-key invocation stats comparable
+    return res
+
+def _hash_fnv_fixed_many(keys, width, instrument=True):
+    words = keys.reshape(len(keys), -1)
+    res = np.full(len(keys), FNV_OFFSET_BASIS, dtype=np.uint64)
+    prime = np.uint64(FNV_PRIME)
+    for i in range(width): # for each byte
+        if i//8 < words.shape[1]:
+            byte_chunk = (words[:, i//8] >> np.uint64(8*(i%8))) & np.uint64(0xff)
+            res ^= byte_chunk
+        res *= prime # uint64 wraps around
+    if instrument:
+        hash_fnv.ncalls += len(keys)
+    return res
+
 if __name__ == "__main__":
     print(hash_fnv(123))
     print(hash_fnv((1232342342432424242424234234234, 12)))
     print(hash_fnv('abc'))
     print(hash_fnv((121,'joe')))
+
+    keys = [0, 123, 1<<30, 103095992320, (1<<64)-1]
+    print(list(hash_fnv_many(keys)) == [hash_fnv(key) for key in keys]) # => True
+    print(list(hash_fnv_many(keys, 8)) == [hash_fnv(key, 8) for key in keys]) # => True
+
+    # 17-byte keys, e.g. encoded IPv6 (prefix_len, ip) pairs
+    keys = [(128<<128) + (1<<127) + 5, (48<<128) + (0x2001<<112)]
+    print(list(hash_fnv_many(to_words(keys, 17), 17)) ==
+          [hash_fnv(key, 17) for key in keys]) # => True
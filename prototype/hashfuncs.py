@@ -0,0 +1,115 @@
+'''
+Hash families a BloomFilter can be built with (see HASH_FUNCS):
+
+    fnv:            64-bit FNV-1a (fnv.hash_fnv), the original hash
+    multiply_shift: two 32-bit halves, each the high word of a
+                    multiply-add over the key's 64-bit words (Dietzfelbinger)
+    splitmix:       splitmix64 finalizer over a multiply-add of the key's words
+
+Keys are ints, hashed as little-endian 64-bit words: `width` bytes, or
+as many words as the key needs if `width` is None. Leading zero words
+do not change the hash, so batch hashing of to_words() arrays matches.
+'''
+import numpy as np
+from fnv import hash_fnv, hash_fnv_many
+from profiler import count_invocations
+
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+# random odd multipliers, one per 64-bit word of the key (up to 4 words),
+# for the low and high 32-bit halves of the multiply-shift hash
+MS_MULTIPLIERS = [[0x71e31fbb32fc5707, 0xca7431db57d1efb9, 0xff490b4952398d91, 0x35921e2082c0d08f],
+                  [0x110b4d35bb309773, 0x834de953d9402233, 0x88ed3107755b4bed, 0xf730511ad669613d]]
+MS_INCREMENTS = [0x3d0fd7161d7bb4d1, 0x99ce8d43e224caec]
+
+SPLITMIX_GAMMA = 0x9e3779b97f4a7c15
+SPLITMIX_MULTIPLIERS = [0xbf58476d1ce4e5b9, 0x94d049bb133111eb]
+
+def _words(obj, width):
+    '''Split int obj into its little-endian 64-bit words.
+    '''
+    words = (width + 7) // 8 if width is not None else max(1, (obj.bit_length() + 63) // 64)
+    return [(obj >> (64*w)) & MASK64 for w in range(words)]
+
+def _word_columns(keys):
+    '''View a uint64 array of keys, or of to_words() rows, as a list of
+        word columns.
+    '''
+    words = np.asarray(keys, dtype=np.uint64).reshape(len(keys), -1)
+    return [words[:, w] for w in range(words.shape[1])]
+
+@count_invocations
+def hash_multiply_shift(obj, width=None):
+    '''Returns a 64-bit hash of int obj made of two independent 32-bit
+        multiply-shift hashes (h1 in the low half, h2 in the high half).
+    '''
+    res = 0
+    for half in range(2):
+        acc = MS_INCREMENTS[half]
+        for w, word in enumerate(_words(obj, width)):
+            acc += MS_MULTIPLIERS[half][w] * word
+        res |= ((acc & MASK64) >> 32) << (32*half)
+    return res
+
+def hash_multiply_shift_many(keys, width=None, instrument=True):
+    '''Vectorized hash_multiply_shift() over a NumPy array of keys (see
+        fnv.hash_fnv_many() for the layout of `keys` and `instrument`).
+    '''
+    columns = _word_columns(keys)
+    res = np.zeros(len(columns[0]), dtype=np.uint64)
+    for half in range(2):
+        acc = np.full(len(res), MS_INCREMENTS[half], dtype=np.uint64)
+        for w, word in enumerate(columns):
+            acc += np.uint64(MS_MULTIPLIERS[half][w]) * word # uint64 wraps around
+        res |= (acc >> np.uint64(32)) << np.uint64(32*half)
+    if instrument:
+        hash_multiply_shift.ncalls += len(res)
+    return res
+
+@count_invocations
+def hash_splitmix(obj, width=None):
+    '''Returns the splitmix64 finalizer of a multiply-add over the words
+        of int obj: all 64 output bits depend on every input bit, so the
+        two 32-bit halves can serve as independent hashes.
+    '''
+    z = 0
+    for w, word in enumerate(_words(obj, width)):
+        z += (MS_MULTIPLIERS[0][w-1] if w else 1) * word
+    z = (z + SPLITMIX_GAMMA) & MASK64
+    z = ((z ^ (z >> 30)) * SPLITMIX_MULTIPLIERS[0]) & MASK64
+    z = ((z ^ (z >> 27)) * SPLITMIX_MULTIPLIERS[1]) & MASK64
+    return z ^ (z >> 31)
+
+def hash_splitmix_many(keys, width=None, instrument=True):
+    '''Vectorized hash_splitmix() over a NumPy array of keys (see
+        fnv.hash_fnv_many() for the layout of `keys` and `instrument`).
+    '''
+    columns = _word_columns(keys)
+    z = columns[0].copy()
+    for w, word in enumerate(columns[1:]):
+        z += np.uint64(MS_MULTIPLIERS[0][w]) * word # uint64 wraps around
+    z += np.uint64(SPLITMIX_GAMMA)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(SPLITMIX_MULTIPLIERS[0])
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(SPLITMIX_MULTIPLIERS[1])
+    if instrument:
+        hash_splitmix.ncalls += len(z)
+    return z ^ (z >> np.uint64(31))
+
+# name -> (scalar hash, batch hash, whether h2 for double hashing is the
+# high 32-bit half shifted down); FNV keeps the original unshifted high
+# word, to reproduce earlier experiments
+HASH_FUNCS = {'fnv': (hash_fnv, hash_fnv_many, False),
+              'multiply_shift': (hash_multiply_shift, hash_multiply_shift_many, True),
+              'splitmix': (hash_splitmix, hash_splitmix_many, True)}
+
+if __name__ == "__main__":
+    from fnv import to_words
+    keys = [0, 123, 1<<30, 103095992320, (1<<64)-1]
+    for name, (scalar, batch, _) in HASH_FUNCS.items():
+        print(name, list(batch(keys, 8)) == [scalar(key, 8) for key in keys]) # => True
+
+    # 17-byte keys, e.g. encoded IPv6 (prefix_len, ip) pairs
+    keys = [(128<<128) + (1<<127) + 5, (48<<128) + (0x2001<<112), 7]
+    for name, (scalar, batch, _) in list(HASH_FUNCS.items())[1:]:
+        print(name, list(batch(to_words(keys, 17), 17)) ==
+              [scalar(key, 17) for key in keys] == [scalar(key) for key in keys]) # => True
@@ -5,10 +5,38 @@ a guided BloomFilter that exposes the following API:
 
     build_bloom_filter(protocol='v4', lamda=None, fpp=FPP, k=None,
                         num_bits=None, fib=None,
-                        prefixes=None, pref_stats=None)
+                        prefixes=None, pref_stats=None, legacy_hash=False,
+                        backend=BloomFilter, partition=None, traffic=None,
+                        workers=None, hash_func='fnv', plan=None,
+                        instrument=True, next_hops=None, bmp_bits=None,
+                        bmp_check=None)
 
     lookup_in_bloom(bf, traffic, fib, root=None, maxx=None, minn=None,
-                        ix2len=None, protocol='v4')
+                        ix2len=None, protocol='v4', cache=None, fallback='linear',
+                        latency=None)
+
+    lookup_batch(bf, ips, fib, root, maxx, minn, ix2len, protocol='v4')
+
+    lookup_stream(bf, traffic, fib, root=None, maxx=None, minn=None,
+                        ix2len=None, protocol='v4', chunk_size=CHUNK_SIZE,
+                        per_ip=False)
+
+    withdraw_prefix(bf, prefix, preflen, root=None, fib=None, protocol='v4')
+
+    RouteCache(capacity, prefixes=None, aggregate=None, protocol='v4', instrument=True)
+
+    GuidedFilter(pref_stats, root, fib, ...).announce(prefix, preflen)
+                                            .withdraw(prefix, preflen)
+
+    HybridFilter(pref_stats, fib, stride=16, ...).lookup(ip)
+
+    AdaptiveFilter(pref_stats, fib, interval=REBUILD_INTERVAL, ...).lookup(ip)
+                                                                 .maybe_rebuild()
+
+    SearchPlan.compile(root, protocol='v4'), SearchPlan.load(fpath)
+
+    Guided search walks a SearchPlan, the bin search tree from obst()
+    compiled into flat arrays; lookups accept either.
 
     The lookup can perform linear or guided search and compile stats (in progress).
 '''
@@ -17,16 +45,40 @@ from mconf import *
 for d in [DATADIR]:
     sys.path.append(d)
 
-from bloomfilter import BloomFilter
+from bloomfilter import BloomFilter, CountingBloomFilter, PartitionedBloomFilter
+from fnv import to_words
 from random import shuffle
+from bisect import bisect_left, insort
+from functools import partial
+from ipaddress import IPv4Network, IPv6Network
+from math import log, ceil
+from itertools import islice
+from time import perf_counter_ns
+from array import array
+import json
+from multiprocessing import Pool
+import numpy as np
 from obst import *
-from utils import encode_ip_prefix_pair, load_prefixes, prefix_stats
-from profiler import count_invocations
+from utils import encode_ip_prefix_pair, load_prefixes, prefix_stats, intern_next_hops,\
+                    KEY_WIDTH, ENCODING as KEY_SHIFT
+from profiler import count_invocations, instrumented, Progress
 
 ENCODING={'v4':5,'v6':7} # min num bits to encode prefix length
 NUMBITS={'v4':32,'v6':128}
 
 FPP = 1e-6 # false positive probability setting for Bloom filter
+MIN_BITS_PER_KEY = 1 # floor for the sub-filters of a partitioned Bloom filter
+CHUNK_SIZE = 4096 # IPs per chunk of a streaming lookup
+AGGREGATE = {'v4':24, 'v6':48} # prefix length of route cache keys covering many IPs
+FALLBACKS = ('linear', 'backtrack', 'likely') # searches after a BMP fails to verify
+REBUILD_INTERVAL = 100000 # lookups between two recomputations of an AdaptiveFilter's tree
+# search paths a lookup's latency is recorded under: guided to the default
+# route, BMP decoded and verified, fallback search, linear search, cache hit
+LATENCY_PATHS = ('default', 'bmp', 'fallback', 'linear', 'cache')
+# check bits after a BMP pointer: none, even parity, or (Berger code) the
+# count of zero bits of the pointer -- a Bloom filter only ever sets bits
+# wrongly, which lowers that count, so it catches any number of them
+BMP_CHECKS = (None, 'parity', 'berger')
 
 def _choose_hash_funcs(start, end=None, pattern=None):
     '''Generate and return a list/generator of hash functions to use,
@@ -47,88 +99,609 @@ def _choose_hash_funcs(start, end=None, pattern=None):
         pattern >>= 1
     return res
 
-def _build_linear_bloom(prefixes, fpp, k, num_bits, protocol='v4'):
+def bmp_width(ix2len):
+    '''Returns the fewest bits that hold a BMP pointer into `ix2len` and
+        leave the all-ones pointer (the hit is itself the BMP) free.
+    '''
+    return len(ix2len).bit_length()
+
+def _check_bmp_layout(bf, root, protocol='v4'):
+    '''Raise ValueError if a BMP pointer of `bf` read at the deepest hit
+        along SearchPlan `root` runs past its k hash funcs.
+    '''
+    bits, check, width = _bmp_layout(bf, protocol)
+    if _deepest_hit(root) + bits + width > bf.k:
+        raise ValueError('%d hash funcs do not hold a %d bit BMP pointer (%d check bits) after'
+                         ' %d hits, use k >= %d' %(bf.k, bits, width, _deepest_hit(root),
+                                                   _deepest_hit(root) + bits + width))
+
+def _deepest_hit(root):
+    '''Returns the most hits a lookup can count along SearchPlan `root`:
+        the markers on the way down to a node, and the node itself.
+    '''
+    return max((len(root.paths[val][0]) + 1 for val in root.vals), default=0)
+
+def bmp_min_k(root, ix2len, bmp_check=None):
+    '''Returns the fewest hash funcs that hold a bmp_width(ix2len) wide
+        BMP pointer and its `bmp_check` bits at every hit along SearchPlan
+        `root`, i.e. the least k to build with bmp_bits='auto'.
+    '''
+    bits = bmp_width(ix2len)
+    return _deepest_hit(root) + bits + _check_width(bits, bmp_check)
+
+def _check_width(bits, check):
+    '''Number of check bits after a `bits` wide BMP pointer.
+    '''
+    if check is None: return 0
+    return 1 if check == 'parity' else bits.bit_length()
+
+def _bmp_layout(bf, protocol='v4'):
+    '''Returns the width of the BMP pointers in `bf` (ENCODING unless
+        built with bmp_bits), its check (one of BMP_CHECKS) and check width.
+    '''
+    bits = getattr(bf, 'bmp_bits', None) or ENCODING[protocol]
+    check = getattr(bf, 'bmp_check', None)
+    return bits, check, _check_width(bits, check)
+
+def _bmp_codeword(bmp, bits, check):
+    '''Returns the pattern of hash funcs (see _choose_hash_funcs()) that
+        encodes BMP pointer `bmp`, `bits` wide, followed by its check bits.
+    '''
+    if check == 'parity':
+        return bmp | (bin(bmp).count('1') & 1) << bits
+    if check == 'berger':
+        return bmp | (bits - bin(bmp).count('1')) << bits
+    return bmp
+
+def _bmp_decode(word, bits, check, width):
+    '''Returns the BMP pointer in `word` as read from the filter over
+        bits+width hash funcs, all ones if it is all ones (a prefix sets
+        all its hash funcs), or None if the check bits do not match.
+    '''
+    bmp = word & ((1<<bits) - 1)
+    if check is None or word == (1<<(bits+width)) - 1:
+        return bmp
+    return bmp if _bmp_codeword(bmp, bits, check) == word else None
+
+def _bmp_decode_many(words, bits, check, width):
+    '''Vectorized _bmp_decode() of a uint64 array of `words`. Returns the
+        BMP pointers and a bool array, whether the check bits match.
+    '''
+    bmp = words & np.uint64((1<<bits) - 1)
+    if check is None:
+        return bmp, np.ones(len(words), dtype=bool)
+    codewords = np.array([_bmp_codeword(ix, bits, check) for ix in range(1<<bits)], dtype=np.uint64)
+    return bmp, (codewords[bmp.astype(np.int64)] == words) | (words == np.uint64((1<<(bits+width)) - 1))
+
+def _new_bloom_filter(prefixes, fpp, k, num_bits, protocol='v4', legacy_hash=False,
+                      backend=BloomFilter, hash_func='fnv', instrument=True):
+    '''Returns an empty `backend` Bloom filter sized for `prefixes`, hashing
+        keys with `hash_func` at their fixed width unless `legacy_hash` is set.
+    '''
+    width = None if legacy_hash else KEY_WIDTH[protocol]
     if not (k or num_bits):
-        bf = BloomFilter(fpp, len(prefixes['prefixes']))
-    else:
-        bf = BloomFilter(fpp, len(prefixes['prefixes']), k=k, num_bits=num_bits)
+        return backend(fpp, len(prefixes['prefixes']), width=width, hash_func=hash_func,
+                       instrument=instrument)
+    return backend(fpp, len(prefixes['prefixes']), k=k, num_bits=num_bits,
+                   width=width, hash_func=hash_func, instrument=instrument)
 
-    count = 0
-    for pair in prefixes['prefixes']:
-        if count % 10000 == 0:
-            print('build processsed %.3f of all prefixes' %(count/len(prefixes['prefixes'])))
-        count += 1
+def _build_linear_bloom(prefixes, fpp, k, num_bits, protocol='v4', legacy_hash=False,
+                        backend=BloomFilter, hash_func='fnv', instrument=True):
+    bf = _new_bloom_filter(prefixes, fpp, k, num_bits, protocol, legacy_hash, backend,
+                           hash_func, instrument)
 
+    progress = Progress('build processsed %.3f of all prefixes', len(prefixes['prefixes']))\
+                if instrument else None
+    for count, pair in enumerate(prefixes['prefixes']):
+        if progress: progress(count)
         bf.insert(encode_ip_prefix_pair(*pair, protocol), hashes=_choose_hash_funcs(0,end=bf.k))
 
     return bf, None
 
-def _find_bmp(prefix, bf, root, fib, max_pref_len, minn, len2ix, ix2len, protocol='v4'):
-    '''Look up the best matching prefix (BMP) among the ones previously
-        entered in the Bloom filter (hence, insert prefixes
-        into BF in ascending order).
+def _build_guided_bloom(prefixes, fpp, k, num_bits, root, fib, protocol='v4',
+                        legacy_hash=False, backend=BloomFilter, workers=None,
+                        hash_func='fnv', instrument=True, next_hops=None, bmp_bits=None,
+                        bmp_check=None):
+    '''Returns a Bloom filer optimized for the `root` bin search tree,
+        and the tree compiled into a SearchPlan.
+
+        Built in two phases: the exact table of unique keys (prefixes and
+        markers with their BMP pointers) is resolved first without touching
+        the filter (see _marker_table()), then bulk-inserted. If `workers`
+        is set, the inserts run in parallel (see _build_guided_parallel()).
+
+        With `next_hops` (dict: encoded prefix -> next hop), every prefix
+        also encodes the index of its next hop into bf.hops as a pattern
+        over hash funcs k..k+bf.hop_bits-1, the way markers encode their
+        BMP pointer; the all-ones pattern is left invalid and marks a
+        prefix without a next hop. Lookups then verify the BMP with all k
+        hash funcs, but still confirm it and its next hop in the FIB.
 
-        Returns best matching prefix length (encoded as int for prefixes['ix2len'] lookup)
-        or 0 if not found (default route).
+        BMP pointers are `bmp_bits` wide (default ENCODING[protocol], or
+        'auto' for the widest the k hash funcs hold, at least bmp_width()
+        of the prefix lengths) and followed by `bmp_check` bits (one of
+        BMP_CHECKS), which lookups test before trusting the pointer. The
+        wider the pointer, the fewer corrupt pointers decode to a prefix
+        length. Raises ValueError unless the pointer of the deepest hit
+        still ends within the k hash funcs (see bmp_min_k()), as a prefix
+        must read back the all-ones pointer.
     '''
-    preflen, fib_val, _ = _guided_lookup_helper(
-                bf, root, prefix, fib, max_pref_len, minn, ix2len, protocol)
-    return len2ix[preflen], fib_val
+    root = _as_plan(root, protocol)
+    bf = _new_bloom_filter(prefixes, fpp, k, num_bits, protocol, legacy_hash, backend,
+                           hash_func, instrument)
+    if bmp_check not in BMP_CHECKS:
+        raise ValueError('unknown bmp_check %r, expected one of %s' %(bmp_check, BMP_CHECKS))
+    if bmp_bits == 'auto':
+        bmp_bits = bmp_width(prefixes['ix2len'])
+        while _deepest_hit(root) + bmp_bits+1 + _check_width(bmp_bits+1, bmp_check) <= bf.k:
+            bmp_bits += 1
+    if bmp_bits is not None and bmp_bits < bmp_width(prefixes['ix2len']):
+        raise ValueError('%d bits do not hold a BMP pointer into %d prefix lengths'
+                         %(bmp_bits, len(prefixes['ix2len'])))
+    bf.bmp_bits, bf.bmp_check = bmp_bits, bmp_check
+    _check_bmp_layout(bf, root, protocol)
+    if hasattr(bf, 'remove'):
+        if next_hops is not None:
+            raise ValueError('next hops are only encoded in a static build, not in %s'
+                             %type(bf).__name__)
+        # counting filter: keep the marker table and the route counts
+        # withdraw_prefix() updates
+        return _build_guided_counting(bf, prefixes, root, protocol), root
+    hop_ix = None
+    if next_hops is not None:
+        bf.hops, hop_ix = intern_next_hops(next_hops)
+        bf.hop_bits = len(bf.hops).bit_length() # at least one invalid index
+    table = _marker_table(prefixes, root, protocol, instrument)
+    groups = _group_marker_table(table, bf.k, hop_ix, getattr(bf, 'hop_bits', 0),
+                                 _bmp_layout(bf, protocol)[:2])
+    if workers is not None:
+        return _build_guided_parallel(bf, groups, workers), root
+    _insert_groups(bf, groups)
+    return bf, root
 
-def _build_guided_bloom(prefixes, fpp, k, num_bits, root, fib, protocol='v4'):
-    '''Returns a Bloom filer optimized for the `root` bin search tree,
-        and `encoded_pref_lens` dict for looking up the BMP prefix length
-        from hash-encoded bit sequence.
+def _marker_table(prefixes, root, protocol='v4', instrument=True):
+    '''Phase one of the guided build. Returns dict: encoded key -> BMP
+        pointer, where a key is either a prefix (pointer None, inserted with
+        all k hash funcs) or a marker on the `root` path of some longer
+        prefix, stored once however many prefixes share it. A marker points
+        at (count_hit, index into ix2len of) the longest prefix covering the
+        marker itself, found with a stack of covering prefixes over the keys
+        in address order, so no pointer depends on the filter's answers.
     '''
     max_shift = NUMBITS[protocol]
+    plan = _as_plan(root, protocol)
+    nodes = dict() # (prefix, preflen) -> count_hit, or None for a prefix
+    progress = Progress('build processsed %.3f of all prefixes', len(prefixes['prefixes']))\
+                if instrument else None
+    for count, (prefix, preflen) in enumerate(prefixes['prefixes']):
+        if progress: progress(count)
 
-    if not (k or num_bits):
-        bf = BloomFilter(fpp, len(prefixes['prefixes']))
+        markers, found = plan.paths[preflen]
+        # count_hit is the same for every key at a node
+        for count_hit, node in enumerate(markers, 1):
+            nodes.setdefault((prefix & plan.masks[node], plan.vals[node]), count_hit)
+        if found:
+            nodes[(prefix, preflen)] = None
+
+    table = dict()
+    stack = [] # prefixes covering the current key, shortest first
+    for prefix, preflen in sorted(nodes):
+        # in address order a covering prefix comes before, and stays
+        # on the stack up to, every key it covers
+        while stack and (prefix ^ stack[-1][0]) >> (max_shift-stack[-1][1]):
+            stack.pop()
+        count_hit = nodes[(prefix, preflen)]
+        pref_encoded = encode_ip_prefix_pair(prefix, preflen, protocol)
+        if count_hit is None:
+            table[pref_encoded] = None
+            stack.append((prefix, preflen))
+        else:
+            bmp = prefixes['len2ix'][stack[-1][1]] if stack else 0
+            table[pref_encoded] = (count_hit, bmp)
+    return table
+
+def _table_hashes(pointer, k, layout=None):
+    '''Returns the hash funcs (tuple) to insert a marker table entry with:
+        all k for a prefix (`pointer` None), else the first and the pattern
+        of its BMP pointer. `layout` is the (width, check) of the BMP
+        pointers, if checked (see _bmp_layout()).
+    '''
+    if pointer is None:
+        return tuple(_choose_hash_funcs(0, end=k))
+    bmp = pointer[1] if layout is None else _bmp_codeword(pointer[1], *layout)
+    return (0,) + tuple(_choose_hash_funcs(pointer[0], pattern=bmp))
+
+def _group_marker_table(table, k, hop_ix=None, hop_bits=0, layout=None):
+    '''Return dict: tuple of hash funcs -> list of keys in `table` to
+        insert with them, i.e. one group per distinct pointer pattern.
+        `hop_ix` optionally maps prefixes to the next hop index to encode
+        after their k hash funcs in `hop_bits` bits. `layout` is the
+        (width, check) of the BMP pointers, if checked (see _bmp_layout()).
+    '''
+    groups = dict()
+    invalid = (1<<hop_bits) - 1
+    for pref_encoded, pointer in table.items():
+        hashes = _table_hashes(pointer, k, layout)
+        if pointer is None and hop_ix is not None:
+            hashes += tuple(_choose_hash_funcs(k, pattern=hop_ix.get(pref_encoded, invalid)))
+        groups.setdefault(hashes, []).append(pref_encoded)
+    return groups
+
+def _insert_groups(bf, groups):
+    '''Phase two of the guided build: insert every key once, one batch
+        per group when the backend hashes fixed-width keys in bulk.
+    '''
+    for hashes, keys in groups.items():
+        if hasattr(bf, 'insert_many') and bf.width is not None:
+            bf.insert_many(to_words(keys, bf.width), hashes=list(hashes))
+        else:
+            for key in keys:
+                bf.insert(key, hashes=list(hashes))
+
+def _build_guided_counting(bf, prefixes, root, protocol='v4'):
+    '''Fill the counting filter `bf` from the exact marker table, like the
+        static build, and keep what _announce_guided() and _withdraw_guided()
+        update: the table (bf.table), the count of routes leaving each
+        marker (bf.refs), the routes in address order (bf.routes), their
+        encoded keys (bf.route_keys) and the prefix length indices
+        (bf.ix2len, bf.len2ix).
+    '''
+    root = _as_plan(root, protocol)
+    bf.table = _marker_table(prefixes, root, protocol, bf.instrument)
+    bf.refs = dict()
+    for prefix, preflen in prefixes['prefixes']:
+        for key, _ in _path_markers(prefix, preflen, root, protocol):
+            bf.refs[key] = bf.refs.get(key, 0) + 1
+    bf.routes = sorted(prefixes['prefixes'])
+    bf.route_keys = set(encode_ip_prefix_pair(prefix, preflen, protocol)
+                        for prefix, preflen in bf.routes)
+    bf.ix2len, bf.len2ix = prefixes['ix2len'], prefixes['len2ix']
+    _insert_groups(bf, _group_marker_table(bf.table, bf.k, layout=_bmp_layout(bf, protocol)[:2]))
+    return bf
+
+def _path_markers(prefix, preflen, root, protocol='v4'):
+    '''Return the (encoded marker, count_hit) pairs a prefix leaves on
+        its way down the `root` plan.
+    '''
+    markers, _ = root.paths[preflen]
+    return [(encode_ip_prefix_pair(prefix & root.masks[node], root.vals[node], protocol), count_hit)
+            for count_hit, node in enumerate(markers, 1)]
+
+def _marker_pointer(bf, prefix, preflen, root, protocol='v4'):
+    '''Returns the (count_hit, BMP) pointer of the marker (`prefix`,
+        `preflen`) in the counting filter `bf`: a marker at a node is hit
+        after that node's own markers, and points at the longest route
+        shorter than itself covering it.
+    '''
+    count_hit = len(root.paths[preflen][0]) + 1
+    return count_hit, _exact_bmp(prefix, preflen, bf.route_keys, bf.ix2len, bf.len2ix, protocol)
+
+def _set_entry(bf, key, pointer, protocol='v4'):
+    '''Make `pointer` (None for a prefix) the marker table entry of `key`
+        in the counting filter `bf`, or drop the entry if `pointer` is
+        False, removing and inserting only what changes.
+    '''
+    layout = _bmp_layout(bf, protocol)[:2]
+    old = bf.table.get(key, False)
+    if old == pointer: return
+    if old is not False:
+        bf.remove(key, hashes=list(_table_hashes(old, bf.k, layout)))
+        del bf.table[key]
+    if pointer is not False:
+        bf.insert(key, hashes=list(_table_hashes(pointer, bf.k, layout)))
+        bf.table[key] = pointer
+
+def _more_specific(routes, prefix, preflen, protocol='v4'):
+    '''Return the routes in `routes` (sorted) strictly inside (`prefix`, `preflen`).
+    '''
+    span = 1 << (NUMBITS[protocol]-preflen)
+    return routes[bisect_left(routes, (prefix, preflen+1)):bisect_left(routes, (prefix+span, 0))]
+
+def _markers_inside(bf, prefix, preflen, root, protocol='v4'):
+    '''Return the marker entries strictly inside (`prefix`, `preflen`),
+        i.e. those the routes inside it leave below `preflen`.
+    '''
+    markers = set()
+    for sub, sublen in _more_specific(bf.routes, prefix, preflen, protocol):
+        for node in root.paths[sublen][0]:
+            if root.vals[node] > preflen:
+                markers.add((sub & root.masks[node], root.vals[node]))
+    return [(marker, pref_len) for marker, pref_len in sorted(markers)
+            if bf.table[encode_ip_prefix_pair(marker, pref_len, protocol)] is not None]
+
+def _announce_guided(bf, prefix, preflen, root, protocol='v4'):
+    '''Add route (`prefix`, `preflen`) to the counting filter `bf` built by
+        _build_guided_counting(): insert its markers not there yet and the
+        route itself, and re-point the markers inside it whose BMP it becomes.
+    '''
+    root = _as_plan(root, protocol)
+    pref_encoded = encode_ip_prefix_pair(prefix, preflen, protocol)
+    bf.route_keys.add(pref_encoded)
+    insort(bf.routes, (prefix, preflen))
+    for (key, _), node in zip(_path_markers(prefix, preflen, root, protocol),
+                              root.paths[preflen][0]):
+        bf.refs[key] = bf.refs.get(key, 0) + 1
+        if key not in bf.table:
+            marker = prefix & root.masks[node]
+            _set_entry(bf, key, _marker_pointer(bf, marker, root.vals[node], root, protocol),
+                       protocol)
+    _set_entry(bf, pref_encoded, None, protocol)
+    for marker, pref_len in _markers_inside(bf, prefix, preflen, root, protocol):
+        key = encode_ip_prefix_pair(marker, pref_len, protocol)
+        count_hit, bmp = bf.table[key]
+        if bmp < bf.len2ix[preflen]:
+            _set_entry(bf, key, (count_hit, bf.len2ix[preflen]), protocol)
+
+def _withdraw_guided(bf, prefix, preflen, root, protocol='v4'):
+    '''Remove route (`prefix`, `preflen`) from the counting filter `bf`
+        built by _build_guided_counting(): the route becomes a plain marker
+        if other routes leave one there, its markers no route leaves any
+        more go, and the markers inside it that pointed at it point at its
+        own BMP instead.
+    '''
+    root = _as_plan(root, protocol)
+    pref_encoded = encode_ip_prefix_pair(prefix, preflen, protocol)
+    bf.route_keys.remove(pref_encoded)
+    del bf.routes[bisect_left(bf.routes, (prefix, preflen))]
+    bmp = _marker_pointer(bf, prefix, preflen, root, protocol)
+    _set_entry(bf, pref_encoded, bmp if bf.refs.get(pref_encoded) else False, protocol)
+    for key, _ in _path_markers(prefix, preflen, root, protocol):
+        bf.refs[key] -= 1
+        if not bf.refs[key]:
+            del bf.refs[key]
+            if bf.table[key] is not None: # unless a route itself
+                _set_entry(bf, key, False, protocol)
+    for marker, pref_len in _markers_inside(bf, prefix, preflen, root, protocol):
+        key = encode_ip_prefix_pair(marker, pref_len, protocol)
+        count_hit, old = bf.table[key]
+        if old == bf.len2ix[preflen]:
+            _set_entry(bf, key, (count_hit, bmp[1]), protocol)
+
+def _exact_bmp(prefix, preflen, routes, ix2len, len2ix, protocol='v4'):
+    '''Return index (into ix2len) of the longest route in `routes` (encoded
+        prefixes) shorter than `preflen` covering `prefix`, or 0 if none.
+    '''
+    max_shift = NUMBITS[protocol]
+    for ix in range(len2ix[preflen]-1, 0, -1):
+        pref_len = ix2len[ix]
+        masked = (((1<<max_shift) - 1) << (max_shift-pref_len)) & prefix
+        if encode_ip_prefix_pair(masked, pref_len, protocol) in routes:
+            return ix
+    return 0
+
+def _build_guided_parallel(bf, groups, workers):
+    '''Fill the empty Bloom filter `bf` from the grouped marker table with a
+        pool of `workers` processes. No insert depends on an earlier one, so
+        each worker sets the bits of a slice of every group in its own bit
+        array, and OR-ing the arrays gives the same filter as the serial
+        build (`workers`==1).
+    '''
+    if not hasattr(bf, 'ba'):
+        raise ValueError('parallel build needs a plain bit array backend, not %s'
+                         %type(bf).__name__)
+    num_tasks = 4*workers # a few tasks per worker to balance load
+    params = (type(bf), bf.num_elements, bf.k, bf.num_bits, bf.width, bf.hash_func,
+              bf.instrument)
+    tasks = [params + ({hashes: keys[i::num_tasks] for hashes, keys in groups.items()},)
+             for i in range(num_tasks)]
+
+    buf = bf._buffer()
+    if workers == 1:
+        for bits in map(_build_guided_chunk, tasks):
+            buf |= np.frombuffer(bits, dtype=np.uint8)
+        return bf
+    with Pool(workers) as pool:
+        for bits in pool.imap_unordered(_build_guided_chunk, tasks):
+            buf |= np.frombuffer(bits, dtype=np.uint8)
+    return bf
+
+def _build_guided_chunk(task):
+    '''Pool worker: return the bit array (bytes) of an empty filter with
+        the slice of grouped keys in `task` inserted.
+    '''
+    backend, n, k, num_bits, width, hash_func, instrument, groups = task
+    bf = backend(None, n, k=k, num_bits=num_bits, width=width, hash_func=hash_func,
+                 instrument=instrument)
+    _insert_groups(bf, groups)
+    return bf.ba.tobytes()
+
+class SearchPlan:
+    '''Bin search tree (e.g. from obst()) compiled into parallel lists,
+        nodes breadth first with the root at index 0: prefix length `vals`,
+        left and right child indices `lefts` and `rights` (-1 if none) and
+        netmask `masks` of each node. `paths[preflen]` lists the nodes a
+        prefix of that length leaves markers at on its way down, and
+        whether it then ends at a node of its own.
+
+        Plans can be saved and loaded (JSON) to skip re-running obst().
+    '''
+    def __init__(self, vals, lefts, rights, protocol='v4'):
+        max_shift = NUMBITS[protocol]
+        self.protocol = protocol
+        self.vals = [int(val) for val in vals]
+        self.lefts = [int(left) for left in lefts]
+        self.rights = [int(right) for right in rights]
+        self.masks = [(((1<<max_shift) - 1) << (max_shift-val)) & ((1<<max_shift) - 1)
+                      for val in self.vals]
+        self.paths = []
+        for preflen in range(max_shift+1):
+            markers, node = [], 0 if self.vals else -1
+            while node >= 0 and self.vals[node] != preflen:
+                if preflen < self.vals[node]:
+                    node = self.lefts[node]
+                else: # preflen > vals[node]
+                    markers.append(node)
+                    node = self.rights[node]
+            self.paths.append((markers, node >= 0))
+
+    @classmethod
+    def compile(cls, root, protocol='v4'):
+        '''Returns the plan of bin search tree `root` (obst.Node).
+        '''
+        nodes = [root] if root else []
+        for node in nodes: # breadth first, appending children as we go
+            nodes.extend(child for child in (node.left, node.right) if child)
+        index = {id(node): ix for ix, node in enumerate(nodes)}
+        return cls([node.val for node in nodes],
+                   [index[id(node.left)] if node.left else -1 for node in nodes],
+                   [index[id(node.right)] if node.right else -1 for node in nodes],
+                   protocol)
+
+    def to_tree(self):
+        '''Returns the root obst.Node of the tree (None if empty).
+        '''
+        nodes = [Node(val) for val in self.vals]
+        for node, left, right in zip(nodes, self.lefts, self.rights):
+            node.left = nodes[left] if left >= 0 else None
+            node.right = nodes[right] if right >= 0 else None
+        return nodes[0] if nodes else None
+
+    def levels(self):
+        '''Return dict: prefix length -> depth of its node.
+        '''
+        depths = [0] * len(self.vals)
+        for node in range(len(self.vals)): # parents come before children
+            for child in (self.lefts[node], self.rights[node]):
+                if child >= 0: depths[child] = depths[node] + 1
+        return dict(zip(self.vals, depths))
+
+    def save(self, fpath):
+        with open(fpath, 'w') as outfile:
+            json.dump({'protocol': self.protocol, 'vals': self.vals,
+                       'lefts': self.lefts, 'rights': self.rights}, outfile)
+
+    @classmethod
+    def load(cls, fpath):
+        with open(fpath, 'r') as infile:
+            plan = json.load(infile)
+        return cls(plan['vals'], plan['lefts'], plan['rights'], plan['protocol'])
+
+def _as_plan(root, protocol='v4'):
+    '''Return bin search tree `root` as a SearchPlan (as is if it is one).
+    '''
+    if isinstance(root, SearchPlan): return root
+    return SearchPlan.compile(root, protocol)
+
+def _tree_keys(prefixes, root, protocol='v4'):
+    '''Return dict: prefix length -> set of keys (prefixes and markers)
+        the guided build inserts at the node of that length.
+    '''
+    plan = _as_plan(root, protocol)
+    keys = {pref_len: set() for pref_len in plan.vals}
+    for prefix, preflen in prefixes:
+        markers, found = plan.paths[preflen]
+        for node in markers:
+            keys[plan.vals[node]].add(
+                encode_ip_prefix_pair(prefix & plan.masks[node], plan.vals[node], protocol))
+        if found:
+            keys[preflen].add(encode_ip_prefix_pair(prefix, preflen, protocol))
+    return keys
+
+def _tree_reach(keys, root, traffic, protocol='v4'):
+    '''Return dict: prefix length -> average number of probes per IP at the
+        node of that length, walking `traffic` down `root` with the exact
+        (false positive free) key sets from _tree_keys().
+    '''
+    plan = _as_plan(root, protocol)
+    reach = dict.fromkeys(keys, 0)
+    for ip in traffic:
+        node = 0 if plan.vals else -1
+        while node >= 0:
+            pref_len = plan.vals[node]
+            reach[pref_len] += 1
+            if encode_ip_prefix_pair(ip & plan.masks[node], pref_len, protocol) in keys[pref_len]:
+                node = plan.rights[node]
+            else:
+                node = plan.lefts[node]
+    return {pref_len: count/max(1, len(traffic)) for pref_len, count in reach.items()}
+
+def _allocate_bits(counts, reach, num_bits):
+    '''Split `num_bits` between groups of `counts` keys probed `reach` times
+        per lookup, minimizing the expected false positives per lookup
+        sum(reach_j * fpp_j) with fpp_j ~ exp(-ln(2)**2 * m_j/n_j), i.e.
+
+            m_j = n_j/ln(2)**2 * (ln(ln(2)**2 * reach_j/n_j) + alpha)
+
+        with alpha such that sum(m_j) == num_bits. Groups that would get
+        fewer than MIN_BITS_PER_KEY bits per key are pinned to that floor.
+    '''
+    c = log(2)**2
+    pinned = set(j for j in range(len(counts)) if reach[j] <= 0 or counts[j] == 0)
+    while True:
+        free = [j for j in range(len(counts)) if j not in pinned]
+        budget = num_bits - sum(max(1, MIN_BITS_PER_KEY*counts[j]) for j in pinned)
+        if not free: break
+        alpha = (c*budget - sum(counts[j]*log(c*reach[j]/counts[j]) for j in free))\
+                    / sum(counts[j] for j in free)
+        bits = {j: counts[j]/c * (log(c*reach[j]/counts[j]) + alpha) for j in free}
+        short = [j for j in free if bits[j] < MIN_BITS_PER_KEY*counts[j]]
+        if not short: break
+        pinned.update(short)
+    return [max(1, MIN_BITS_PER_KEY*counts[j]) if j in pinned else ceil(bits[j])
+            for j in range(len(counts))]
+
+def _new_partitioned_filter(fpp, n, k=None, num_bits=None, width=None, hash_func='fnv',
+                            instrument=True, prefixes=None, root=None, protocol='v4',
+                            partition='level', traffic=None):
+    '''Returns an empty PartitionedBloomFilter with one sub-filter per level
+        (`partition`=='level') or per prefix length (=='length') of `root`,
+        each sized from its key count and how often `traffic` (sample of
+        IPs, uniform if None) reaches it. Signature follows BloomFilter so it
+        can serve as a `backend` once the keyword args are bound.
+    '''
+    keys = _tree_keys(prefixes['prefixes'], root, protocol)
+    reach = _tree_reach(keys, root, traffic, protocol) if traffic else dict.fromkeys(keys, 1.0)
+    if partition == 'level':
+        groups = _as_plan(root, protocol).levels()
     else:
-        bf = BloomFilter(fpp, len(prefixes['prefixes']), k=k, num_bits=num_bits)
+        groups = {pref_len: ix for ix, pref_len in enumerate(sorted(keys))}
 
-    count = 0 # report progress
-    for pair in prefixes['prefixes']:
-        if count % 10000 == 0:
-            print('build processsed %.3f of all prefixes' %(count/len(prefixes['prefixes'])))
-        count += 1
+    counts, reached = [0]*(max(groups.values())+1), [0.0]*(max(groups.values())+1)
+    for pref_len, group in groups.items():
+        counts[group] += len(keys[pref_len])
+        reached[group] += reach[pref_len]
+    total = sum(counts)
+    if num_bits is None: # same total size as a single filter holding all keys
+        if k is None:
+            num_bits = ceil(-total * log(fpp) / ((log(2))**2))
+        else:
+            num_bits = ceil(-(k * total) / (log(1-(fpp)**(1./k))))
+    if k is None:
+        k = max(1, round(num_bits/total * log(2)))
 
-        prefix, preflen = pair
-        # BMP is an index, can recover prefix length using prefixes['ix2len']
-        bmp, fib_val = _find_bmp(prefix, bf, root, fib, preflen-1, prefixes['minn'],
-                        prefixes['len2ix'], prefixes['ix2len'],
-                        protocol=protocol)
-
-        current = root
-        count_hit = 0
-        while current:
-            if preflen < current.val:
-                current = current.left
-            elif preflen == current.val:
-                # insert using hash_1..hash_k
-                pref_encoded = encode_ip_prefix_pair(prefix, preflen, protocol)
-                bf.insert(pref_encoded, hashes=_choose_hash_funcs(0,end=bf.k))
-                break
-            else: # preflen > current.val
-                masked = (((1<<max_shift) - 1) << (max_shift-current.val)) & prefix
-                pref_encoded = encode_ip_prefix_pair(masked, current.val, protocol)
-                bf.insert(pref_encoded, hashes=_choose_hash_funcs(0,end=1))
-                count_hit += 1
-                # insert pointers
-                bf.insert(pref_encoded,
-                          hashes=_choose_hash_funcs(count_hit,
-                                                    pattern=bmp))
-                current = current.right
-    return bf, root
+    filters = [BloomFilter(fpp, count, k=k, num_bits=bits, width=width, hash_func=hash_func,
+                           instrument=instrument)
+               for count, bits in zip(counts, _allocate_bits(counts, reached, num_bits))]
+    return PartitionedBloomFilter(filters, groups, KEY_SHIFT[protocol])
 
 def build_bloom_filter(protocol='v4', lamda=None, fpp=FPP, k=None, 
                        num_bits=None, fib=None, prefixes=None, 
-                       pref_stats=None):
+                       pref_stats=None, legacy_hash=False, backend=BloomFilter,
+                       partition=None, traffic=None, workers=None, hash_func='fnv',
+                       plan=None, instrument=True, next_hops=None, bmp_bits=None,
+                       bmp_check=None):
     '''Build and return a Bloom filter containing all prefixes.
-        If provided with `lamda`, return also the optimal binary search tree.
+        If provided with `lamda`, return also the optimal binary search tree,
+        compiled into a SearchPlan; or pass a `plan` (e.g. SearchPlan.load())
+        to build for that tree without re-running obst().
+        Set `legacy_hash` to reproduce experiments run with the original
+        getsizeof()-wide FNV hash. `backend` is the Bloom filter class to
+        use, e.g. bloomfilter.BlockedBloomFilter, and `hash_func` its hash
+        family (see hashfuncs.HASH_FUNCS).
+
+        For guided search, `partition` ('level' or 'length') splits the
+        filter into one sub-filter per level or per node of the search tree,
+        sized by key count and by how often a sample of `traffic` reaches it.
+        `workers` builds the guided filter with a pool of that many processes.
+        Unset `instrument` for a filter whose builds and lookups run without
+        counters or progress reports (see profiler.py). Pass `next_hops`
+        (e.g. utils.load_next_hops()) to encode each prefix's next hop in
+        the guided filter, which lookups check against the FIB; pass
+        the same next hops as `fib`, and `bmp_bits`/`bmp_check` to size
+        and check the BMP pointers (see _build_guided_bloom()).
 
         Returns a pair:
-            (Bloom filter, optionally bin search tree)
+            (Bloom filter, optionally search plan)
     '''
     # [(pref_int, pref_len),...], sorted in ascending order
     if prefixes is None: # default case, setting prefixes only for testing...
@@ -136,13 +709,39 @@ def build_bloom_filter(protocol='v4', lamda=None, fpp=FPP, k=None,
     if pref_stats is None:
         pref_stats = prefix_stats(prefixes)
 
-    if lamda is None: # build for linear search
-        return _build_linear_bloom(pref_stats, fpp, k, num_bits, protocol=protocol)
+    if lamda is None and plan is None: # build for linear search
+        return _build_linear_bloom(pref_stats, fpp, k, num_bits, protocol=protocol,
+                                   legacy_hash=legacy_hash, backend=backend,
+                                   hash_func=hash_func, instrument=instrument)
     else:
-        bst = obst(protocol, lamda)
-        return _build_guided_bloom(pref_stats, fpp, k, num_bits, bst, fib, protocol=protocol)
+        bst = plan if plan is not None else SearchPlan.compile(obst(protocol, lamda), protocol)
+        if partition is not None:
+            backend = partial(_new_partitioned_filter, prefixes=pref_stats, root=bst,
+                              protocol=protocol, partition=partition, traffic=traffic)
+        return _build_guided_bloom(pref_stats, fpp, k, num_bits, bst, fib, protocol=protocol,
+                                   legacy_hash=legacy_hash, backend=backend, workers=workers,
+                                   hash_func=hash_func, instrument=instrument,
+                                   next_hops=next_hops, bmp_bits=bmp_bits, bmp_check=bmp_check)
 
-def _linear_lookup_helper(bf, hashes, ip, maxx, minn, fib, protocol):
+def withdraw_prefix(bf, prefix, preflen, root=None, fib=None, protocol='v4'):
+    '''Withdraw route (`prefix`, `preflen`) from a Bloom filter built with
+        backend=CountingBloomFilter, in O(k) without a rebuild. Pass the
+        `root` a guided filter was built with to also re-point the markers
+        of more specific prefixes that pointed at the withdrawn route, as a
+        rebuild would. Also deletes the route from `fib`.
+    '''
+    pref_encoded = encode_ip_prefix_pair(prefix, preflen, protocol)
+    if root is None:
+        bf.remove(pref_encoded, hashes=_choose_hash_funcs(0, end=bf.k))
+    else:
+        _withdraw_guided(bf, prefix, preflen, root, protocol)
+    if fib is not None and pref_encoded in fib.keys():
+        del fib[pref_encoded]
+
+def _linear_lookup_helper(bf, hashes, ip, maxx, minn, fib, protocol, hashed=None):
+    '''`hashed` optionally maps prefix lengths to bf.hash_key() of `ip`
+        masked to that length, computed earlier for the same `ip`.
+    '''
     max_shift = NUMBITS[protocol]
 
     false_positives = 0
@@ -150,7 +749,8 @@ def _linear_lookup_helper(bf, hashes, ip, maxx, minn, fib, protocol):
         mask = ((1<<max_shift) - 1) << (max_shift-pref_len)
         test_pref = ip & mask
         pref_encoded = encode_ip_prefix_pair(test_pref, pref_len, protocol)
-        if bf.contains(pref_encoded, hashes=hashes):
+        hash64 = hashed.get(pref_len) if hashed else None
+        if bf.contains(pref_encoded, hashes=hashes, hash64=hash64):
             if pref_encoded in fib:
                 return pref_len, fib[pref_encoded], false_positives
             else:
@@ -158,87 +758,236 @@ def _linear_lookup_helper(bf, hashes, ip, maxx, minn, fib, protocol):
 
     return 0, None, false_positives
 
-def _linear_lookup_bloom(bf, traffic, maxx, minn, fib, protocol):
+def _linear_lookup_bloom(bf, traffic, maxx, minn, fib, protocol, latency=None):
     num_found, false_positives = 0, 0
     hashes = _choose_hash_funcs(0, end=bf.k)
 
-    count = 0
-    for ip in traffic:
-        if count % 10000 == 0:
-            print('lookup processed %.3f of all ips' %(count/len(traffic)))
-        count += 1
+    progress = Progress('lookup processed %.3f of all ips', len(traffic)) if bf.instrument else None
+    for count, ip in enumerate(traffic):
+        if progress: progress(count)
 
         # return pref_len, fib[pref_encoded], false_positives
-        pref_len, fib_val, fp = _linear_lookup_helper(bf, hashes, ip, maxx, minn, fib, protocol)
+        if latency and not count % latency.sample:
+            start = perf_counter_ns()
+            pref_len, fib_val, fp = _linear_lookup_helper(bf, hashes, ip, maxx, minn, fib, protocol)
+            latency.record('linear', perf_counter_ns() - start)
+        else:
+            pref_len, fib_val, fp = _linear_lookup_helper(bf, hashes, ip, maxx, minn, fib, protocol)
         if fib_val is not None: num_found += 1
         false_positives += fp
     return num_found, false_positives
 
 @count_invocations
-def _default_to_linear_search(bf, ip, bmp_less_1, minn, fib, protocol='v4'):
+def _default_to_linear_search(bf, ip, bmp_less_1, minn, fib, protocol='v4', hashed=None):
     '''Default to linear search of remaining prefixes below BMP.
     '''
     hashes = _choose_hash_funcs(0, end=bf.k)
-    return _linear_lookup_helper(bf, hashes, ip, bmp_less_1, minn, fib, protocol)
+    return _linear_lookup_helper(bf, hashes, ip, bmp_less_1, minn, fib, protocol, hashed)
 
-def _guided_lookup_helper(bf, root, ip, fib, maxx, minn, ix2len, protocol):
-    ''' Returns resulting prefix length, FIB value (or None if default route), 
-            num false positives
+@count_invocations
+def _backtrack_search(bf, root, ip, hits, fib, ix2len, protocol='v4', hashed=None):
+    '''Fallback along the search path instead: once the BMP pointer at the
+        deepest hit in `hits` (nodes hit on the way down) fails, no pointer
+        is trusted, since a false positive hit decodes garbage. The lengths
+        below it are searched longest first, each verified with all k hash
+        funcs and the FIB: the left subtree of the deepest hit, then each
+        hit above it and its left subtree. In a subtree, a node whose first
+        hash func misses holds no marker, so neither it nor its right
+        subtree matches and only its left subtree is searched on. Returns
+        what linear search would, probing only the lengths of the tree.
     '''
-    max_shift = NUMBITS[protocol]
-    k = bf.k
     false_positives = 0
+    if hashed is None: hashed = {}
+    hashes = _choose_hash_funcs(0, end=bf.k)
+    # (node, whether to verify it or search its subtree), next to pop last
+    todo = []
+    for node in hits[:-1]:
+        todo += [(root.lefts[node], False), (node, True)]
+    todo.append((root.lefts[hits[-1]], False))
+    while todo:
+        current, verify = todo.pop()
+        if current < 0: continue
+        val = root.vals[current]
+        pref_encoded = encode_ip_prefix_pair(root.masks[current] & ip, val, protocol)
+        if val not in hashed:
+            hashed[val] = bf.hash_key(pref_encoded)
+        if verify:
+            if bf.contains(pref_encoded, hashes=hashes, hash64=hashed[val]):
+                if pref_encoded in fib:
+                    return val, fib[pref_encoded], false_positives
+                false_positives += 1
+        elif bf.contains(pref_encoded, hashes=[0], hash64=hashed[val]):
+            todo += [(root.lefts[current], False), (current, True), (root.rights[current], False)]
+        else:
+            todo.append((root.lefts[current], False))
+    return 0, None, false_positives
 
-    current = root # index of where we're in the binary search tree
-    count_hit = 0
-    preflen_hit = (0,count_hit) # (last preflen lookup that resulted in a hit (default to 0), count of hits along the path)
-    while current:
-        masked = (((1<<max_shift) - 1) << (max_shift-current.val)) & ip
-        pref_encoded = encode_ip_prefix_pair(masked, current.val, protocol)
-        if not bf.contains(pref_encoded, hashes=[0]): # guided by first hash function
-            current = current.left
+@count_invocations
+def _likely_search(bf, root, ip, hits, minn, fib, ix2len, protocol='v4', hashed=None):
+    '''Fallback over the prefix lengths of ix2len only, below the deepest
+        hit in `hits` and down to `minn`, skipping the lengths whose first
+        hash func missed on the way down. Most likely lengths first -- those
+        hit on the way down, then the others, longest first -- and only
+        lengths longer than the best match found so far.
+    '''
+    false_positives = 0
+    if hashed is None: hashed = {}
+    hashes = _choose_hash_funcs(0, end=bf.k)
+    below = root.vals[hits[-1]]
+    hit_lens = [root.vals[node] for node in reversed(hits[:-1])]
+    # walk the path down again to find the lengths that missed
+    missed, current, hit_set = set(), 0, set(hits)
+    while current >= 0:
+        if current in hit_set:
+            current = root.rights[current]
         else:
-            count_hit += 1
-            preflen_hit = (current.val, count_hit)
-            current = current.right
+            missed.add(root.vals[current])
+            current = root.lefts[current]
+    others = [pref_len for pref_len in reversed(ix2len) if minn <= pref_len < below
+              and pref_len not in missed and pref_len not in hit_lens]
 
-    # current is None, reached leaf of tree
-    if preflen_hit[0] == 0:
-        # return default route
-        return ix2len[preflen_hit[0]], None, 0
+    best = (0, None)
+    for pref_len in hit_lens + others:
+        if pref_len <= best[0]: continue
+        mask = (((1<<NUMBITS[protocol]) - 1) << (NUMBITS[protocol]-pref_len)) & ip
+        pref_encoded = encode_ip_prefix_pair(mask, pref_len, protocol)
+        if bf.contains(pref_encoded, hashes=hashes, hash64=hashed.get(pref_len)):
+            if pref_encoded in fib:
+                best = (pref_len, fib[pref_encoded])
+            else:
+                false_positives += 1
+    return best + (false_positives,)
 
-    # try decoding BMP (best matching prefix)
-    masked = (((1<<max_shift) - 1) << (max_shift-preflen_hit[0])) & ip
-    pref_encoded = encode_ip_prefix_pair(masked, preflen_hit[0], protocol)
+@count_invocations
+def _bmp_rejected():
+    pass
+
+@count_invocations
+def _hop_rejected():
+    pass
+
+def _verify_bmp(bf, root, ip, node_hit, count_hit, fib, ix2len, protocol, hashed):
+    '''Decode the BMP pointer of the key at `node_hit`, the `count_hit`th
+        hit on the way down, and verify it with the remaining hash funcs
+        and the FIB. Returns (prefix length, FIB value), or None if the
+        pointer does not verify.
+
+        If `bf` encodes next hops (bf.hops), the BMP is verified with all
+        k hash funcs instead, then the FIB confirms it and its decoded next
+        hop, counting wrong ones in _hop_rejected.ncalls. A pointer whose
+        check bits (see BMP_CHECKS) do not match is rejected untried: the
+        hit itself is verified instead, as if it were a prefix.
+    '''
+    max_shift = NUMBITS[protocol]
+    bits, check, width = _bmp_layout(bf, protocol)
+    preflen_hit = root.vals[node_hit]
+    pref_encoded = encode_ip_prefix_pair(root.masks[node_hit] & ip, preflen_hit, protocol)
     bmp_ix = bf.contains(pref_encoded,
-                         hashes=_choose_hash_funcs(preflen_hit[1],
-                                                   end=preflen_hit[1]+ENCODING[protocol]),
-                         keep_going = True)
+                         hashes=_choose_hash_funcs(count_hit,
+                                                   end=count_hit+bits+width),
+                         keep_going = True,
+                         hash64=hashed[preflen_hit])
+    if check is not None:
+        bmp_ix = _bmp_decode(bmp_ix, bits, check, width)
+        if bmp_ix is None:
+            if bf.instrument: _bmp_rejected()
+            bmp_ix = (1<<bits) - 1
 
     # note that bmp_ix is potentially pointing at the wrong BMP pref length...
-    #   if decoding fails due to false positive, default to linear search
-    pref_hypothesis = preflen_hit[0]
+    pref_hypothesis = preflen_hit
     if bmp_ix < len(ix2len):
         pref_hypothesis = ix2len[bmp_ix] # BMP hypothesis
         masked = (((1<<max_shift) - 1) << (max_shift-pref_hypothesis)) & ip
         pref_encoded = encode_ip_prefix_pair(masked, pref_hypothesis, protocol)
+        if pref_hypothesis not in hashed:
+            hashed[pref_hypothesis] = bf.hash_key(pref_encoded)
 
-    # check remaining hash funcs
-    if (bmp_ix == (1<<ENCODING[protocol]) - 1 or pref_hypothesis < preflen_hit[0])\
-            and bf.contains(pref_encoded,
-                            hashes = _choose_hash_funcs(preflen_hit[1] + ENCODING[protocol],
-                                                        end=k))\
-            and pref_encoded in fib:
-        return pref_hypothesis, fib[pref_encoded], 0
+    if bmp_ix != (1<<bits) - 1 and pref_hypothesis >= preflen_hit:
+        return None
+    hops = getattr(bf, 'hops', None)
+    if hops is None:
+        # check remaining hash funcs, if the pointer left any
+        hashes = _choose_hash_funcs(count_hit + bits + width, end=bf.k)
+        if (not hashes or bf.contains(pref_encoded, hashes=hashes, hash64=hashed[pref_hypothesis]))\
+                and pref_encoded in fib:
+            return pref_hypothesis, fib[pref_encoded]
+        return None
 
-    # else default to linear search below longest prefix hit
+    # a prefix has all k hash funcs, a marker only its first and pointer;
+    # the next hop follows in one pass. Any of these bits may be set by
+    # other keys, so the FIB confirms the route and its next hop
+    decode = bf.contains(pref_encoded, hashes=_choose_hash_funcs(0, end=bf.k+bf.hop_bits),
+                         keep_going=True, hash64=hashed[pref_hypothesis])
+    if decode & ((1<<bf.k) - 1) != (1<<bf.k) - 1 or pref_encoded not in fib:
+        return None
+    fib_val = fib[pref_encoded]
+    hop_ix = decode >> bf.k
+    if bf.instrument and hop_ix < len(hops) and hops[hop_ix] != fib_val:
+        _hop_rejected()
+    return pref_hypothesis, fib_val
+
+def _guided_lookup_helper(bf, root, ip, fib, maxx, minn, ix2len, protocol, hashed=None,
+                          fallback='linear'):
+    ''' Returns resulting prefix length, FIB value (or None if default route), 
+            num false positives
+
+        Each probed (prefix, length) key is hashed once; the hashes are
+        recorded in `hashed` (dict: prefix length -> hash) if provided.
+
+        If the BMP does not verify, `fallback` (one of FALLBACKS) searches
+        on: 'linear' every length below the deepest hit, 'backtrack' the
+        search tree again off the path, 'likely' the lengths of ix2len.
+    '''
+    false_positives = 0
+    if hashed is None: hashed = {}
+
+    vals, lefts, rights, masks = root.vals, root.lefts, root.rights, root.masks
+    current = 0 if vals else -1 # index of where we're in the binary search tree
+    hits = [] # nodes where the lookup resulted in a hit, along the path
+    while current >= 0:
+        val = vals[current]
+        pref_encoded = encode_ip_prefix_pair(masks[current] & ip, val, protocol)
+        hashed[val] = bf.hash_key(pref_encoded)
+        if not bf.contains(pref_encoded, hashes=[0], hash64=hashed[val]): # guided by first hash function
+            current = lefts[current]
+        else:
+            hits.append(current)
+            current = rights[current]
+
+    # current is -1, reached leaf of tree
+    if not hits:
+        # return default route
+        return ix2len[0], None, 0
+
+    # try decoding BMP (best matching prefix)
+    res = _verify_bmp(bf, root, ip, hits[-1], len(hits), fib, ix2len, protocol, hashed)
+    if res is not None:
+        return res + (0,)
+
+    # else fall back to searching below longest prefix hit
     false_positives += 1
-    preflen, fib_val, fp = _default_to_linear_search(bf, ip, preflen_hit[0]-1, minn, fib, protocol)
+    if fallback == 'backtrack':
+        search = instrumented(_backtrack_search, bf.instrument)
+        preflen, fib_val, fp = search(bf, root, ip, hits, fib, ix2len, protocol, hashed)
+    elif fallback == 'likely':
+        search = instrumented(_likely_search, bf.instrument)
+        preflen, fib_val, fp = search(bf, root, ip, hits, minn, fib, ix2len, protocol, hashed)
+    else:
+        search = instrumented(_default_to_linear_search, bf.instrument)
+        preflen, fib_val, fp = search(bf, ip, vals[hits[-1]]-1, minn, fib, protocol, hashed)
     false_positives += fp
     return preflen, fib_val, false_positives
 
-def _guided_lookup_bloom(bf, traffic, root, fib, maxx, minn, ix2len, protocol='v4'):
-    '''Currently defaulting to linear search iff led astray by false
+def _guided_path(fib_val, false_positives):
+    '''Returns the LATENCY_PATHS entry for a _guided_lookup_helper() result:
+        only the fallback search counts false positives.
+    '''
+    if false_positives: return 'fallback'
+    return 'default' if fib_val is None else 'bmp'
+
+def _guided_lookup_bloom(bf, traffic, root, fib, maxx, minn, ix2len, protocol='v4',
+                         fallback='linear', latency=None):
+    '''Currently defaulting to `fallback` search iff led astray by false
         positive hits at any point.
 
         Alternatives to consider in the future:
@@ -246,31 +995,636 @@ def _guided_lookup_bloom(bf, traffic, root, fib, maxx, minn, ix2len, protocol='v
             Add a parity bit to encoding to check if BMP makes sense?
             Shoot for very sparse bitarrays (up to current cache bottleneck)?
     '''
+    root = _as_plan(root, protocol)
     # keep track of number of times had to default to linear search
     num_found = false_positives = 0
-    count = 0 # track progress
-    for ip in traffic:
-        if count % 10000 == 0:
-            print('lookup processed %.3f of all ips' %(count/len(traffic)))
-        count += 1
+    progress = Progress('lookup processed %.3f of all ips', len(traffic)) if bf.instrument else None
+    for count, ip in enumerate(traffic):
+        if progress: progress(count)
 
         # return preflen, fib_val, false_positives, 1
-        preflen, fib_val, fp = _guided_lookup_helper(
-                bf, root, ip, fib, maxx, minn, ix2len, protocol)
+        if latency and not count % latency.sample:
+            start = perf_counter_ns()
+            preflen, fib_val, fp = _guided_lookup_helper(
+                    bf, root, ip, fib, maxx, minn, ix2len, protocol, fallback=fallback)
+            latency.record(_guided_path(fib_val, fp), perf_counter_ns() - start)
+        else:
+            preflen, fib_val, fp = _guided_lookup_helper(
+                    bf, root, ip, fib, maxx, minn, ix2len, protocol, fallback=fallback)
         false_positives += fp
         if fib_val is not None: num_found += 1
 
     return num_found, false_positives
 
-def lookup_in_bloom(bf, traffic, fib, root=None, maxx=None, minn=None, ix2len=None, protocol='v4'):
+class RouteCache:
+    '''Bounded cache of lookup results in front of lookup_in_bloom(): a
+        fixed number of preallocated slots, evicted by CLOCK (second chance
+        for entries referenced since the hand last passed). Prefix lengths
+        are kept in an array; keys (IPv6 ones overflow 64 bits) and FIB
+        values (any object) in lists, with a dict from key to slot.
+
+        Keyed by destination IP, or with `aggregate` set (e.g.
+        AGGREGATE[protocol]) by the covering prefix of that length, from
+        which every IP gets the same result -- unless one of `prefixes`
+        (list of (prefix, length) pairs) more specific than `aggregate`
+        lies inside it, in which case its IPs are cached one by one so
+        that an aggregate entry never hides that route, so `aggregate`
+        requires `prefixes`. Clear the cache when routes change.
+    '''
+    def __init__(self, capacity, prefixes=None, aggregate=None, protocol='v4',
+                 instrument=True):
+        if aggregate and prefixes is None:
+            raise ValueError('aggregate keys need the prefixes to split them around')
+        self.capacity = capacity
+        self.instrument = instrument
+        self.protocol = protocol
+        self.aggregate = aggregate
+        max_shift = NUMBITS[protocol]
+        self.mask = (((1<<max_shift) - 1) << (max_shift-aggregate)) if aggregate else 0
+        # aggregates holding a more specific route
+        self.split = set(prefix & self.mask for prefix, preflen in (prefixes or [])
+                         if aggregate and preflen > aggregate)
+        self.clear()
+
+    def clear(self):
+        self.keys = [None] * self.capacity
+        self.pref_lens = array('i', [0]) * self.capacity
+        self.fib_vals = [None] * self.capacity
+        self.referenced = bytearray(self.capacity)
+        self.slots = dict() # key -> slot
+        self.hand = 0
+
+    def _key(self, ip):
+        if self.aggregate:
+            masked = ip & self.mask
+            if masked not in self.split:
+                return encode_ip_prefix_pair(masked, self.aggregate, self.protocol)
+        return encode_ip_prefix_pair(ip, NUMBITS[self.protocol], self.protocol)
+
+    def get(self, ip):
+        '''Returns cached (prefix length, FIB value) for `ip`, or None.
+        '''
+        slot = self.slots.get(self._key(ip))
+        if slot is None:
+            if self.instrument: _cache_miss()
+            return None
+        if self.instrument: _cache_hit()
+        self.referenced[slot] = 1
+        return self.pref_lens[slot], self.fib_vals[slot]
+
+    def put(self, ip, pref_len, fib_val):
+        key = self._key(ip)
+        slot = self.slots.get(key)
+        if slot is None:
+            # advance the clock hand to an entry not referenced since last pass
+            while self.referenced[self.hand]:
+                self.referenced[self.hand] = 0
+                self.hand = (self.hand + 1) % self.capacity
+            slot = self.hand
+            self.hand = (self.hand + 1) % self.capacity
+            self.slots.pop(self.keys[slot], None)
+            self.keys[slot] = key
+            self.slots[key] = slot
+        self.pref_lens[slot] = pref_len
+        self.fib_vals[slot] = fib_val
+        self.referenced[slot] = 1
+
+@count_invocations
+def _cache_hit():
+    pass
+
+@count_invocations
+def _cache_miss():
+    pass
+
+def _cached_lookup_bloom(bf, traffic, fib, root, maxx, minn, ix2len, protocol, cache,
+                         fallback='linear', latency=None):
+    '''Linear (`root` is None) or guided lookup of each IP in `traffic`
+        not found in RouteCache `cache`, storing the result there.
+        Sampled latencies include the cache lookup.
+    '''
+    num_found = false_positives = 0
+    hashes = _choose_hash_funcs(0, end=bf.k)
+    progress = Progress('lookup processed %.3f of all ips', len(traffic)) if bf.instrument else None
+    for count, ip in enumerate(traffic):
+        if progress: progress(count)
+
+        sampled = latency and not count % latency.sample
+        if sampled: start = perf_counter_ns()
+        res = cache.get(ip)
+        if res is None:
+            if root is None:
+                pref_len, fib_val, fp = _linear_lookup_helper(bf, hashes, ip, maxx, minn, fib,
+                                                              protocol)
+                path = 'linear'
+            else:
+                pref_len, fib_val, fp = _guided_lookup_helper(bf, root, ip, fib, maxx, minn,
+                                                              ix2len, protocol, fallback=fallback)
+                path = _guided_path(fib_val, fp)
+            cache.put(ip, pref_len, fib_val)
+            false_positives += fp
+        else:
+            pref_len, fib_val = res
+            path = 'cache'
+        if sampled: latency.record(path, perf_counter_ns() - start)
+        if fib_val is not None: num_found += 1
+    return num_found, false_positives
+
+def lookup_in_bloom(bf, traffic, fib, root=None, maxx=None, minn=None, ix2len=None, protocol='v4',
+                    cache=None, fallback='linear', latency=None):
     '''Look up `traffic` in `bf`. If unguided search -> range between
         maxx to minn. If guided search -> `root` is an (optimal)
-        binary search tree to guide the search.
+        binary search tree to guide the search, and `fallback` one of
+        FALLBACKS (see _guided_lookup_helper()). Optionally consult and
+        fill RouteCache `cache` first (hit rate in _cache_hit.ncalls and
+        _cache_miss.ncalls). Pass a profiler.LatencyRecorder as `latency`
+        to time a sample of the lookups by search path (LATENCY_PATHS).
 
         Returns a pair: count of matched prefixes and count of false positives
             (return values can be used for sanity checks).
     '''
+    if fallback not in FALLBACKS:
+        raise ValueError('unknown fallback %r, expected one of %s' %(fallback, FALLBACKS))
+    if root is not None:
+        root = _as_plan(root, protocol)
+    if cache is not None:
+        return _cached_lookup_bloom(bf, traffic, fib, root, maxx, minn, ix2len, protocol, cache,
+                                    fallback, latency)
     if root is None: # linear search
-        return _linear_lookup_bloom(bf, traffic, maxx, minn, fib, protocol)
+        return _linear_lookup_bloom(bf, traffic, maxx, minn, fib, protocol, latency)
     else:
-        return _guided_lookup_bloom(bf, traffic, root, fib, maxx, minn, ix2len, protocol=protocol)
+        return _guided_lookup_bloom(bf, traffic, root, fib, maxx, minn, ix2len, protocol=protocol,
+                                    fallback=fallback, latency=latency)
+
+def _ip_words(ips, protocol='v4'):
+    '''Return `ips` (ints, or a NumPy array of IPv4 addresses) as a
+        (len(ips), words) uint64 array of little-endian 64-bit words.
+    '''
+    if protocol == 'v4':
+        return np.asarray(ips, dtype=np.uint64).reshape(-1, 1)
+    return to_words(ips, NUMBITS[protocol]//8)
+
+def _mask_words(protocol='v4'):
+    '''Return (NUMBITS+1, words) uint64 array, row i holding the netmask
+        of prefix length i split into words as by _ip_words().
+    '''
+    max_shift = NUMBITS[protocol]
+    return to_words([(((1<<max_shift) - 1) << (max_shift-pref_len)) & ((1<<max_shift) - 1)
+                     for pref_len in range(max_shift+1)], max_shift//8)
+
+def _key_words(words, pref_lens, masks, protocol='v4'):
+    '''Vectorized encode_ip_prefix_pair(): IP `words` masked to `pref_lens`
+        (one length, or one per IP), encoded as keys for contains_many().
+    '''
+    masked = words & masks[pref_lens]
+    pref_lens = np.broadcast_to(np.asarray(pref_lens, dtype=np.uint64), (len(words),))
+    if protocol == 'v4':
+        return masked[:, 0] | (pref_lens << np.uint64(KEY_SHIFT[protocol]))
+    return np.column_stack([masked, pref_lens])
+
+def _key_ints(keys):
+    '''Return keys from _key_words() as a list of (encoded prefix) ints.
+    '''
+    if keys.ndim == 1: keys = keys[:, None]
+    return [sum(int(word) << (64*i) for i, word in enumerate(row)) for row in keys]
+
+def _fib_lookup_many(fib, keys):
+    '''Look up keys from _key_words() in `fib`, in one batch if it is a
+        utils.CompactFIB. Returns an int array of the positions in `keys`
+        found, and a list of their FIB values.
+    '''
+    if hasattr(fib, 'index_many'):
+        rows = fib.index_many(keys)
+        found = np.flatnonzero(rows >= 0)
+        return found, [fib.value(row) for row in rows[found].tolist()]
+    found, vals = [], []
+    for i, pref_encoded in enumerate(_key_ints(keys)):
+        if pref_encoded in fib:
+            found.append(i)
+            vals.append(fib[pref_encoded])
+    return np.array(found, dtype=np.int64), vals
+
+def lookup_batch(bf, ips, fib, root, maxx, minn, ix2len, protocol='v4'):
+    '''Guided lookup of a whole array of `ips` at once: all IPs at a node
+        of the `root` bin search tree are masked, hashed and probed in one
+        vectorized step, then split into the left and right subtrees by
+        hit; BMP decoding, verification and the default to linear search
+        run the same way on the IPs that need them.
+
+        `bf` must support contains_many() (and for IPv6, fixed-width keys).
+
+        Returns a pair of per-IP arrays: resulting prefix length, and FIB
+            value (None if default route), as _guided_lookup_helper()
+            would return IP by IP.
+    '''
+    if not hasattr(bf, 'contains_many') or (bf.width is None and protocol != 'v4'):
+        raise ValueError('batch lookup needs a fixed-width contains_many() backend, not %s'
+                         %type(bf).__name__)
+    plan = _as_plan(root, protocol)
+    words = _ip_words(ips, protocol)
+    masks = _mask_words(protocol)
+    num_ips = len(words)
+
+    # walk the tree level by level, each node with the IPs that reached it
+    hit_len = np.zeros(num_ips, dtype=np.int64) # last prefix length hit
+    count_hit = np.zeros(num_ips, dtype=np.int64) # count of hits along the path
+    hit_hash = np.zeros(num_ips, dtype=np.uint64) # hash of the key at hit_len
+    frontier = [(0, np.arange(num_ips))] if plan.vals else []
+    while frontier:
+        next_frontier = []
+        for node, ixs in frontier:
+            val = plan.vals[node]
+            hash64 = bf.hash_many(_key_words(words[ixs], val, masks, protocol))
+            hit = bf.contains_many(None, hashes=[0], hash64=hash64) != 0 # guided by first hash function
+            hits = ixs[hit]
+            count_hit[hits] += 1
+            hit_len[hits] = val
+            hit_hash[hits] = hash64[hit]
+            for child, sub in ((plan.lefts[node], ixs[~hit]), (plan.rights[node], hits)):
+                if child >= 0 and len(sub):
+                    next_frontier.append((child, sub))
+        frontier = next_frontier
+
+    pref_lens = np.zeros(num_ips, dtype=np.int64) # default route
+    fib_vals = np.full(num_ips, None, dtype=object)
+    resolved = count_hit == 0
+
+    # decode BMP pointers, one batch per count of hits (first hash func of the pointer)
+    bits, check, width = _bmp_layout(bf, protocol)
+    bmp = np.zeros(num_ips, dtype=np.uint64)
+    for count in np.unique(count_hit[~resolved]):
+        sel = np.flatnonzero(count_hit == count)
+        bmp[sel] = bf.contains_many(None, hashes=_choose_hash_funcs(count, end=count+bits+width),
+                                    keep_going=True, hash64=hit_hash[sel])
+    bmp, intact = _bmp_decode_many(bmp, bits, check, width)
+    intact |= resolved
+    if bf.instrument:
+        _bmp_rejected.ncalls += int(np.count_nonzero(~intact))
+    bmp[~intact] = (1<<bits) - 1 # rejected: verify the hit itself
+    hypothesis = hit_len.copy()
+    decoded = bmp < len(ix2len)
+    hypothesis[decoded] = np.asarray(ix2len)[bmp[decoded].astype(np.int64)]
+
+    # check remaining hash funcs of the BMP hypothesis, then the FIB
+    cand = np.flatnonzero(~resolved & ((bmp == (1<<bits) - 1) | (hypothesis < hit_len)))
+    keys = _key_words(words[cand], hypothesis[cand], masks, protocol)
+    hash64 = hit_hash[cand]
+    moved = hypothesis[cand] != hit_len[cand]
+    if moved.any():
+        hash64[moved] = bf.hash_many(keys[moved])
+    hops = getattr(bf, 'hops', None)
+    if hops is None:
+        verified = np.ones(len(cand), dtype=bool) # none left: the FIB decides
+        for count in np.unique(count_hit[cand]):
+            hashes = _choose_hash_funcs(count+bits+width, end=bf.k)
+            if hashes:
+                sel = np.flatnonzero(count_hit[cand] == count)
+                verified[sel] = bf.contains_many(None, hashes=hashes, hash64=hash64[sel]) != 0
+    else: # all k hash funcs, then the encoded next hop (see _verify_bmp())
+        decode = bf.contains_many(None, hashes=_choose_hash_funcs(0, end=bf.k+bf.hop_bits),
+                                  keep_going=True, hash64=hash64)
+        all_k = np.uint64((1<<bf.k) - 1)
+        verified = decode & all_k == all_k
+    found, vals = _fib_lookup_many(fib, keys[verified])
+    sel = cand[np.flatnonzero(verified)[found]]
+    pref_lens[sel] = hypothesis[sel]
+    fib_vals[sel] = vals
+    resolved[sel] = True
+    if hops is not None and bf.instrument: # decoded next hops the FIB disagrees with
+        hop_ix = (decode[np.flatnonzero(verified)[found]] >> np.uint64(bf.k)).tolist()
+        _hop_rejected.ncalls += sum(ix < len(hops) and hops[ix] != val
+                                    for ix, val in zip(hop_ix, vals))
+
+    # else default to linear search below longest prefix hit
+    todo = np.flatnonzero(~resolved)
+    if bf.instrument:
+        _default_to_linear_search.ncalls += len(todo)
+    hashes = _choose_hash_funcs(0, end=bf.k)
+    for pref_len in range(int(hit_len[todo].max(initial=0))-1, minn-1, -1):
+        active = todo[hit_len[todo] > pref_len]
+        if not len(active): continue
+        keys = _key_words(words[active], pref_len, masks, protocol)
+        hit = bf.contains_many(keys, hashes=hashes) != 0
+        found, vals = _fib_lookup_many(fib, keys[hit])
+        sel = active[np.flatnonzero(hit)[found]]
+        pref_lens[sel] = pref_len
+        fib_vals[sel] = vals
+        resolved[sel] = True
+        todo = todo[~resolved[todo]]
+    return pref_lens, fib_vals
+
+
+def _lookup_chunk(bf, ips, fib, root, maxx, minn, ix2len, protocol='v4'):
+    '''Returns a pair of arrays, prefix length and FIB value per IP in the
+        list `ips`: batched (see lookup_batch()) where `bf` allows it,
+        else IP by IP.
+    '''
+    if root is not None and hasattr(bf, 'contains_many') and\
+            (bf.width is not None or protocol == 'v4'):
+        return lookup_batch(bf, np.array(ips, dtype=np.uint64) if protocol == 'v4' else ips,
+                            fib, root, maxx, minn, ix2len, protocol)
+    if root is None:
+        hashes = _choose_hash_funcs(0, end=bf.k)
+        res = [_linear_lookup_helper(bf, hashes, ip, maxx, minn, fib, protocol) for ip in ips]
+    else:
+        res = [_guided_lookup_helper(bf, root, ip, fib, maxx, minn, ix2len, protocol)
+               for ip in ips]
+    fib_vals = np.full(len(ips), None, dtype=object)
+    fib_vals[:] = [fib_val for _, fib_val, _ in res]
+    return np.array([pref_len for pref_len, _, _ in res], dtype=np.int64), fib_vals
+
+def lookup_stream(bf, traffic, fib, root=None, maxx=None, minn=None, ix2len=None,
+                  protocol='v4', chunk_size=CHUNK_SIZE, per_ip=False):
+    '''Look up `traffic`, any iterable of IPs (e.g. utils.iter_traffic()
+        over a trace file or a live feed), `chunk_size` IPs at a time and
+        in constant memory. Linear or guided search as in lookup_in_bloom().
+
+        Yields per chunk a triple of arrays: IPs, resulting prefix length
+            and FIB value (None if default route); or, if `per_ip` is set,
+            one (ip, prefix length, FIB value) triple per IP.
+    '''
+    if root is not None:
+        root = _as_plan(root, protocol)
+    traffic = iter(traffic)
+    while True:
+        chunk = list(islice(traffic, chunk_size))
+        if not chunk: return
+        pref_lens, fib_vals = _lookup_chunk(bf, chunk, fib, root, maxx, minn, ix2len, protocol)
+        if per_ip:
+            yield from zip(chunk, pref_lens.tolist(), fib_vals.tolist())
+        else:
+            yield (np.array(chunk, dtype=np.uint64 if protocol == 'v4' else object),
+                   pref_lens, fib_vals)
+
+
+class GuidedFilter:
+    '''Guided Bloom filter over a CountingBloomFilter that supports
+        incremental route updates.
+
+        The filter holds the same marker table as build_bloom_filter(),
+        one entry per key with the exact BMP of each marker, and counts the
+        routes leaving each marker, so that announce() and withdraw() only
+        add or drop the markers no other route shares and re-point the
+        markers whose BMP changes. After any sequence of updates the
+        filter is identical to one built from scratch.
+    '''
+    def __init__(self, pref_stats, root, fib, fpp=FPP, k=None, num_bits=None,
+                 protocol='v4', counter_bits=8, legacy_hash=False, hash_func='fnv',
+                 instrument=True):
+        self.root = _as_plan(root, protocol)
+        self.fib = fib
+        self.protocol = protocol
+        self.ix2len = pref_stats['ix2len']
+        self.len2ix = pref_stats['len2ix']
+        self.maxx, self.minn = pref_stats['maxx'], pref_stats['minn']
+        self.tree_lens = set(self.root.vals)
+        self.bf = _new_bloom_filter(pref_stats, fpp, k, num_bits, protocol, legacy_hash,
+                                    partial(CountingBloomFilter, counter_bits=counter_bits),
+                                    hash_func, instrument)
+        self.bf.bmp_bits, self.bf.bmp_check = None, None
+        _check_bmp_layout(self.bf, self.root, protocol)
+        _build_guided_counting(self.bf, pref_stats, self.root, protocol)
+        self.routes = self.bf.routes
+
+    def lookup(self, ip):
+        '''Returns resulting prefix length, FIB value (or None if default route),
+            num false positives.
+        '''
+        return _guided_lookup_helper(self.bf, self.root, ip, self.fib, self.maxx,
+                                     self.minn, self.ix2len, self.protocol)
+
+    def announce(self, prefix, preflen, fib_val=None):
+        '''Add route (`prefix`, `preflen`), by default with its CIDR string
+            as FIB value, and re-point the markers inside it that it becomes
+            the BMP of.
+        '''
+        pref_encoded = encode_ip_prefix_pair(prefix, preflen, self.protocol)
+        if pref_encoded in self.bf.route_keys: return
+        if preflen not in self.len2ix or preflen not in self.tree_lens:
+            raise ValueError('prefix length %d not in the search tree, rebuild required' %preflen)
+
+        _announce_guided(self.bf, prefix, preflen, self.root, self.protocol)
+        if fib_val is None:
+            network = IPv4Network if self.protocol == 'v4' else IPv6Network
+            fib_val = str(network((prefix, preflen)))
+        self.fib[pref_encoded] = fib_val
+
+    def withdraw(self, prefix, preflen):
+        '''Remove route (`prefix`, `preflen`) and re-point the markers
+            inside it that it was the BMP of to its own BMP.
+        '''
+        _withdraw_guided(self.bf, prefix, preflen, self.root, self.protocol)
+        del self.fib[encode_ip_prefix_pair(prefix, preflen, self.protocol)]
+
+@count_invocations
+def _direct_hit():
+    pass
+
+class HybridFilter:
+    '''Two-stage lookup: the top `stride` bits of an IP index an array
+        that resolves every IP no route longer than `stride` covers, with
+        no filter probes; only IPs under such a route fall through to a
+        guided Bloom filter holding just the routes longer than `stride`,
+        searched along a tree built only for those lengths.
+
+        An entry v >= 0 of `stage` is final, route `hops[v]`; v < 0 means
+        continue, with route `hops[~v]` if the guided search finds none.
+        `hops` lists (prefix length, FIB value) pairs, hops[0] the default
+        route. Count of IPs resolved by the array in _direct_hit.ncalls.
+    '''
+    def __init__(self, pref_stats, fib, stride=16, lamda=weigh_equally, fpp=FPP, k=None,
+                 num_bits=None, protocol='v4', legacy_hash=False, backend=BloomFilter,
+                 hash_func='fnv', instrument=True):
+        max_shift = NUMBITS[protocol]
+        self.stride = stride
+        self.instrument = instrument
+        self.shift = max_shift - stride
+        self.protocol = protocol
+        self.fib = fib
+
+        # paint short routes over the array, more specific ones last
+        stage = np.zeros(1 << stride, dtype=np.int64)
+        self.hops = [(0, None)]
+        short = sorted([(preflen, prefix) for prefix, preflen in pref_stats['prefixes']
+                        if preflen <= stride])
+        for preflen, prefix in short:
+            start = prefix >> self.shift
+            stage[start:start + (1 << (stride-preflen))] = len(self.hops)
+            self.hops.append((preflen, fib[encode_ip_prefix_pair(prefix, preflen, protocol)]))
+        # flag the slots under longer routes to continue
+        longer = [(prefix, preflen) for prefix, preflen in pref_stats['prefixes']
+                  if preflen > stride]
+        slots = np.unique(np.array([prefix >> self.shift for prefix, _ in longer], dtype=np.int64))
+        stage[slots] = ~stage[slots]
+        # narrowest entries that hold every index into hops
+        dtype = np.int16 if len(self.hops) <= np.iinfo(np.int16).max else np.int32
+        self.stage = array('h' if dtype == np.int16 else 'i', stage.astype(dtype).tobytes())
+
+        self.bf = self.root = None
+        if longer:
+            stats = prefix_stats(longer)
+            self.maxx, self.minn, self.ix2len = stats['maxx'], stats['minn'], stats['ix2len']
+            lens = set(stats['ix2len'])
+            self.bf, self.root = build_bloom_filter(
+                    protocol=protocol, fpp=fpp, k=k, num_bits=num_bits, fib=fib,
+                    lamda=lambda protocol: [(w, l) for w, l in lamda(protocol) if l in lens],
+                    prefixes=longer, pref_stats=stats, legacy_hash=legacy_hash,
+                    backend=backend, hash_func=hash_func, instrument=instrument)
+
+    def num_bytes(self):
+        '''Memory of the direct-indexed array and the filter's bit array.
+        '''
+        if self.bf is None: return self.stage.itemsize * len(self.stage)
+        filter_bytes = self.bf.num_bytes() if hasattr(self.bf, 'num_bytes') else\
+                       ceil(self.bf.num_bits/8)
+        return self.stage.itemsize * len(self.stage) + filter_bytes
+
+    def lookup(self, ip):
+        '''Returns resulting prefix length, FIB value (or None if default route),
+            num false positives.
+        '''
+        v = self.stage[ip >> self.shift]
+        if v >= 0:
+            if self.instrument: _direct_hit()
+            return self.hops[v] + (0,)
+        preflen, fib_val, fp = _guided_lookup_helper(self.bf, self.root, ip, self.fib, self.maxx,
+                                                     self.minn, self.ix2len, self.protocol)
+        if fib_val is None:
+            return self.hops[~v] + (fp,)
+        return preflen, fib_val, fp
+
+@count_invocations
+def _tree_rebuilt():
+    pass
+
+def _match_keys(prefixes, lens, protocol='v4'):
+    '''Returns the set of keys a guided search could hit if every length
+        in `lens` (ascending) held the markers of all longer prefixes: each
+        prefix cut to each of `lens` up to its own length.
+    '''
+    max_shift = NUMBITS[protocol]
+    keys = set()
+    for prefix, preflen in prefixes:
+        for pref_len in lens:
+            if pref_len > preflen: break
+            shift = max_shift - pref_len
+            keys.add(encode_ip_prefix_pair(prefix >> shift << shift, pref_len, protocol))
+    return keys
+
+def _deepest_match(ip, lens, keys, protocol='v4'):
+    '''Returns the longest of `lens` (ascending) at which `ip` matches one
+        of `keys` (see _match_keys()), or 0. A match at a length implies
+        one at every shorter length, so this is a binary search.
+    '''
+    max_shift = NUMBITS[protocol]
+    lo, hi, deepest = 0, len(lens) - 1, 0
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        shift = max_shift - lens[mid]
+        if encode_ip_prefix_pair(ip >> shift << shift, lens[mid], protocol) in keys:
+            deepest, lo = lens[mid], mid + 1
+        else:
+            hi = mid - 1
+    return deepest
+
+class AdaptiveFilter:
+    '''Guided Bloom filter whose search tree follows the traffic. Lookups
+        record the IPs they look up, and nothing else: the caller runs
+        maybe_rebuild() off the lookup path (e.g. after each batch of
+        traffic), which once `interval` lookups have been recorded calls
+        adapt(). That counts for each IP the longest length at which it
+        matches some route at least as long (see _deepest_match()), where
+        its walk down the tree ends, recomputes the optimal tree weighted
+        by the counts (see obst.weigh_by_lookups()) and, if the tree
+        changed, builds a filter for it and swaps filter and tree in
+        together.
+        The counts are taken off the routes rather than off the hits of the
+        current tree, which lacks the markers other trees would have.
+        Counts are scaled by `decay` after each recomputation, so older
+        traffic weighs less. Count of swaps in _tree_rebuilt.ncalls.
+
+        The first tree is built with `lamda`, whose prefix lengths every
+        later tree keeps.
+    '''
+    def __init__(self, pref_stats, fib, lamda=weigh_equally, fpp=FPP, k=None, num_bits=None,
+                 protocol='v4', interval=REBUILD_INTERVAL, decay=0.5, legacy_hash=False,
+                 backend=BloomFilter, hash_func='fnv', instrument=True):
+        self.fib = fib
+        self.protocol = protocol
+        self.interval = interval
+        self.decay = decay
+        self.instrument = instrument
+        self.maxx, self.minn, self.ix2len = pref_stats['maxx'], pref_stats['minn'], pref_stats['ix2len']
+        self.tree_lens = sorted(pref_len for _, pref_len in lamda(protocol))
+        self.keys = _match_keys(pref_stats['prefixes'], self.tree_lens, protocol)
+        self.window = [] # IPs looked up since the last adapt()
+        self.counts = [0] * (NUMBITS[protocol]+1) # prefix length -> lookups ending past it
+        self.pending = interval # lookups left until maybe_rebuild() adapts
+        self._build = partial(build_bloom_filter, protocol=protocol, fpp=fpp, k=k,
+                              num_bits=num_bits, fib=fib, prefixes=pref_stats['prefixes'],
+                              pref_stats=pref_stats, legacy_hash=legacy_hash,
+                              backend=backend, hash_func=hash_func, instrument=instrument)
+        self.bf, self.root = self._build(lamda=lamda)
+
+    def lookup(self, ip):
+        '''Returns resulting prefix length, FIB value (or None if default route),
+            num false positives.
+        '''
+        res = _guided_lookup_helper(self.bf, self.root, ip, self.fib, self.maxx, self.minn,
+                                    self.ix2len, self.protocol)
+        self.window.append(ip)
+        self.pending -= 1
+        return res
+
+    def maybe_rebuild(self):
+        '''Run adapt() if `interval` lookups were counted since the last
+            one. Returns whether it swapped in a new tree.
+        '''
+        if self.pending > 0:
+            return False
+        return self.adapt()
+
+    def adapt(self):
+        '''Recompute the optimal tree from the counts so far, and swap in a
+            filter built for it unless it is the current tree. Returns
+            whether it swapped.
+        '''
+        self.pending = self.interval
+        for ip in self.window:
+            self.counts[_deepest_match(ip, self.tree_lens, self.keys, self.protocol)] += 1
+        self.window = []
+        weigh, gaps = weigh_by_lookups(self.counts, self.tree_lens)
+        # counts rarely recur, so the tree is not memoized
+        plan = SearchPlan.compile(obst(self.protocol, weigh, gaps=gaps, cache=False), self.protocol)
+        self.counts = [count * self.decay for count in self.counts]
+        if (plan.vals, plan.lefts, plan.rights) == (self.root.vals, self.root.lefts, self.root.rights):
+            return False
+        self.bf, self.root = self._build(plan=plan)
+        if self.instrument: _tree_rebuilt()
+        return True
+
+if __name__ == "__main__":
+    # incremental updates after random churn vs a full rebuild
+    from random import sample
+    from utils import compile_fib_table
+    protocol = 'v4'
+    pref_stats = prefix_stats(load_prefixes(protocol=protocol))
+    bst = obst(protocol, weigh_equally)
+    gf = GuidedFilter(pref_stats, bst, compile_fib_table(protocol=protocol),
+                      fpp=None, k=10, num_bits=10*len(pref_stats['prefixes']), protocol=protocol)
+
+    withdrawn = sample(gf.routes, len(gf.routes)//5)
+    for prefix, preflen in withdrawn:
+        gf.withdraw(prefix, preflen)
+    for prefix, preflen in sample(withdrawn, len(withdrawn)//2):
+        gf.announce(prefix, preflen)
+    for prefix, preflen in sample(gf.routes, len(gf.routes)//10):
+        gf.withdraw(prefix, preflen)
+
+    rebuilt, _ = build_bloom_filter(protocol, fpp=None, k=10,
+                                    num_bits=10*len(pref_stats['prefixes']),
+                                    pref_stats=dict(pref_stats, prefixes=list(gf.routes)),
+                                    plan=gf.root, instrument=False)
+    print(gf.bf)
+    print(gf.bf.saturated() == 0 and gf.bf.ba == rebuilt.ba) # => True
+    print(set(gf.fib.keys()) == set(gf.bf.route_keys)) # => True
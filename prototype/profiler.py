@@ -1,4 +1,27 @@
+'''profiler.py
+
+Instrumentation of the hot paths: call counters (count_invocations) and
+time-throttled progress reports (Progress). Both are switched on or off
+where a filter is built, e.g. BloomFilter(..., instrument=False): an
+uninstrumented filter binds the undecorated functions (see
+instrumented()) and the lookups and builds over it skip the counters and
+the progress reports altogether.
+
+Lookup latency is recorded separately, by passing a LatencyRecorder to
+ipfilter.lookup_in_bloom(): a log-bucketed histogram per search path of
+a sample of the lookups, exported as JSON or Prometheus text.
+'''
+import os
+import json
+from array import array
 from functools import wraps
+from time import perf_counter
+
+PROGRESS_INTERVAL = 1.0 # min seconds between two progress reports
+SUB_BITS = 3 # histogram buckets per power of 2 are 2**SUB_BITS, ~12% wide
+QUANTILES = (0.5, 0.9, 0.99, 0.999) # exported latency percentiles
+
+_progress = {'callback': None, 'interval': PROGRESS_INTERVAL}
 
 def count_invocations(func):
     '''Count the number of times `func` was called.
@@ -10,6 +33,135 @@ def count_invocations(func):
     register.ncalls = 0
     return register
 
+def instrumented(func, enabled=True):
+    '''Returns `func` as decorated with count_invocations() if `enabled`,
+        else the undecorated function, which runs without counting.
+    '''
+    return func if enabled else getattr(func, '__wrapped__', func)
+
+def set_progress(callback=None, interval=PROGRESS_INTERVAL):
+    '''Report progress of instrumented loops to `callback(done, total)`
+        (None to print), at most once per `interval` seconds.
+    '''
+    _progress['callback'] = callback
+    _progress['interval'] = interval
+
+class Progress:
+    '''Progress of a loop over `total` items: call with the count of items
+        done on every iteration, reports (the first call and then at most
+        once per interval, see set_progress()) print `message` formatted
+        with the fraction done.
+    '''
+    def __init__(self, message, total):
+        self.message = message
+        self.total = total
+        self.callback = _progress['callback']
+        self.interval = _progress['interval']
+        self.due = perf_counter()
+
+    def __call__(self, done):
+        now = perf_counter()
+        if now < self.due: return
+        self.due = now + self.interval
+        if self.callback is None:
+            print(self.message %(done/max(1, self.total)))
+        else:
+            self.callback(done, self.total)
+
+class Histogram:
+    '''Counts of non-negative int values (e.g. latencies in ns) in
+        log-scale buckets: exact below 2**(SUB_BITS+1), then 2**SUB_BITS
+        buckets per power of 2, so a quantile is off by at most
+        1/2**SUB_BITS of its value.
+    '''
+    def __init__(self):
+        self.counts = array('Q', bytes(8 * (64 << SUB_BITS)))
+        self.count = self.total = self.max = 0
+
+    def add(self, value):
+        shift = max(0, value.bit_length() - SUB_BITS - 1)
+        self.counts[(shift << SUB_BITS) + (value >> shift)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max: self.max = value
+
+    @staticmethod
+    def bucket_range(ix):
+        '''Returns the lowest value in bucket `ix`, and its width.
+        '''
+        shift = max(0, (ix >> SUB_BITS) - 1)
+        return (ix - (shift << SUB_BITS)) << shift, 1 << shift
+
+    def quantile(self, q):
+        '''Returns the value (bucket midpoint, at most the max added) below
+            which a fraction `q` of the values lie, 0 if empty.
+        '''
+        if not self.count: return 0
+        rank, seen = q * self.count, 0
+        for ix, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                low, width = self.bucket_range(ix)
+                return min(low + width // 2, self.max)
+        return self.max
+
+class LatencyRecorder:
+    '''Histogram of the latencies (ns) of one in every `sample` lookups,
+        per search path (see ipfilter.LATENCY_PATHS). Lookups pass in
+        recorder.sample and call record() for the sampled ones.
+    '''
+    def __init__(self, sample=100, name='ipfilter_lookup_latency_seconds'):
+        assert sample >= 1
+        self.sample = sample
+        self.name = name
+        self.paths = dict() # path -> Histogram
+
+    def record(self, path, ns):
+        hist = self.paths.get(path)
+        if hist is None:
+            hist = self.paths[path] = Histogram()
+        hist.add(ns)
+
+    def summary(self, quantiles=QUANTILES):
+        '''Returns dict: path -> count, sum, max and `quantiles` of the
+            sampled latencies in ns.
+        '''
+        return {path: {'count': hist.count, 'sum': hist.total, 'max': hist.max,
+                       'quantiles': {str(q): hist.quantile(q) for q in quantiles}}
+                for path, hist in sorted(self.paths.items())}
+
+    def to_json(self, quantiles=QUANTILES):
+        return json.dumps({'unit': 'ns', 'sample': self.sample,
+                           'paths': self.summary(quantiles)}, indent=2)
+
+    def to_prometheus(self, quantiles=QUANTILES):
+        '''Returns the summary in Prometheus text exposition format, one
+            summary metric labeled by path, in seconds.
+        '''
+        lines = ['# HELP %s Lookup latency by search path, 1 in %d lookups sampled.'
+                 %(self.name, self.sample),
+                 '# TYPE %s summary' %self.name]
+        for path, stats in self.summary(quantiles).items():
+            for q, ns in stats['quantiles'].items():
+                lines.append('%s{path="%s",quantile="%s"} %.9f' %(self.name, path, q, ns/1e9))
+            lines.append('%s_sum{path="%s"} %.9f' %(self.name, path, stats['sum']/1e9))
+            lines.append('%s_count{path="%s"} %d' %(self.name, path, stats['count']))
+        return '\n'.join(lines) + '\n'
+
+    def save_json(self, fpath, quantiles=QUANTILES):
+        _write(fpath, self.to_json(quantiles))
+
+    def save_prometheus(self, fpath, quantiles=QUANTILES):
+        _write(fpath, self.to_prometheus(quantiles))
+
+def _write(fpath, text):
+    '''Replace file `fpath` with `text` atomically, so that a reader
+        (e.g. a Prometheus textfile collector) never sees it half written.
+    '''
+    with open(fpath + '.tmp', 'w') as out:
+        out.write(text)
+    os.replace(fpath + '.tmp', fpath)
+
 if __name__ == "__main__":
     @count_invocations
     def plus1(num):
@@ -21,3 +173,25 @@ if __name__ == "__main__":
 
     print(plus1.ncalls) # => 10
 
+    x = 0
+    for i in range(10):
+        x+=instrumented(plus1, enabled=False)(i)
+
+    print(plus1.ncalls) # => 10
+
+    reports = []
+    set_progress(lambda done, total: reports.append(done), interval=60)
+    progress = Progress('processed %.3f', 10)
+    for i in range(10):
+        progress(i)
+    print(reports) # => [0]
+
+    hist = Histogram()
+    for ns in range(1, 100001):
+        hist.add(ns)
+    print([round(hist.quantile(q)/(q*100000), 2) for q in QUANTILES]) # => within 1 +- 1/2**SUB_BITS
+
+    latency = LatencyRecorder(sample=1)
+    for ns in [800, 900, 1000, 25000]:
+        latency.record('bmp', ns)
+    print(latency.to_prometheus())
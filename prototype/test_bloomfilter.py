@@ -0,0 +1,58 @@
+'''
+unit tests for bloomfilter.py, run from this directory with `python -m pytest`
+'''
+import sys
+from mconf import *
+for d in [DATADIR]:
+    sys.path.append(d)
+
+from random import Random
+import numpy as np
+from utils import KEY_WIDTH
+from bloomfilter import BloomFilter, BlockedBloomFilter, CountingBloomFilter
+from hashfuncs import HASH_FUNCS
+
+def _keys(num_keys, width, seed=0):
+    rand = Random(seed)
+    return [rand.getrandbits(8*width) for _ in range(num_keys)]
+
+def test_insert_many_matches_insert():
+    keys = _keys(2000, KEY_WIDTH['v4'])
+    for backend in (BloomFilter, BlockedBloomFilter, CountingBloomFilter):
+        scalar = backend(None, len(keys), k=7, num_bits=10*len(keys), width=KEY_WIDTH['v4'])
+        batch = backend(None, len(keys), k=7, num_bits=10*len(keys), width=KEY_WIDTH['v4'])
+        for key in keys:
+            scalar.insert(key, hashes=range(3, 7))
+        batch.insert_many(np.array(keys, dtype=np.uint64), hashes=range(3, 7))
+        assert scalar.ba == batch.ba
+        if backend is CountingBloomFilter:
+            assert scalar.counters == batch.counters
+
+def test_contains_many_matches_contains():
+    keys = _keys(2000, KEY_WIDTH['v4'])
+    probes = keys[::2] + _keys(2000, KEY_WIDTH['v4'], seed=1)
+    for backend in (BloomFilter, BlockedBloomFilter):
+        bf = backend(None, len(keys), k=7, num_bits=4*len(keys), width=KEY_WIDTH['v4'])
+        bf.insert_many(np.array(keys, dtype=np.uint64), hashes=range(7))
+        words = np.array(probes, dtype=np.uint64)
+        for hashes in (range(7), [0], range(2, 6)):
+            for keep_going in (False, True):
+                assert bf.contains_many(words, hashes=hashes, keep_going=keep_going).tolist()\
+                    == [bf.contains(key, hashes=hashes, keep_going=keep_going) for key in probes]
+
+def test_uninstrumented_filter_counts_nothing():
+    keys = _keys(500, KEY_WIDTH['v4'])
+    words = np.array(keys, dtype=np.uint64)
+    for hash_func, (scalar, _, _) in HASH_FUNCS.items():
+        for backend in (BloomFilter, BlockedBloomFilter, CountingBloomFilter):
+            for instrument in (True, False):
+                bf = backend(None, len(keys), k=7, num_bits=10*len(keys), width=KEY_WIDTH['v4'],
+                             hash_func=hash_func, instrument=instrument)
+                before = scalar.ncalls, BloomFilter._register.ncalls
+                bf.insert_many(words, hashes=range(7))
+                for key in keys:
+                    bf.contains(key, hashes=range(7))
+                bf.contains_many(words, hashes=range(7))
+                bf.hash_many(words)
+                counted = scalar.ncalls != before[0], BloomFilter._register.ncalls != before[1]
+                assert counted == (instrument, instrument), (hash_func, backend)
@@ -0,0 +1,72 @@
+'''
+unit tests for codegen.py, run from this directory with `python -m pytest`
+'''
+import sys
+from mconf import *
+for d in [DATADIR]:
+    sys.path.append(d)
+
+from random import Random
+from utils import compile_fib_table, load_traffic, load_prefixes, encode_ip_prefix_pair,\
+                  prefix_stats
+from bloomfilter import BloomFilter, BlockedBloomFilter
+import ipfilter
+from ipfilter import FPP
+from obst import obst, weigh_equally
+from codegen import compile_lookup
+
+def _traffic(protocol):
+    return Random(0).sample(sorted(load_traffic(protocol=protocol, typ=RANDOM_TRAFFIC)), 5000)
+
+def test_compiled_lookup_matches_helper():
+    for protocol, backend, kwargs in [('v4', BloomFilter, {}), ('v4', BlockedBloomFilter, {}),
+                                      ('v6', BloomFilter, {}), ('v4', BloomFilter,
+                                                               {'bmp_check': 'parity'})]:
+        fib = compile_fib_table(protocol=protocol, instrument=False)
+        pref_stats = prefix_stats(load_prefixes(protocol=protocol))
+        bf, bst = ipfilter.build_bloom_filter(protocol=protocol, lamda=weigh_equally, fpp=FPP,
+                                              fib=fib, pref_stats=pref_stats, backend=backend,
+                                              instrument=False, **kwargs)
+        args = (fib, pref_stats['maxx'], pref_stats['minn'], pref_stats['ix2len'], protocol)
+        lookup = compile_lookup(bf, bst, *args)
+        for ip in _traffic(protocol):
+            assert lookup(ip) == ipfilter._guided_lookup_helper(bf, bst, ip, *args)
+
+def test_compiled_lookup_counts_rejected_pointers():
+    fib = compile_fib_table(protocol='v4', instrument=False)
+    pref_stats = prefix_stats(load_prefixes(protocol='v4'))
+    # a small filter, so that false positive pointers often fail their check
+    bf, bst = ipfilter.build_bloom_filter(protocol='v4', lamda=weigh_equally, fpp=None, k=10,
+                                          num_bits=4*len(pref_stats['prefixes']), fib=fib,
+                                          pref_stats=pref_stats, bmp_check='parity')
+    args = (fib, pref_stats['maxx'], pref_stats['minn'], pref_stats['ix2len'], 'v4')
+    lookup = compile_lookup(bf, bst, *args)
+    rejected = []
+    for func in (lookup, lambda ip: ipfilter._guided_lookup_helper(bf, bst, ip, *args)):
+        before = ipfilter._bmp_rejected.ncalls
+        for ip in _traffic('v4'):
+            func(ip)
+        rejected.append(ipfilter._bmp_rejected.ncalls - before)
+    assert rejected[0] == rejected[1] > 0
+
+def test_compiled_lookup_hits_default_route_node():
+    # a tree with a node for the default route, which the lookup can hit
+    rand = Random(0)
+    routes = {(0, 0)}
+    while len(routes) < 500:
+        preflen = rand.choice([8, 16, 24])
+        routes.add((rand.getrandbits(32) >> (32-preflen) << (32-preflen), preflen))
+    routes = sorted(routes)
+    fib = {encode_ip_prefix_pair(prefix, preflen): 'route %d' %ix
+           for ix, (prefix, preflen) in enumerate(routes)}
+    pref_stats = prefix_stats(routes)
+    bst = obst('v4', lambda protocol: [(1.0, 0), (1.0, 8), (1.0, 16), (1.0, 24)], cache=False)
+    bf, plan = ipfilter.build_bloom_filter(protocol='v4', fpp=FPP, fib=fib, pref_stats=pref_stats,
+                                           plan=bst, instrument=False)
+    assert 0 in plan.vals
+    args = (fib, pref_stats['maxx'], pref_stats['minn'], pref_stats['ix2len'], 'v4')
+    lookup = compile_lookup(bf, plan, *args)
+    ips = [rand.getrandbits(32) for _ in range(5000)]
+    results = [lookup(ip) for ip in ips]
+    assert results == [ipfilter._guided_lookup_helper(bf, plan, ip, *args) for ip in ips]
+    assert (0, 'route 0', 0) in results
@@ -0,0 +1,37 @@
+'''
+unit tests for engine.py, run from this directory with `python -m pytest`
+'''
+import sys
+from mconf import *
+for d in [DATADIR]:
+    sys.path.append(d)
+
+from random import Random
+import numpy as np
+from utils import compile_fib_table, load_traffic, load_prefixes, prefix_stats
+from bloomfilter import BloomFilter, BlockedBloomFilter
+import ipfilter
+from ipfilter import FPP
+from obst import weigh_equally
+from engine import LookupEngine
+
+def test_engine_matches_lookup_batch():
+    for protocol, backend, hops in [('v4', BloomFilter, False), ('v4', BlockedBloomFilter, False),
+                                    ('v4', BloomFilter, True), ('v6', BloomFilter, False)]:
+        fib = compile_fib_table(protocol=protocol, instrument=False)
+        traffic = Random(0).sample(sorted(load_traffic(protocol=protocol, typ=RANDOM_TRAFFIC)), 3000)
+        pref_stats = prefix_stats(load_prefixes(protocol=protocol))
+        next_hops = {key: 'hop %d' %(key % 5) for key in fib} if hops else None
+        bf, bst = ipfilter.build_bloom_filter(protocol=protocol, lamda=weigh_equally, fpp=FPP,
+                                              fib=fib, pref_stats=pref_stats, backend=backend,
+                                              next_hops=next_hops, instrument=False)
+        ips = np.array(traffic, dtype=np.uint64 if protocol == 'v4' else object)
+        pref_lens, fib_vals = ipfilter.lookup_batch(bf, ips, fib, bst, pref_stats['maxx'],
+                                                    pref_stats['minn'], pref_stats['ix2len'],
+                                                    protocol)
+        with LookupEngine(bf, bst, fib, pref_stats, protocol=protocol, workers=2) as engine:
+            res = engine.lookup(ips)
+            empty = engine.lookup(ips[:0])
+        assert res[0].tolist() == pref_lens.tolist()
+        assert list(res[1]) == list(fib_vals)
+        assert len(empty[0]) == len(empty[1]) == 0
@@ -0,0 +1,31 @@
+'''
+unit tests for fnv.py, run from this directory with `python -m pytest`
+'''
+import sys
+from mconf import *
+for d in [DATADIR]:
+    sys.path.append(d)
+
+from random import Random
+import numpy as np
+from utils import KEY_WIDTH
+from fnv import hash_fnv, hash_fnv_many, to_words
+
+def _keys(num_keys, width, seed=0):
+    rand = Random(seed)
+    return [rand.getrandbits(8*width) for _ in range(num_keys)]
+
+def test_hash_fnv_many_matches_scalar():
+    for width in (KEY_WIDTH['v4'], 8, KEY_WIDTH['v6']):
+        keys = _keys(1000, width)
+        words = to_words(keys, width) if width > 8 else np.array(keys, dtype=np.uint64)
+        assert hash_fnv_many(words, width).tolist() == [hash_fnv(key, width) for key in keys]
+
+def test_legacy_hash_fnv_many_matches_scalar():
+    keys = _keys(1000, 4) + [0, 1<<30, 1<<60, (1<<64) - 1]
+    assert hash_fnv_many(np.array(keys, dtype=np.uint64)).tolist() == [hash_fnv(key) for key in keys]
+
+def test_fixed_width_hash_skips_padding():
+    # a fixed width hashes just the key's bytes, not the int object's padding
+    assert hash_fnv(103095992320, KEY_WIDTH['v4']) != hash_fnv(103095992320)
+    assert hash_fnv(5, 5) != hash_fnv(5, 8)
@@ -0,0 +1,41 @@
+'''
+unit tests for hashfuncs.py, run from this directory with `python -m pytest`
+'''
+import sys
+from mconf import *
+for d in [DATADIR]:
+    sys.path.append(d)
+
+from random import Random
+import numpy as np
+from utils import KEY_WIDTH
+from fnv import to_words
+from bloomfilter import BloomFilter
+from hashfuncs import HASH_FUNCS
+
+def _keys(num_keys, width, seed=0):
+    rand = Random(seed)
+    return [rand.getrandbits(8*width) for _ in range(num_keys)]
+
+def test_batch_hashes_match_scalar():
+    for name, (scalar, batch, _) in HASH_FUNCS.items():
+        for width in (KEY_WIDTH['v4'], 8, KEY_WIDTH['v6']):
+            if name == 'fnv' and width > 8: continue # covered in test_fnv.py
+            keys = _keys(1000, width)
+            words = to_words(keys, width) if width > 8 else np.array(keys, dtype=np.uint64)
+            assert batch(words, width).tolist() == [scalar(key, width) for key in keys], name
+
+def test_hash_families_fpp():
+    keys = _keys(4000, KEY_WIDTH['v4'])
+    members, others = keys[:2000], keys[2000:]
+    bits = dict()
+    for name in HASH_FUNCS:
+        bf = BloomFilter(0.01, len(members), width=KEY_WIDTH['v4'], hash_func=name,
+                         instrument=False)
+        hashes_all = list(range(bf.k))
+        for key in members:
+            bf.insert(key, hashes=hashes_all)
+        assert all(bf.contains(key, hashes=hashes_all) for key in members), name
+        assert sum(bool(bf.contains(key, hashes=hashes_all)) for key in others) < 3*0.01*len(others), name
+        bits[name] = bf.ba
+    assert len(set(map(bytes, bits.values()))) == len(HASH_FUNCS)
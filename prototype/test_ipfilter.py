@@ -0,0 +1,451 @@
+'''
+unit tests for ipfilter.py, run from this directory with `python -m pytest`
+'''
+import sys
+from mconf import *
+for d in [DATADIR]:
+    sys.path.append(d)
+
+import pytest
+from copy import copy
+from random import Random
+from collections import Counter
+from ipaddress import IPv4Network
+import numpy as np
+from utils import compile_fib_table, load_traffic, load_prefixes, encode_ip_prefix_pair,\
+                  prefix_stats, CompactFIB
+from bloomfilter import BloomFilter, BlockedBloomFilter, CountingBloomFilter
+import ipfilter
+from ipfilter import NUMBITS, FPP
+from obst import obst, weigh_equally
+from profiler import LatencyRecorder
+from codegen import compile_lookup
+
+def _common_prep(protocol='v4'):
+    fib = compile_fib_table(protocol=protocol, instrument=False)
+    traffic = Random(0).sample(sorted(load_traffic(protocol=protocol, typ=RANDOM_TRAFFIC)), 5000)
+    pref_stats = prefix_stats(load_prefixes(protocol=protocol))
+    return fib, traffic, pref_stats
+
+def _exact_lpm(ip, fib, pref_stats, protocol='v4'):
+    '''(prefix length, FIB value) of the longest route in `fib` covering
+        `ip`, by brute force.
+    '''
+    max_shift = NUMBITS[protocol]
+    for preflen in reversed(pref_stats['ix2len']):
+        masked = (((1<<max_shift) - 1) << (max_shift-preflen)) & ip
+        key = encode_ip_prefix_pair(masked, preflen, protocol)
+        if key in fib:
+            return preflen, fib[key]
+    return pref_stats['ix2len'][0], None
+
+def _assert_guided_lpm(results, traffic, fib, pref_stats, protocol='v4'):
+    '''Guided lookups are exact LPM but for a false positive hit whose
+        pointer decodes to a shorter route that also covers the IP and
+        verifies: allow those, if rare.
+    '''
+    shorter = 0
+    for (preflen, fib_val), ip in zip(results, traffic):
+        exact = _exact_lpm(ip, fib, pref_stats, protocol)
+        if (preflen, fib_val) != exact:
+            assert preflen < exact[0]
+            assert _exact_lpm(ip, fib, dict(pref_stats, ix2len=[0, preflen]), protocol)\
+                == (preflen, fib_val)
+            shorter += 1
+    assert shorter < len(traffic) / 100
+
+def _guided(fib, pref_stats, protocol='v4', **kwargs):
+    kwargs.setdefault('fpp', FPP)
+    return ipfilter.build_bloom_filter(protocol=protocol, lamda=weigh_equally, fib=fib,
+                                       pref_stats=pref_stats, instrument=False, **kwargs)
+
+def test_linear_lookup_matches_exact_lpm():
+    for protocol in ('v4', 'v6'):
+        fib, traffic, pref_stats = _common_prep(protocol)
+        bf, _ = ipfilter.build_bloom_filter(protocol=protocol, fpp=FPP, pref_stats=pref_stats,
+                                            instrument=False)
+        hashes = list(range(bf.k))
+        for table in (fib, CompactFIB.from_fib(fib, protocol)):
+            for ip in traffic:
+                assert ipfilter._linear_lookup_helper(bf, hashes, ip, pref_stats['maxx'],
+                                                      pref_stats['minn'], table, protocol)[:2]\
+                    == _exact_lpm(ip, fib, pref_stats, protocol)
+
+def test_guided_lookup_matches_exact_lpm():
+    for protocol in ('v4', 'v6'):
+        fib, traffic, pref_stats = _common_prep(protocol)
+        bf, bst = _guided(fib, pref_stats, protocol)
+        args = (pref_stats['maxx'], pref_stats['minn'], pref_stats['ix2len'], protocol)
+        results = [ipfilter._guided_lookup_helper(bf, bst, ip, fib, *args)[:2] for ip in traffic]
+        _assert_guided_lpm(results, traffic, fib, pref_stats, protocol)
+        # the same from a CompactFIB
+        compact = CompactFIB.from_fib(fib, protocol)
+        assert [ipfilter._guided_lookup_helper(bf, bst, ip, compact, *args)[:2]
+                for ip in traffic] == results
+
+def test_allocate_bits():
+    bits = ipfilter._allocate_bits([1000, 1000, 10], [1.0, 0.1, 0.5], 20000)
+    assert sum(bits) - 20000 in range(len(bits)) # rounded up
+    assert bits[0] > bits[1] # same keys, reached more often
+    assert min(bits) >= ipfilter.MIN_BITS_PER_KEY * 10
+
+def test_partitioned_filter_holds_every_key():
+    fib, traffic, pref_stats = _common_prep('v4')
+    for partition in ('level', 'length'):
+        bf, bst = _guided(fib, pref_stats, fpp=None, k=10, num_bits=8*len(pref_stats['prefixes']),
+                          partition=partition, traffic=traffic)
+        assert str(bf).startswith('PartitionedBloomFilter(')
+        assert bf.num_bytes() == sum((sub.num_bits + 7)//8 for sub in bf.filters)
+        for pref_len, keys in ipfilter._tree_keys(pref_stats['prefixes'], bst).items():
+            for key in keys:
+                assert bf.contains(key, hashes=[0])
+
+def _empty_like(bf):
+    return type(bf)(None, bf.num_elements, k=bf.k, num_bits=bf.num_bits, width=bf.width,
+                    hash_func=bf.hash_func, instrument=False)
+
+def test_parallel_build_matches_serial():
+    for protocol in ('v4', 'v6'):
+        fib, _, pref_stats = _common_prep(protocol)
+        for backend in (BloomFilter, BlockedBloomFilter):
+            serial, bst = _guided(fib, pref_stats, protocol, backend=backend)
+            groups = ipfilter._group_marker_table(
+                ipfilter._marker_table(pref_stats, bst, protocol, instrument=False), serial.k,
+                layout=ipfilter._bmp_layout(serial, protocol)[:2])
+            for workers in (1, 3):
+                parallel = ipfilter._build_guided_parallel(_empty_like(serial), groups, workers)
+                assert parallel.ba == serial.ba
+            assert _guided(fib, pref_stats, protocol, backend=backend, workers=2)[0].ba == serial.ba
+
+def test_fallbacks_match_linear():
+    for protocol in ('v4', 'v6'):
+        fib, traffic, pref_stats = _common_prep(protocol)
+        args = (fib, pref_stats['maxx'], pref_stats['minn'], pref_stats['ix2len'], protocol)
+        k = 10 if protocol == 'v4' else 14
+        for bits in (4, 16): # small filters, so that most lookups fall back
+            bf, bst = _guided(fib, pref_stats, protocol, fpp=None, k=k,
+                              num_bits=bits*len(pref_stats['prefixes']))
+            results = {fallback: [ipfilter._guided_lookup_helper(bf, bst, ip, *args,
+                                                                 fallback=fallback)[:2]
+                                  for ip in traffic]
+                       for fallback in ipfilter.FALLBACKS}
+            for fallback in ipfilter.FALLBACKS:
+                assert results[fallback] == results['linear'], fallback
+
+def test_bmp_layout_fits_k():
+    routes = _synthetic_routes()
+    pref_stats = prefix_stats(routes)
+    plan = ipfilter.SearchPlan.compile(_tree(pref_stats))
+    deepest = max(len(plan.paths[val][0]) + 1 for val in plan.vals)
+    fib = _fib(routes)
+    for check in ipfilter.BMP_CHECKS:
+        k = ipfilter.bmp_min_k(plan, pref_stats['ix2len'], check)
+        with pytest.raises(ValueError):
+            _guided(fib, pref_stats, fpp=None, k=k-1, num_bits=1000, plan=plan, bmp_bits='auto',
+                    bmp_check=check)
+        with pytest.raises(ValueError): # the default width is too wide too
+            _guided(fib, pref_stats, fpp=None, k=deepest+ipfilter.ENCODING['v4'], num_bits=1000,
+                    plan=plan, bmp_check='berger')
+        # 'auto' takes the hash funcs left after the deepest hit
+        for extra in (0, 3):
+            bf, _ = _guided(fib, pref_stats, fpp=None, k=k+extra, num_bits=1000, plan=plan,
+                            bmp_bits='auto', bmp_check=check)
+            bits, _, width = ipfilter._bmp_layout(bf)
+            assert bits >= ipfilter.bmp_width(pref_stats['ix2len'])
+            assert deepest + bits + width <= bf.k < deepest + bits+1 + ipfilter._check_width(bits+1, check)
+
+def test_corrupted_bmp_pointer_is_rejected():
+    routes = _synthetic_routes()
+    pref_stats = prefix_stats(routes)
+    fib = _fib(routes)
+    bf, plan = ipfilter.build_bloom_filter(fpp=None, k=12, num_bits=32*len(routes), fib=fib,
+                                           pref_stats=pref_stats, plan=_tree(pref_stats),
+                                           bmp_check='parity')
+    table = ipfilter._marker_table(pref_stats, plan, instrument=False)
+    bits, check, width = ipfilter._bmp_layout(bf)
+    corrupted = 0
+    for route, route_len in routes:
+        for count_hit, node in enumerate(plan.paths[route_len][0], 1):
+            prefix, preflen = route & plan.masks[node], plan.vals[node]
+            key = encode_ip_prefix_pair(prefix, preflen)
+            if table[key] is None: continue # also a route
+            args = (bf, plan, prefix, node, count_hit, fib, pref_stats['ix2len'], 'v4')
+            word = bf.contains(key, hashes=range(count_hit, count_hit+bits+width), keep_going=True)
+            if word != ipfilter._bmp_codeword(table[key][1], bits, check) or\
+                    ipfilter._verify_bmp(*args, {preflen: bf.hash_key(key)}) is None:
+                continue # already read wrong, or seen
+            # set one bit the pointer left unset, as another key's insert would
+            flip = next(i for i in range(bits+width) if not word >> i & 1)
+            bf.insert(key, hashes=[count_hit+flip])
+            rejected = ipfilter._bmp_rejected.ncalls
+            assert ipfilter._verify_bmp(*args, {preflen: bf.hash_key(key)}) is None
+            assert ipfilter._bmp_rejected.ncalls == rejected + 1
+            corrupted += 1
+    assert corrupted > 100
+
+def test_lookup_batch_matches_scalar():
+    for protocol, backend in [('v4', BloomFilter), ('v4', BlockedBloomFilter), ('v6', BloomFilter)]:
+        fib, traffic, pref_stats = _common_prep(protocol)
+        next_hops = {key: 'hop %d' %(key % 5) for key in fib}
+        for kwargs in ({}, {'bmp_check': 'berger'}, {'next_hops': next_hops}):
+            bf, bst = _guided(fib, pref_stats, protocol, backend=backend, **kwargs)
+            args = (pref_stats['maxx'], pref_stats['minn'], pref_stats['ix2len'], protocol)
+            ips = np.array(traffic, dtype=np.uint64 if protocol == 'v4' else object)
+            pref_lens, fib_vals = ipfilter.lookup_batch(bf, ips, fib, bst, *args)
+            assert list(zip(pref_lens.tolist(), fib_vals))\
+                == [ipfilter._guided_lookup_helper(bf, bst, ip, fib, *args)[:2] for ip in traffic]
+
+def test_lookup_stream_matches_per_ip():
+    fib, traffic, pref_stats = _common_prep('v4')
+    args = (pref_stats['maxx'], pref_stats['minn'], pref_stats['ix2len'], 'v4')
+    guided, bst = _guided(fib, pref_stats)
+    linear, _ = ipfilter.build_bloom_filter(protocol='v4', fpp=FPP, pref_stats=pref_stats,
+                                            instrument=False)
+    for bf, root in ((linear, None), (guided, bst)):
+        if root is None:
+            hashes = list(range(bf.k))
+            expected = [(ip,) + ipfilter._linear_lookup_helper(bf, hashes, ip, args[0], args[1],
+                                                               fib, 'v4')[:2] for ip in traffic]
+        else:
+            expected = [(ip,) + ipfilter._guided_lookup_helper(bf, root, ip, fib, *args)[:2]
+                        for ip in traffic]
+        # IPs from a generator, in chunks that do not divide the traffic
+        per_ip = ipfilter.lookup_stream(bf, iter(traffic), fib, root, *args, chunk_size=777,
+                                        per_ip=True)
+        assert list(per_ip) == expected
+        chunks = list(ipfilter.lookup_stream(bf, iter(traffic), fib, root, *args, chunk_size=777))
+        assert [len(ips) for ips, _, _ in chunks] == [777]*6 + [len(traffic) - 6*777]
+        assert [triple for ips, pref_lens, fib_vals in chunks
+                for triple in zip(ips.tolist(), pref_lens.tolist(), fib_vals.tolist())] == expected
+
+def test_hybrid_lookup_matches_exact_lpm():
+    fib, traffic, pref_stats = _common_prep('v4')
+    # the direct-indexed array alone, for routes no longer than its stride, is exact
+    short = prefix_stats([(prefix, preflen) for prefix, preflen in pref_stats['prefixes']
+                          if preflen <= 20])
+    short_fib = {encode_ip_prefix_pair(prefix, preflen): fib[encode_ip_prefix_pair(prefix, preflen)]
+                 for prefix, preflen in short['prefixes']}
+    hybrid = ipfilter.HybridFilter(short, short_fib, stride=20, fpp=FPP, instrument=False)
+    assert hybrid.bf is None
+    for ip in traffic:
+        assert hybrid.lookup(ip)[:2] == _exact_lpm(ip, short_fib, short)
+    for stride in (8, 16, 20):
+        hybrid = ipfilter.HybridFilter(pref_stats, fib, stride=stride, fpp=FPP, instrument=False)
+        _assert_guided_lpm([hybrid.lookup(ip)[:2] for ip in traffic], traffic, fib, pref_stats)
+
+def test_lookup_latency_sampled_per_path():
+    fib, traffic, pref_stats = _common_prep('v4')
+    args = (pref_stats['maxx'], pref_stats['minn'], pref_stats['ix2len'], 'v4')
+    # a small filter, so that some lookups fall back
+    guided, bst = _guided(fib, pref_stats, fpp=None, k=10,
+                          num_bits=4*len(pref_stats['prefixes']))
+    linear, _ = ipfilter.build_bloom_filter(protocol='v4', fpp=FPP, pref_stats=pref_stats,
+                                            instrument=False)
+    for bf, root, paths in ((linear, None, {'linear'}), (guided, bst, {'bmp', 'fallback'})):
+        latency = LatencyRecorder(sample=7)
+        ipfilter.lookup_in_bloom(bf, traffic, fib, root, *args, latency=latency)
+        assert paths <= set(latency.paths) <= set(ipfilter.LATENCY_PATHS)
+        assert sum(hist.count for hist in latency.paths.values()) == -(-len(traffic) // 7)
+    # served from the cache the second time round
+    cache = ipfilter.RouteCache(len(traffic), instrument=False)
+    ipfilter.lookup_in_bloom(guided, traffic, fib, bst, *args, cache=cache)
+    latency = LatencyRecorder(sample=7)
+    ipfilter.lookup_in_bloom(guided, traffic, fib, bst, *args, cache=cache, latency=latency)
+    assert list(latency.paths) == ['cache']
+
+def test_cached_lookup_matches_uncached():
+    fib, traffic, pref_stats = _common_prep('v4')
+    args = (pref_stats['maxx'], pref_stats['minn'], pref_stats['ix2len'], 'v4')
+    guided, bst = _guided(fib, pref_stats)
+    linear, _ = ipfilter.build_bloom_filter(protocol='v4', fpp=FPP, pref_stats=pref_stats,
+                                            instrument=False)
+    for aggregate in (None, 24):
+        for bf, root in ((linear, None), (guided, bst)):
+            cache = ipfilter.RouteCache(len(traffic), pref_stats['prefixes'],
+                                        aggregate=aggregate, instrument=False)
+            for _ in range(2): # fill, then served from the cache
+                ipfilter.lookup_in_bloom(bf, traffic, fib, root, *args, cache=cache)
+            # a key (IP or aggregate) keeps the result of the first IP looked up under it
+            first = dict()
+            for ip in traffic:
+                res = _exact_lpm(ip, fib, pref_stats) if root is None else\
+                      ipfilter._guided_lookup_helper(bf, root, ip, fib, *args)[:2]
+                first.setdefault(cache._key(ip), res)
+                assert cache.get(ip) == first[cache._key(ip)]
+            if root is None: # linear lookups are exact, so then are the aggregates
+                for ip in traffic:
+                    assert cache.get(ip) == _exact_lpm(ip, fib, pref_stats)
+                    neighbour = cache.get(ip ^ 0xff)
+                    assert neighbour is None or neighbour == _exact_lpm(ip ^ 0xff, fib, pref_stats)
+
+def test_route_cache_evicts_unreferenced():
+    cache = ipfilter.RouteCache(4, instrument=False)
+    for ip in range(4):
+        cache.put(ip, 32, ip)
+    cache.get(0) # referenced again, the others only when put
+    cache.put(4, 32, 4) # one pass clears every bit, then evicts the first slot
+    cache.put(5, 32, 5) # slot 1 was not referenced since
+    assert [cache.get(ip) for ip in range(6)]\
+        == [None, None, (32, 2), (32, 3), (32, 4), (32, 5)]
+    assert len(cache.slots) == cache.capacity
+
+def test_route_cache_aggregate_needs_prefixes():
+    with pytest.raises(ValueError):
+        ipfilter.RouteCache(16, aggregate=24)
+
+def _plan_fields(plan):
+    return plan.protocol, plan.vals, plan.lefts, plan.rights, plan.masks, plan.paths
+
+def test_search_plan_save_load(tmp_path):
+    for protocol in ('v4', 'v6'):
+        fib, traffic, pref_stats = _common_prep(protocol)
+        bst = obst(protocol, weigh_equally)
+        plan = ipfilter.SearchPlan.compile(bst, protocol)
+        assert _plan_fields(ipfilter.SearchPlan.compile(plan.to_tree(), protocol))\
+            == _plan_fields(plan)
+        plan.save(tmp_path / ('plan_%s.json' %protocol))
+        loaded = ipfilter.SearchPlan.load(tmp_path / ('plan_%s.json' %protocol))
+        assert _plan_fields(loaded) == _plan_fields(plan)
+
+        # a filter built for the loaded plan is the one built by obst()
+        bf, _ = _guided(fib, pref_stats, protocol, plan=loaded)
+        rebuilt, compiled = _guided(fib, pref_stats, protocol)
+        assert bf.ba == rebuilt.ba
+        args = (pref_stats['maxx'], pref_stats['minn'], pref_stats['ix2len'], protocol)
+        assert [ipfilter._guided_lookup_helper(bf, loaded, ip, fib, *args) for ip in traffic]\
+            == [ipfilter._guided_lookup_helper(rebuilt, compiled, ip, fib, *args)
+                for ip in traffic]
+
+def _synthetic_routes(seed=0):
+    '''Routes around a /16 route and a /16 with no route of its own, each
+        with 300 host routes in its first /20, so that whatever the tree
+        the markers above /20 are shared by more prefixes than an 8-bit
+        counter holds; plus random routes.
+    '''
+    rand = Random(seed)
+    routes = {(10<<24, 8), ((10<<24) + (1<<16), 16)}
+    for second in (1, 2):
+        routes.update(((10<<24) + (second<<16) + 13*host, 32) for host in range(300))
+    while len(routes) < 1200:
+        preflen = rand.choice([8, 12, 16, 20, 24, 28, 32])
+        routes.add((rand.getrandbits(32) >> (32-preflen) << (32-preflen), preflen))
+    return sorted(routes)
+
+def _fib(routes, protocol='v4'):
+    return {encode_ip_prefix_pair(prefix, preflen, protocol): str(IPv4Network((prefix, preflen)))
+            for prefix, preflen in routes}
+
+def _tree(pref_stats, protocol='v4'):
+    lens = [pref_len for pref_len in pref_stats['ix2len'] if pref_len > 0]
+    return obst(protocol, lambda protocol: [(1.0, pref_len) for pref_len in lens], cache=False)
+
+def test_next_hops_match_fib():
+    routes = _synthetic_routes()
+    pref_stats = prefix_stats(routes)
+    fib = {key: 'link %d' %(key % 16) for key in _fib(routes)}
+    # a small filter, so that decoded next hops are often wrong
+    bf, plan = _guided(fib, pref_stats, fpp=None, k=10, num_bits=8*len(routes),
+                       plan=_tree(pref_stats), next_hops=fib)
+    fib_mode = copy(bf)
+    fib_mode.hops = None # the same bits, next hops from the FIB only
+    args = (fib, pref_stats['maxx'], pref_stats['minn'], pref_stats['ix2len'], 'v4')
+    rand = Random(1)
+    ips = [rand.getrandbits(32) for _ in range(2000)]
+    ips += [prefix + rand.getrandbits(32-preflen) for prefix, preflen in routes]
+    results = [ipfilter._guided_lookup_helper(bf, plan, ip, *args) for ip in ips]
+    assert results == [ipfilter._guided_lookup_helper(fib_mode, plan, ip, *args) for ip in ips]
+    pref_lens, fib_vals = ipfilter.lookup_batch(bf, np.array(ips, dtype=np.uint64), fib, plan,
+                                                *args[1:])
+    assert list(zip(pref_lens.tolist(), fib_vals)) == [res[:2] for res in results]
+    lookup = compile_lookup(bf, plan, *args)
+    assert [lookup(ip) for ip in ips] == results
+
+def test_guided_filter_churn_matches_rebuild():
+    routes = _synthetic_routes()
+    pref_stats = prefix_stats(routes)
+    bst = _tree(pref_stats)
+    num_bits = 16*len(routes)
+    gf = ipfilter.GuidedFilter(pref_stats, bst, _fib(routes), fpp=None, k=10,
+                               num_bits=num_bits, instrument=False)
+    root = gf.root.vals[0]
+    sharing = Counter(prefix & gf.root.masks[0] for prefix, preflen in routes if preflen > root)
+    assert max(sharing.values()) > gf.bf.max_count
+
+    rand = Random(1)
+    withdrawn = rand.sample(gf.routes, len(gf.routes)//2)
+    for prefix, preflen in withdrawn:
+        gf.withdraw(prefix, preflen)
+    for prefix, preflen in rand.sample(withdrawn, len(withdrawn)//2):
+        gf.announce(prefix, preflen)
+    for prefix, preflen in rand.sample(gf.routes, len(gf.routes)//10):
+        gf.withdraw(prefix, preflen)
+
+    remaining = dict(pref_stats, prefixes=list(gf.routes))
+    rebuilt, _ = ipfilter.build_bloom_filter(fpp=None, k=10, num_bits=num_bits, fib=gf.fib,
+                                             pref_stats=remaining, plan=gf.root,
+                                             instrument=False)
+    assert gf.bf.saturated() == 0
+    assert gf.bf.ba == rebuilt.ba
+    assert set(gf.fib) == gf.bf.route_keys
+
+    fresh = ipfilter.GuidedFilter(remaining, bst, _fib(gf.routes), fpp=None, k=10,
+                                  num_bits=num_bits, instrument=False)
+    assert gf.bf.table == fresh.bf.table
+    assert gf.bf.counters == fresh.bf.counters
+
+    ips = [rand.getrandbits(32) for _ in range(2000)]
+    ips += [prefix + rand.getrandbits(32-preflen) for prefix, preflen in routes]
+    for ip in ips:
+        assert gf.lookup(ip) == ipfilter._guided_lookup_helper(
+            rebuilt, gf.root, ip, gf.fib, pref_stats['maxx'], pref_stats['minn'],
+            pref_stats['ix2len'], 'v4')
+
+def test_withdraw_prefix_matches_rebuild():
+    routes = _synthetic_routes()
+    pref_stats = prefix_stats(routes)
+    bst = _tree(pref_stats)
+    num_bits = 16*len(routes)
+    bf, plan = _guided(_fib(routes), pref_stats, fpp=None, k=10, num_bits=num_bits,
+                       plan=bst, backend=CountingBloomFilter)
+    fib = _fib(routes)
+    for prefix, preflen in Random(2).sample(routes, len(routes)//3):
+        ipfilter.withdraw_prefix(bf, prefix, preflen, root=plan, fib=fib)
+
+    remaining = dict(pref_stats, prefixes=list(bf.routes))
+    rebuilt, _ = _guided(fib, remaining, fpp=None, k=10, num_bits=num_bits, plan=plan)
+    assert bf.ba == rebuilt.ba
+    assert set(fib) == bf.route_keys
+
+def _walk(bf, plan, ip):
+    '''Count of nodes of `plan` the walk down it visits for `ip`.'''
+    node, depth = 0, 0
+    while node >= 0:
+        key = encode_ip_prefix_pair(plan.masks[node] & ip, plan.vals[node])
+        node = plan.rights[node] if bf.contains(key, hashes=[0]) else plan.lefts[node]
+        depth += 1
+    return depth
+
+def test_adaptive_filter_follows_traffic():
+    routes = _synthetic_routes()
+    pref_stats = prefix_stats(routes)
+    lens = [pref_len for pref_len in pref_stats['ix2len'] if pref_len > 0]
+    fib = _fib(routes)
+    rand = Random(2)
+    # mostly IPs under the host routes, which walk past their BMP on markers
+    traffic = [(10<<24) + (rand.choice([1, 2])<<16) + rand.getrandbits(12) for _ in range(3000)]
+    traffic += [rand.getrandbits(32) for _ in range(1000)]
+    adaptive = ipfilter.AdaptiveFilter(pref_stats, fib, lamda=lambda protocol: [(1.0, pref_len)
+                                                                                 for pref_len in lens],
+                                       fpp=None, k=12, num_bits=32*len(routes),
+                                       interval=len(traffic), instrument=False)
+    equal_bf, equal_plan = adaptive.bf, adaptive.root
+    for ip in traffic:
+        adaptive.lookup(ip)
+    assert adaptive.maybe_rebuild()
+    for ip in traffic[:200]: # the deepest length matching a route at least as long
+        assert ipfilter._deepest_match(ip, adaptive.tree_lens, adaptive.keys) ==\
+            max([pref_len for pref_len in lens for prefix, preflen in routes
+                 if preflen >= pref_len and (prefix ^ ip) >> (32-pref_len) == 0], default=0)
+    assert sum(_walk(adaptive.bf, adaptive.root, ip) for ip in traffic) <\
+        sum(_walk(equal_bf, equal_plan, ip) for ip in traffic)
+    _assert_guided_lpm([adaptive.lookup(ip)[:2] for ip in traffic], traffic, fib, pref_stats)
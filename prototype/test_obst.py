@@ -0,0 +1,92 @@
+'''
+unit tests for obst.py, run from this directory with `python -m pytest`
+'''
+import sys
+from mconf import *
+for d in [DATADIR]:
+    sys.path.append(d)
+
+import os
+import pytest
+from random import Random
+import obst
+
+def _cubic_cost(weights, gaps):
+    '''Expected cost of the optimal tree, trying every root of every
+        subtree: the O(n^3) dynamic program the Knuth bound prunes.
+    '''
+    n = len(weights)
+    w = obst._construct_w_tab(weights, gaps)
+    e = [[0.0] * (n+1) for _ in range(n+1)]
+    for i in range(n+1):
+        e[i][i] = gaps[i]
+    for l in range(1, n+1):
+        for i in range(n+1-l):
+            j = i + l
+            e[i][j] = min(e[i][root-1] + e[root][j] for root in range(i+1, j+1)) + w[i][j]
+    return e[0][n]
+
+def _tree_cost(tree, weights, gaps):
+    '''Expected cost of `tree`: the count of nodes a search visits for
+        each prefix length, and for each gap between two plus its leaf,
+        weighted.
+    '''
+    def visits(target):
+        node, count = tree, 0
+        while node is not None:
+            count += 1
+            if target == node.val: break
+            node = node.right if target > node.val else node.left
+        return count
+    lens = [pref_len for _, pref_len in weights]
+    cost = sum(p * visits(pref_len) for p, pref_len in weights)
+    cost += gaps[0] * (visits(lens[0] - 0.5) + 1)
+    cost += sum(q * (visits(pref_len + 0.5) + 1) for q, pref_len in zip(gaps[1:], lens))
+    return cost
+
+def _random_weights(rand, n):
+    lens = sorted(rand.sample(range(1, 129), n))
+    return [(rand.random(), pref_len) for pref_len in lens],\
+           [rand.random() * rand.choice([0, 1]) for _ in range(n+1)]
+
+def test_knuth_tree_is_optimal():
+    rand = Random(0)
+    cases = [_random_weights(rand, n) for n in (1, 2, 3, 8, 15, 40) for _ in range(5)]
+    cases += [(obst.weigh_equally(protocol), None) for protocol in ('v4', 'v6')]
+    for weights, gaps in cases:
+        _, e, _ = obst._construct_tabs(weights, gaps)
+        gaps = gaps or [0.0] * (len(weights)+1)
+        assert e[0][-1] == pytest.approx(_cubic_cost(weights, gaps))
+        tree = obst.obst(weigh=lambda protocol: weights, gaps=gaps, cache=False)
+        assert _tree_cost(tree, weights, gaps) == pytest.approx(e[0][-1])
+
+def test_tree_cache_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(obst, 'TREEDIR', str(tmp_path))
+    monkeypatch.setattr(obst, '_trees', dict())
+    weights, gaps = _random_weights(Random(1), 20)
+    weigh = lambda protocol: weights
+    built = obst._to_lists(obst.obst('v6', weigh, gaps=gaps))
+    key = obst._cache_key('v6', weights, gaps)
+    assert os.listdir(tmp_path) == [key + '.json']
+
+    def no_dp(*args):
+        raise AssertionError('memoized tree recomputed')
+    monkeypatch.setattr(obst, '_construct_tabs', no_dp)
+    assert obst._to_lists(obst.obst('v6', weigh, gaps=gaps)) == built # in memory
+    monkeypatch.setattr(obst, '_trees', dict())
+    assert obst._to_lists(obst.obst('v6', weigh, gaps=gaps)) == built # from disk
+    # other weights or protocol miss the cache
+    assert obst._cache_key('v4', weights, gaps) != key
+    assert obst._cache_key('v6', weights, gaps[::-1]) != key
+    with pytest.raises(AssertionError):
+        obst.obst('v4', weigh, gaps=gaps)
+
+    # an unreadable file is rebuilt and replaced
+    monkeypatch.undo()
+    monkeypatch.setattr(obst, 'TREEDIR', str(tmp_path))
+    monkeypatch.setattr(obst, '_trees', dict())
+    with open(os.path.join(tmp_path, key + '.json'), 'w') as outfile:
+        outfile.write('[15, nul')
+    assert obst._to_lists(obst.obst('v6', weigh, gaps=gaps)) == built
+    monkeypatch.setattr(obst, '_trees', dict())
+    assert obst._cached_tree(key) is not None
@@ -0,0 +1,54 @@
+'''
+unit tests for profiler.py, run from this directory with `python -m pytest`
+'''
+import sys
+from mconf import *
+for d in [DATADIR]:
+    sys.path.append(d)
+
+import json
+from random import Random
+from profiler import Histogram, LatencyRecorder, SUB_BITS, QUANTILES
+
+def test_histogram_quantiles_within_bucket_width():
+    rand = Random(0)
+    values = sorted(int(rand.expovariate(1e-5)) for _ in range(10000))
+    hist = Histogram()
+    for value in values:
+        hist.add(value)
+    assert (hist.count, hist.total, hist.max) == (len(values), sum(values), values[-1])
+    for q in (0.0, 0.5, 0.9, 0.99, 0.999, 1.0):
+        exact = values[max(0, int(q*len(values)) - 1)]
+        assert abs(hist.quantile(q) - exact) <= exact / 2**SUB_BITS + 1, q
+    # small values are exact
+    hist = Histogram()
+    for value in range(2**(SUB_BITS+1)):
+        hist.add(value)
+    assert [hist.quantile((value+1) / hist.count) for value in range(hist.count)]\
+        == list(range(2**(SUB_BITS+1)))
+
+def test_latency_recorder_exports(tmp_path):
+    recorder = LatencyRecorder(sample=10, name='lookup_seconds')
+    for ns in range(1000, 2000):
+        recorder.record('bmp', ns)
+    recorder.record('fallback', 50000)
+    summary = recorder.summary()
+    assert list(summary) == ['bmp', 'fallback']
+    assert summary['fallback'] == {'count': 1, 'sum': 50000, 'max': 50000,
+                                   'quantiles': {str(q): 50000 for q in QUANTILES}}
+    assert summary['bmp']['count'] == 1000 and summary['bmp']['max'] == 1999
+
+    recorder.save_json(str(tmp_path / 'latency.json'))
+    with open(tmp_path / 'latency.json') as infile:
+        saved = json.load(infile)
+    assert saved == {'unit': 'ns', 'sample': 10, 'paths': summary}
+
+    recorder.save_prometheus(str(tmp_path / 'latency.prom'))
+    with open(tmp_path / 'latency.prom') as infile:
+        lines = infile.read().splitlines()
+    assert lines[:2] == ['# HELP lookup_seconds Lookup latency by search path, 1 in 10 lookups sampled.',
+                         '# TYPE lookup_seconds summary']
+    assert 'lookup_seconds{path="fallback",quantile="0.99"} 0.000050000' in lines
+    assert 'lookup_seconds_count{path="bmp"} 1000' in lines
+    assert 'lookup_seconds_sum{path="bmp"} %.9f' %(sum(range(1000, 2000))/1e9) in lines
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['latency.json', 'latency.prom']
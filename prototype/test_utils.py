@@ -0,0 +1,53 @@
+'''
+unit tests for utils.py, run from this directory with `python -m pytest`
+'''
+import sys
+from mconf import *
+for d in [DATADIR]:
+    sys.path.append(d)
+
+import pytest
+from random import Random
+import numpy as np
+from utils import compile_fib_table, CompactFIB, KEY_WIDTH
+from fnv import to_words
+
+def test_compact_fib_matches_dict():
+    for protocol in ('v4', 'v6'):
+        fib = compile_fib_table(protocol=protocol, instrument=False)
+        fib[min(fib)] = 'hop a' # values other than the route's CIDR string are interned
+        fib[max(fib)] = 'hop a'
+        for render in (True, False):
+            compact = CompactFIB.from_fib(fib, protocol, render=render)
+            assert len(compact) == len(fib)
+            assert compact.items() == sorted(fib.items())
+            assert len(compact.hops) == (1 if render else len(set(fib.values())))
+
+            rand = Random(0)
+            absent = [rand.getrandbits(8*KEY_WIDTH[protocol]) for _ in range(1000)]
+            keys = rand.sample(sorted(fib), 1000) + absent
+            for key in keys:
+                assert (key in compact) == (key in fib)
+                if key in fib:
+                    assert compact[key] == fib[key]
+                else:
+                    with pytest.raises(KeyError):
+                        compact[key]
+            words = to_words(keys, KEY_WIDTH[protocol]) if protocol == 'v6' else\
+                    np.array(keys, dtype=np.uint64)
+            assert compact.contains_many(words).tolist() == [key in fib for key in keys]
+            assert [compact.value(ix) for ix in compact.index_many(words) if ix >= 0]\
+                == [fib[key] for key in keys if key in fib]
+
+def test_uninstrumented_compact_fib_counts_nothing():
+    fib = compile_fib_table(protocol='v4', instrument=False)
+    keys = sorted(fib)[:100]
+    words = np.array(keys, dtype=np.uint64)
+    for instrument in (True, False):
+        compact = CompactFIB.from_fib(fib, 'v4', instrument=instrument)
+        before = CompactFIB.__contains__.ncalls, CompactFIB.__getitem__.ncalls
+        for key in keys:
+            if key in compact: compact[key]
+        compact.contains_many(words)
+        assert CompactFIB.__contains__.ncalls - before[0] == (2*len(keys) if instrument else 0)
+        assert CompactFIB.__getitem__.ncalls - before[1] == (len(keys) if instrument else 0)
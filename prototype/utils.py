@@ -1,6 +1,6 @@
 '''Convenience functions to load inputs for testing:
 
-    - Compile FIB table for testing.
+    - Compile FIB table for testing (or a compact, array-backed one).
     - Load traffic from preprocessed files.
     - Load prefixes from preprocessed files.
 '''
@@ -12,8 +12,13 @@ for d in [IPV4DIR, IPV6DIR]:
 
 from profiler import count_invocations
 from random import shuffle
+from ipaddress import IPv4Network, IPv6Network
+from sys import getsizeof
+import numpy as np
+from fnv import to_words
 
 ENCODING={'v4':32,'v6':128}
+KEY_WIDTH={'v4':5,'v6':17} # bytes in an encoded (ip, prefix_len) pair
 
 class FIB:
     '''Define a custom dict to record the count of lookups.
@@ -50,22 +55,153 @@ class FIB:
     def items(self):
         return self.__dict__.items()
 
+def _sorted_rows(words):
+    '''View keys (uint64 array, or to_words() rows) as one opaque value per
+        key that sorts like the keys: words most significant first, each
+        big-endian. Returns the (len(keys), words) big-endian array and
+        the view.
+    '''
+    words = np.asarray(words, dtype=np.uint64)
+    if words.ndim == 1: words = words[:, None]
+    words = np.ascontiguousarray(words[:, ::-1], dtype='>u8')
+    return words, words.view('V%d' %(8*words.shape[1])).ravel()
+
+class CompactFIB:
+    '''Read-only FIB in NumPy arrays: the encoded keys sorted, `words`
+        holding one row of to_words() words per key (most significant word
+        first and big-endian, so rows compare like the keys), and per key an index
+        into `hops`, the distinct FIB values. A value that is just the
+        route's own CIDR string, as from compile_fib_table(), can be left
+        out (index -1) and rendered on access instead, saving its memory at
+        some cost per access. With `hop_ix` None the value of a key is its row.
+
+        Lookups are binary searches (np.searchsorted), of one key as in a
+        FIB or of a whole batch of keys (contains_many(), index_many()).
+        Counts lookups in __contains__.ncalls and __getitem__.ncalls as FIB,
+        unless built with `instrument` unset.
+    '''
+    def __init__(self, keys, hop_ix=None, hops=None, protocol='v4', instrument=True):
+        self.words, self._rows = _sorted_rows(keys) if keys.dtype != np.dtype('>u8') else\
+                                 (keys, keys.view('V%d' %(8*keys.shape[1])).ravel())
+        self.hop_ix = hop_ix
+        self.hops = hops
+        self.protocol = protocol
+        self.instrument = instrument
+        self._last = (None, -1) # the FIB is probed with `in`, then indexed
+
+    @classmethod
+    def from_fib(cls, fib, protocol='v4', render=True, instrument=True):
+        '''Returns the CompactFIB of `fib` (FIB or dict), rendering the
+            values that are CIDR strings on access if `render` is set.
+        '''
+        items = sorted(fib.items())
+        interned = dict() # FIB value -> index into hops
+        hop_ix = [-1 if render and val == _cidr(key, protocol) else
+                  interned.setdefault(val, len(interned)) for key, val in items]
+        dtype = next(dtype for dtype in (np.int8, np.int16, np.int32, np.int64)
+                     if len(interned) <= np.iinfo(dtype).max)
+        return cls(to_words([key for key, _ in items], KEY_WIDTH[protocol]),
+                   np.array(hop_ix, dtype=dtype), list(interned), protocol, instrument)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def index(self, key):
+        '''Row of `key`, or -1 if absent.
+        '''
+        if key == self._last[0]: return self._last[1]
+        row = np.void(key.to_bytes(self._rows.itemsize, 'big'))
+        ix = int(self._rows.searchsorted(row))
+        if ix == len(self._rows) or self._rows[ix] != row:
+            ix = -1
+        self._last = (key, ix)
+        return ix
+
+    def index_many(self, keys):
+        '''Vectorized index(): int64 array of the rows of `keys` (uint64
+            array, or to_words() rows as from ipfilter._key_words()), -1
+            for keys not in the FIB.
+        '''
+        _, rows = _sorted_rows(keys)
+        if self.instrument:
+            CompactFIB.__contains__.ncalls += len(rows)
+        ix = np.minimum(self._rows.searchsorted(rows), len(self._rows) - 1)
+        return np.where(self._rows[ix] == rows, ix, -1) if len(self._rows) else\
+               np.full(len(rows), -1, dtype=np.int64)
+
+    def contains_many(self, keys):
+        '''Vectorized `in`: bool array, whether each of `keys` is in the FIB.
+        '''
+        return self.index_many(keys) >= 0
+
+    def value(self, ix):
+        '''FIB value of the key in row `ix`.
+        '''
+        if self.hop_ix is None: return ix
+        hop = self.hop_ix[ix]
+        if hop < 0: return _cidr(self._key(ix), self.protocol)
+        return self.hops[hop]
+
+    def _key(self, ix):
+        return int.from_bytes(self._rows[ix].tobytes(), 'big')
+
+    def __contains__(self, key):
+        if self.instrument:
+            CompactFIB.__contains__.ncalls += 1
+        return self.index(key) >= 0
+
+    def __getitem__(self, key):
+        if self.instrument:
+            CompactFIB.__getitem__.ncalls += 1
+        ix = self.index(key)
+        if ix < 0: raise KeyError(key)
+        return self.value(ix)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [self._key(ix) for ix in range(len(self))]
+
+    def values(self):
+        return [self.value(ix) for ix in range(len(self))]
+
+    def items(self):
+        return list(zip(self.keys(), self.values()))
+
+    def num_bytes(self):
+        '''Memory of the key and hop arrays and of the interned values.
+        '''
+        hop_bytes = 0 if self.hop_ix is None else\
+                    self.hop_ix.nbytes + getsizeof(self.hops) + sum(map(getsizeof, self.hops))
+        return self.words.nbytes + hop_bytes
+
+# lookups, counted like count_invocations() does if instrumented
+CompactFIB.__contains__.ncalls = CompactFIB.__getitem__.ncalls = 0
+
+def _cidr(key, protocol='v4'):
+    '''CIDR string of encoded route `key`, as in the prefix files.
+    '''
+    network = IPv4Network if protocol == 'v4' else IPv6Network
+    return str(network((key & ((1<<ENCODING[protocol]) - 1), key >> ENCODING[protocol])))
+
 def encode_ip_prefix_pair(ip, prefix, protocol='v4'):
     '''Takes two ints, returns an int. Used for hashing.
     '''
     return (prefix << ENCODING[protocol]) + ip
 
-def compile_fib_table(protocol='v4', infile=PREFIX_FILE):
+def compile_fib_table(protocol='v4', infile=PREFIX_FILE, instrument=True):
     '''Load prefixes into a hash table.
        Returns FIB table (dict): { encoded(pref_int, pref_len): pref_str }
             e.g. for IPv4: {103095992320: '1.0.0.0/24', ...}
+       A FIB counting its lookups, or a plain dict unless `instrument`.
     '''
     indir = IPV4DIR if protocol=='v4' else IPV6DIR
-    fib = FIB()
+    fib = FIB() if instrument else dict()
     with open (os.path.join(indir, infile), 'r') as infile:
         for line in infile:
             parts = line.strip().split()
-            if len(parts) != 3: continue
+            if len(parts) < 3: continue
             fib[encode_ip_prefix_pair(int(parts[0]), int(parts[1]), protocol)] = parts[2]
     return fib
 
@@ -87,16 +223,60 @@ def load_traffic(protocol='v4', typ=RANDOM_TRAFFIC):
     shuffle(traffic)
     return traffic
 
+def iter_traffic(protocol='v4', typ=RANDOM_TRAFFIC, infile=None):
+    '''Yield IPs one by one from `typ`, or from `infile` (any iterable of
+        lines, e.g. an open trace file or sys.stdin), in their original
+        order and without loading them all into memory.
+    '''
+    if infile is None:
+        indir = IPV4DIR if protocol=='v4' else IPV6DIR
+        fpath = os.path.join(indir, typ)
+        if not os.path.isfile(fpath):
+            raise FileNotFoundError('No such file: "%s"' %fpath)
+        with open(fpath, 'r') as infile:
+            yield from iter_traffic(protocol, infile=infile)
+        return
+    for line in infile:
+        parts = line.strip().split()
+        if len(parts) < 1: continue
+        yield int(parts[0])
+
 def load_prefixes(protocol='v4', infile=PREFIX_FILE):
     prefixes = []
     indir = IPV4DIR if protocol=='v4' else IPV6DIR
     with open (os.path.join(indir, infile), 'r') as infile:
         for line in infile:
             parts = line.strip().split()
-            if len(parts) != 3: continue
+            if len(parts) < 3: continue
             prefixes.append((int(parts[0]), int(parts[1])))
     return prefixes
 
+def load_next_hops(protocol='v4', infile=PREFIX_FILE):
+    '''Load the next hop of each prefix, the 4th column of the prefix
+       file (see data/preprocess_bgp_tables.py).
+       Returns dict: { encoded(pref_int, pref_len): next_hop_str },
+            empty for a prefix file without next hops.
+    '''
+    next_hops = dict()
+    indir = IPV4DIR if protocol=='v4' else IPV6DIR
+    with open (os.path.join(indir, infile), 'r') as infile:
+        for line in infile:
+            parts = line.strip().split()
+            if len(parts) < 4: continue
+            next_hops[encode_ip_prefix_pair(int(parts[0]), int(parts[1]), protocol)] = parts[3]
+    return next_hops
+
+def intern_next_hops(next_hops):
+    '''Number the distinct values of `next_hops` (dict: encoded prefix ->
+       next hop, e.g. from load_next_hops()) in order of first appearance.
+       Returns the list of distinct next hops, and dict: encoded prefix ->
+            index of its next hop in that list.
+    '''
+    interned = dict() # next hop -> index
+    hop_ix = {key: interned.setdefault(next_hop, len(interned))
+              for key, next_hop in sorted(next_hops.items())}
+    return list(interned), hop_ix
+
 def prefix_stats(prefixes):
     '''Return a dict of basic stats about the incoming prefixes.
     '''